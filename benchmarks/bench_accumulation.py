@@ -0,0 +1,54 @@
+import time
+
+import requests
+
+from powerlibs.aws.sqs.dequeue_to_api.serialization import decode_response, get_serializer
+from powerlibs.aws.sqs.dequeue_to_api.transformations import accumulate
+
+from stub_api import StubAPI
+
+
+class Dequeuer:
+    def __init__(self, base_url):
+        self.config = {'base_url': base_url}
+        self.serializer = get_serializer()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=64)
+        self.session.mount('http://', adapter)
+
+    def get(self, url):
+        return self.session.get(url)
+
+    def decode_response(self, response):
+        return decode_response(self.serializer, response)
+
+
+ACCUMULATORS = (
+    ('alfa', 'foo/{payload[id]}/?results=4'),
+    ('beta', 'bar/{alfa[id]}/?results=4'),
+    ('gama', 'baz/{beta[id]}/?results=2'),
+)
+
+
+def run(latency=0.02, concurrencies=(1, 4, 16, 32)):
+    with StubAPI(latency=latency) as api:
+        dequeuer = Dequeuer(api.base_url)
+        payload = {'id': 'MESSAGE_ID'}
+        expected = None
+
+        for concurrency in concurrencies:
+            requests_before = api.requests_count
+            started = time.perf_counter()
+            results = accumulate(dequeuer, payload, ACCUMULATORS, concurrency=concurrency)
+            elapsed = time.perf_counter() - started
+
+            expected = expected or results
+            assert results == expected
+
+            print('concurrency {:>3}: {:>4} GETs, {:>4} entries in {:7.3f}s'.format(
+                concurrency, api.requests_count - requests_before, len(results), elapsed
+            ))
+
+
+if __name__ == '__main__':
+    run()
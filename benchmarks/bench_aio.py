@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import time
+
+from powerlibs.aws.sqs.dequeue_to_api import DequeueToAPI
+from powerlibs.aws.sqs.dequeue_to_api.aio import AsyncDequeueToAPI
+
+from stub_api import StubAPI
+
+
+class Message:
+    def __init__(self, data, topic):
+        self.body = json.dumps(data)
+        self.message_attributes = {'topic': {'StringValue': topic}}
+
+    def delete(self):
+        pass
+
+
+def build_config(base_url):
+    return {
+        'config': {
+            'base_url': base_url,
+            'accumulators_concurrency': 4,
+            'http': {'pool_maxsize': 256},
+            'async': {'max_in_flight': 1000},
+        },
+        'actions': {
+            'update_children': {
+                'topic': 'parent__updated',
+                'endpoint': 'children/',
+                'method': 'POST',
+                'accumulators': [('child', 'children/?parent={payload[id]}&results=2')],
+                'payload': {'parent': '{payload[id]}', 'child': '{child[id]}'},
+            },
+        },
+    }
+
+
+def build_dequeuer(dequeuer_class, base_url):
+    return dequeuer_class(
+        build_config(base_url), 'BENCHMARK',
+        process_pool_size=0,
+        thread_pool_size=0,
+        aws_access_key_id='AWS_ID',
+        aws_secret_access_key='AWS_SECRET',
+        aws_region='AWS_REGION'
+    )
+
+
+def run_threads(dequeuer, messages, threads):
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return sum(executor.map(dequeuer.parse_and_handle_message, messages))
+
+
+def run_async(dequeuer, messages):
+    async def run_all():
+        results = await asyncio.gather(*(dequeuer.async_parse_and_handle_message(message) for message in messages))
+        await dequeuer.close_client_sessions()
+        return sum(results)
+
+    return asyncio.run(run_all())
+
+
+def run(messages_count=500, latency=0.05, threads=32):
+    messages = [Message({'id': index}, 'parent__updated') for index in range(messages_count)]
+
+    with StubAPI(latency=latency) as api:
+        dequeuer = build_dequeuer(DequeueToAPI, api.base_url)
+        started = time.perf_counter()
+        assert run_threads(dequeuer, messages, threads) == messages_count
+        threaded = time.perf_counter() - started
+        dequeuer.shutdown()
+
+        dequeuer = build_dequeuer(AsyncDequeueToAPI, api.base_url)
+        started = time.perf_counter()
+        assert run_async(dequeuer, messages) == messages_count
+        asynchronous = time.perf_counter() - started
+        dequeuer.shutdown()
+
+    print('{} messages ({} HTTP calls each, {}ms latency):'.format(messages_count, 3, int(latency * 1000)))
+    print('  {:>3} threads: {:7.1f} msg/s'.format(threads, messages_count / threaded))
+    print('  event loop:  {:7.1f} msg/s'.format(messages_count / asynchronous))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,86 @@
+# Compares `apply_data_map` (every value of every entry parsed as it
+# goes) with `DataMapper` (the "MAP:" sites found in the payload
+# template once) on rendered entries.
+import timeit
+
+from powerlibs.aws.sqs.dequeue_to_api.data_maps import DataMapper
+from powerlibs.aws.sqs.dequeue_to_api.templates import compile_payload_template
+from powerlibs.aws.sqs.dequeue_to_api.transformations import apply_data_map
+
+
+DATA_MAP = {'rgb': 'RGB', 'thermal': 'THERMAL', 'multispectral': 'MULTISPECTRAL', 'done': 'DONE'}
+
+TEMPLATES = {
+    'flat': {
+        'project': '{payload[id]}',
+        'flight': '{flight[id]}',
+        'tile': '{tile[id]}',
+        'status': 'processed',
+        'zoom': 'INT:{tile[zoom]}',
+        'kind': 'MAP:{payload[kind]}',
+        'state': 'MAP:done',
+    },
+    'nested': {
+        'project': '{payload[id]}',
+        'tile': '{tile[id]}',
+        'kind': 'MAP:{payload[kind]}',
+        'metadata': {'source': 'MAP:rgb', 'bands': ['MAP:rgb', 'MAP:thermal'], 'version': 2},
+        'flags': ['MAP:done', 'visible'],
+    },
+}
+
+
+def build_entries(entries_count):
+    return [
+        {
+            'payload': {'id': 'PROJECT_ID', 'kind': ('rgb', 'thermal')[index % 2]},
+            'flight': {'id': 'FLIGHT_{}'.format(index // 100)},
+            'tile': {'id': 'TILE_{}'.format(index), 'zoom': str(index % 20)},
+        }
+        for index in range(entries_count)
+    ]
+
+
+def run(entries_count=1000, repetitions=20):
+    entries = build_entries(entries_count)
+    args = ('project__processed', {}, {'method': 'POST'})
+
+    for name, template in TEMPLATES.items():
+        compiled = compile_payload_template(template)
+        mapper = DataMapper(DATA_MAP, template, {'nested': name == 'nested'})
+        rendered = [compiled.render(*args, entry) for entry in entries]
+
+        if name == 'flat':
+            for entry in rendered[:10]:
+                assert mapper.apply(dict(entry)) == apply_data_map(entry, DATA_MAP)
+
+        # Both get fresh copies, as they would get freshly rendered entries:
+        # the time copying takes is measured apart, and left out.
+        def do_copy():
+            for entry in rendered:
+                dict(entry)
+
+        def do_legacy():
+            for entry in rendered:
+                apply_data_map(dict(entry), DATA_MAP)
+
+        def do_compiled():
+            for entry in rendered:
+                mapper.apply(dict(entry))
+
+        copy = min(timeit.repeat(do_copy, number=repetitions, repeat=3))
+        legacy = min(timeit.repeat(do_legacy, number=repetitions, repeat=3)) - copy
+        mapped = min(timeit.repeat(do_compiled, number=repetitions, repeat=3)) - copy
+        per_entry = entries_count * repetitions
+
+        print('{:<7} {} entries: apply_data_map {:5.2f}us/entry, DataMapper {:5.2f}us/entry ({:.1f}x){}'.format(
+            name, entries_count,
+            legacy / per_entry * 1e6,
+            mapped / per_entry * 1e6,
+            legacy / mapped,
+            '' if name == 'flat' else ' (apply_data_map leaves nested values unmapped)',
+        ))
+
+
+if __name__ == '__main__':
+    run()
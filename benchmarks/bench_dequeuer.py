@@ -0,0 +1,314 @@
+# End to end load test: messages go through an in-memory SQS queue
+# (fake_sqs.FakeQueue), the real SQSDequeuer receiving loop and thread
+# pool (or the event loop of AsyncDequeueToAPI) and a local HTTP API
+# (stub_api.StubAPI) with configurable latency and error rate.
+#
+#   python bench_dequeuer.py --output before.json
+#   (change something)
+#   python bench_dequeuer.py --compare before.json
+#
+# Each scenario runs in its own process, so peak RSS is per scenario.
+# Messages and API errors come from a seeded random generator: runs
+# with the same arguments send the same work, and can be compared
+# across commits.
+
+from argparse import ArgumentParser
+import json
+import os.path
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from powerlibs.aws.sqs.dequeue_to_api import DequeueToAPI
+from powerlibs.aws.sqs.dequeue_to_api.aio import AsyncDequeueToAPI
+
+from fake_sqs import FakeQueue
+from stub_api import StubAPI
+
+
+PLUGINS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plugins')
+
+ACTIONS = {
+    'literal': {
+        'update_parent': {
+            'topic': 'company__parent_updated',
+            'endpoint': 'parents/{payload[id]}/',
+            'method': 'PATCH',
+            'payload': {'status': '{payload[status]}', 'updated_by': 'dequeuer'},
+        },
+    },
+    'regex': {
+        'register_step': {
+            'topic': 'step__(?P<step_name>[a-z]+)__(?P<step_status>started|finished)',
+            'endpoint': 'steps/',
+            'method': 'POST',
+            'payload': {
+                'id': '{payload[id]}',
+                'name': '{_topic_groups[step_name]}',
+                'status': '{_topic_groups[step_status]}',
+            },
+        },
+    },
+    'accumulators': {
+        'create_tiles': {
+            'topic': 'project__processed',
+            'endpoint': 'tiles/',
+            'method': 'POST',
+            'accumulators': [
+                ('flight', 'flights/?project={payload[id]}&results=3'),
+                ('image', 'images/?flight={flight[id]}&results=3'),
+                ('tile', 'tiles/?image={image[id]}&results=2'),
+            ],
+            'payload': {
+                'project': '{payload[id]}',
+                'flight': '{flight[id]}',
+                'tile': '{tile[id]}',
+                'kind': 'MAP:{payload[kind]}',
+            },
+            'data_map': {'rgb': 'RGB', 'thermal': 'THERMAL'},
+        },
+    },
+    'plugins': {
+        'run_plugins': {
+            'topic': 'plugins__run',
+            'custom_handlers': ['bench_plugin.count', 'bench_plugin.notify'],
+        },
+    },
+}
+SCENARIOS = tuple(ACTIONS) + ('mixed',)
+
+
+def build_message(scenario, index, rng):
+    if scenario == 'literal':
+        return 'company__parent_updated', {'id': index, 'status': rng.choice(('new', 'done'))}
+    if scenario == 'regex':
+        topic = 'step__{}__{}'.format(rng.choice(('upload', 'process', 'render')), rng.choice(('started', 'finished')))
+        return topic, {'id': index}
+    if scenario == 'accumulators':
+        return 'project__processed', {'id': index, 'kind': rng.choice(('rgb', 'thermal'))}
+    if scenario == 'plugins':
+        return 'plugins__run', {'id': index}
+    return build_message(rng.choice(SCENARIOS[:-1]), index, rng)
+
+
+def build_config(scenario, base_url, threads):
+    actions = {}
+    for name in (SCENARIOS[:-1] if scenario == 'mixed' else (scenario,)):
+        actions.update(ACTIONS[name])
+
+    return {
+        'config': {
+            'base_url': base_url,
+            'http': {'pool_maxsize': max(threads, 10)},
+            'custom_handlers': {'paths': [PLUGINS_PATH]},
+            'async': {'max_in_flight': threads},
+        },
+        'actions': actions,
+    }
+
+
+def build_dequeuer(engine, config, threads):
+    dequeuer_class, thread_pool_size = (AsyncDequeueToAPI, 0) if engine == 'async' else (DequeueToAPI, threads)
+    return dequeuer_class(
+        config, 'BENCHMARK',
+        process_pool_size=0,
+        thread_pool_size=thread_pool_size,
+        aws_access_key_id='AWS_ID',
+        aws_secret_access_key='AWS_SECRET',
+        aws_region='AWS_REGION'
+    )
+
+
+def time_handling(dequeuer, engine):
+    # Marks when each message first starts being handled, to tell its
+    # latency (redeliveries included) apart from the time it waited in
+    # the dequeuer's own queue.
+    def mark(message):
+        if getattr(message, 'handling_started_at', None) is None:
+            message.handling_started_at = time.perf_counter()
+
+    if engine == 'async':
+        original = dequeuer.async_parse_and_handle_message
+
+        async def timed(message):
+            mark(message)
+            return await original(message)
+
+        dequeuer.async_parse_and_handle_message = timed
+    else:
+        original = dequeuer.parse_and_handle_message
+
+        def timed(message):
+            mark(message)
+            return original(message)
+
+        dequeuer.parse_and_handle_message = timed
+
+
+def stop_thread_pool(dequeuer):
+    # SQSDequeuer threads wait up to 5s for work before noticing
+    # `alive` is gone: wake them up.
+    dequeuer.alive = False
+    for _ in dequeuer.threads:
+        dequeuer.thread_queue.put((lambda: None, [], {}))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def get_peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenario(scenario, engine='threads', messages_count=1000, latency=0.005, error_rate=0.0, threads=32,
+                 seed=0, visibility_timeout=2.0, timeout=300):
+    rng = random.Random(seed)
+    random.seed(seed)  # The stub API errors.
+    queue = FakeQueue(visibility_timeout=visibility_timeout)
+
+    with StubAPI(latency=latency, error_rate=error_rate) as api:
+        dequeuer = build_dequeuer(engine, build_config(scenario, api.base_url, threads), threads)
+        dequeuer.queue = queue
+        time_handling(dequeuer, engine)
+
+        for index in range(messages_count):
+            queue.send(*build_message(scenario, index, rng))
+
+        started = time.perf_counter()
+        deadline = started + timeout
+        while queue.pending_count and time.perf_counter() < deadline:
+            if engine == 'threads' and dequeuer.thread_queue.qsize() > threads * 2:
+                time.sleep(0.001)
+                continue
+            dequeuer.process_messages()
+        elapsed = time.perf_counter() - started
+
+        if engine == 'threads':
+            stop_thread_pool(dequeuer)
+        dequeuer.shutdown()
+        http_requests = api.requests_count
+
+    latencies = [message.deleted_at - message.handling_started_at for message in queue.deleted]
+    return {
+        'scenario': scenario,
+        'engine': engine,
+        'messages': messages_count,
+        'handled': len(queue.deleted),
+        'attempts': sum(message.receive_count for message in queue.deleted),
+        'http_requests': http_requests,
+        'elapsed': round(elapsed, 3),
+        'messages_per_second': round(len(queue.deleted) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+    }
+
+
+def run_isolated(scenario, arguments):
+    command = [sys.executable, os.path.abspath(__file__), '--scenario', scenario, '--json'] + arguments
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_results(results, baseline=None):
+    baseline = {(result['scenario'], result['engine']): result for result in (baseline or [])}
+    print('{:<13} {:<8} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'scenario', 'engine', 'msg/s', 'p50 ms', 'p99 ms', 'RSS MB', 'requests'
+    ))
+    for result in results:
+        print('{:<13} {:<8} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            result['scenario'], result['engine'], result['messages_per_second'], result['p50_ms'],
+            result['p99_ms'], result['peak_rss_mb'], result['http_requests']
+        ))
+        before = baseline.get((result['scenario'], result['engine']), None)
+        if before:
+            def change(key):
+                return '{:+.1f}%'.format((result[key] / before[key] - 1) * 100) if before[key] else '-'
+
+            print('{:<13} {:<8} {:>9} {:>9} {:>9} {:>9}'.format(
+                '', 'vs base', change('messages_per_second'), change('p50_ms'), change('p99_ms'),
+                change('peak_rss_mb')
+            ))
+
+
+def main():
+    parser = ArgumentParser(description='Load test DequeueToAPI against a fake SQS queue and a stub API.')
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append')
+    parser.add_argument('--engine', choices=('threads', 'async'), action='append')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.005, help='Stub API latency, in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of stub API responses that are 503s.')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--visibility-timeout', type=float, default=2.0,
+        help='Seconds before a failed (or too slow) message is received again.'
+    )
+    parser.add_argument('--output', help='Save the results (JSON) here.')
+    parser.add_argument('--compare', help='Results (JSON) of a previous run to compare with.')
+    parser.add_argument('--json', action='store_true', help='Run in this process and print the result as JSON.')
+    args = parser.parse_args()
+
+    scenarios = args.scenario or SCENARIOS
+    engines = args.engine or ('threads',)
+    parameters = {
+        'messages': args.messages, 'latency': args.latency, 'error_rate': args.error_rate,
+        'threads': args.threads, 'seed': args.seed, 'visibility_timeout': args.visibility_timeout,
+    }
+
+    if args.json:
+        result = run_scenario(
+            scenarios[0], engines[0], args.messages, args.latency, args.error_rate, args.threads, args.seed,
+            args.visibility_timeout
+        )
+        print(json.dumps(result))
+        return
+
+    arguments = [
+        '--messages', str(args.messages), '--latency', str(args.latency), '--error-rate', str(args.error_rate),
+        '--threads', str(args.threads), '--seed', str(args.seed),
+        '--visibility-timeout', str(args.visibility_timeout),
+    ]
+    results = []
+    for scenario in scenarios:
+        for engine in engines:
+            result = run_isolated(scenario, arguments + ['--engine', engine])
+            result.update(parameters)
+            results.append(result)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'commit': get_commit(),
+                'python': platform.python_version(),
+                'parameters': parameters,
+                'results': results,
+            }, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
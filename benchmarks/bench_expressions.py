@@ -0,0 +1,49 @@
+import timeit
+
+from powerlibs.aws.sqs.dequeue_to_api.expressions import evaluate_source
+from powerlibs.aws.sqs.dequeue_to_api.templates import compile_payload_template
+
+
+def legacy_eval(entry):
+    return eval('EVAL:{payload[count]} * 2 + {beta[position]}'.format(**entry).replace('EVAL:', ''))
+
+
+def build_entries(entries_count):
+    return [
+        {
+            'payload': {'count': str(index % 50)},
+            'beta': {'position': str(index)},
+            'expression': {'source': '{} + 1'.format(index)},
+        }
+        for index in range(entries_count)
+    ]
+
+
+def run(entries_count=1000, repetitions=20):
+    entries = build_entries(entries_count)
+    args = ('topic', {}, {})
+
+    bound = compile_payload_template({'value': 'EVAL:{payload[count]} * 2 + {beta[position]}'})
+    text = compile_payload_template({'value': 'EVAL:({expression[source]}) * 2'})
+    expression = compile_payload_template({'value': "EXPR:int(payload['count']) * 2 + int(beta['position'])"})
+
+    for entry in entries[:10]:
+        assert bound.render(*args, entry)['value'] == legacy_eval(entry)
+        assert expression.render(*args, entry)['value'] == legacy_eval(entry)
+
+    cases = (
+        ('builtin eval (legacy)', lambda: [legacy_eval(entry) for entry in entries]),
+        ('EVAL: bound fields', lambda: [bound.render(*args, entry) for entry in entries]),
+        ('EVAL: text fallback', lambda: [text.render(*args, entry) for entry in entries]),
+        ('EXPR: variables', lambda: [expression.render(*args, entry) for entry in entries]),
+        ('cached source', lambda: [evaluate_source('21 * 2') for entry in entries]),
+    )
+
+    per_entry = entries_count * repetitions
+    for name, function in cases:
+        elapsed = min(timeit.repeat(function, number=repetitions, repeat=3))
+        print('{:>24}: {:6.2f}us/entry'.format(name, elapsed / per_entry * 1e6))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,67 @@
+import re
+import timeit
+
+from powerlibs.aws.sqs.dequeue_to_api.routing import TopicRouter
+
+
+def build_topics(actions_count):
+    topics = []
+    for index in range(actions_count):
+        kind = index % 3
+        if kind == 0:
+            topics.append('object_{}__created'.format(index))
+        elif kind == 1:
+            topics.append('step_{}__(?P<step_name>[^_]+)__(?P<step_status>[^_]+)'.format(index))
+        else:
+            topics.append('{{payload[company_name]}}__thing_{}__updated'.format(index))
+    return topics
+
+
+def linear_scan(topics, config, topic, payload):
+    matches = []
+    for topic_name in topics:
+        match = re.match(topic_name.format(config=config, payload=payload), topic)
+        if match:
+            matches.append((topic_name, match.groupdict()))
+    return matches
+
+
+def run(actions_count, repetitions=2000):
+    config = {}
+    payload = {'company_name': 'mycompany'}
+    topics = build_topics(actions_count)
+    router = TopicRouter(topics, config)
+
+    messages = (
+        'object_{}__created'.format(actions_count - 3),
+        'step_1__alfa__started',
+        'mycompany__thing_2__updated',
+        'unknown__topic',
+    )
+
+    for message_topic in messages:
+        assert router.route(message_topic, payload) == linear_scan(topics, config, message_topic, payload)
+
+    def do_linear():
+        for message_topic in messages:
+            linear_scan(topics, config, message_topic, payload)
+
+    def do_router():
+        for message_topic in messages:
+            router.route(message_topic, payload)
+
+    linear = min(timeit.repeat(do_linear, number=repetitions, repeat=3))
+    routed = min(timeit.repeat(do_router, number=repetitions, repeat=3))
+    per_message = len(messages) * repetitions
+
+    print('{:>5} actions: linear scan {:8.2f}us/msg, router {:8.2f}us/msg ({:.1f}x)'.format(
+        actions_count,
+        linear / per_message * 1e6,
+        routed / per_message * 1e6,
+        linear / routed,
+    ))
+
+
+if __name__ == '__main__':
+    for actions_count in (10, 100, 1000):
+        run(actions_count, repetitions=max(20, 20000 // actions_count))
@@ -0,0 +1,52 @@
+import json
+import timeit
+import tracemalloc
+
+from powerlibs.aws.sqs.dequeue_to_api.serialization import SERIALIZERS, get_serializer, project_fields
+
+
+def build_response(results_count):
+    # A page of "heavy" results, of which templates use two fields.
+    return json.dumps({
+        'results': [
+            {
+                'id': index,
+                'name': 'image_{}.jpg'.format(index),
+                'metadata': {'exif': {'key_{}'.format(key): 'value' * 4 for key in range(20)}},
+                'tags': ['tag_{}'.format(tag) for tag in range(10)],
+                'description': 'lorem ipsum ' * 20,
+            }
+            for index in range(results_count)
+        ],
+        'next': None,
+    }).encode('utf-8')
+
+
+def get_retained_size(function):
+    tracemalloc.start()
+    retained = function()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del retained
+    return size
+
+
+def run(results_count=2000, repetitions=5):
+    content = build_response(results_count)
+    body = {'entries': json.loads(content)['results'][:200]}
+    print('Response: {:.1f}MB, {} results'.format(len(content) / 1e6, results_count))
+
+    for name in sorted(SERIALIZERS):
+        serializer = get_serializer(name)
+        decode = min(timeit.repeat(lambda: serializer.loads(content), number=repetitions, repeat=3)) / repetitions
+        encode = min(timeit.repeat(lambda: serializer.dumps(body), number=repetitions, repeat=3)) / repetitions
+        print('{:>8}: decode {:7.2f}ms, encode (200 results) {:6.2f}ms'.format(name, decode * 1e3, encode * 1e3))
+
+    serializer = get_serializer()
+    full = get_retained_size(lambda: serializer.loads(content)['results'])
+    projected = get_retained_size(lambda: project_fields(serializer.loads(content)['results'], ('id', 'name')))
+    print('Retained results: all fields {:.1f}MB, "fields": ["id", "name"] {:.1f}MB'.format(full / 1e6, projected / 1e6))
+
+
+if __name__ == '__main__':
+    run()
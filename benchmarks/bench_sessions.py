@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import requests
+
+from powerlibs.aws.sqs.dequeue_to_api.sessions import SessionPool
+
+from stub_api import StubAPI
+
+
+def measure(request, url, requests_count, threads):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for response in executor.map(lambda _: request(url, json={'status': 'ok'}), range(requests_count)):
+            response.raise_for_status()
+    return requests_count / (time.perf_counter() - started)
+
+
+def run(requests_count=2000, threads=8):
+    with StubAPI() as api:
+        url = api.base_url + 'parents/1/'
+        pool = SessionPool({'Authorization': 'token BENCHMARK'}, pool_maxsize=threads)
+
+        module_level = measure(requests.patch, url, requests_count, threads)
+        pooled = measure(lambda url, **kwargs: pool.request('patch', url, **kwargs), url, requests_count, threads)
+        pool.close()
+
+    print('{} PATCHes, {} threads: requests.patch {:7.1f} req/s, SessionPool {:7.1f} req/s ({:.1f}x)'.format(
+        requests_count, threads, module_level, pooled, pooled / module_level
+    ))
+
+
+if __name__ == '__main__':
+    run()
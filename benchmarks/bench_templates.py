@@ -0,0 +1,88 @@
+import timeit
+
+from powerlibs.aws.sqs.dequeue_to_api.templates import compile_payload_template
+
+
+def legacy_apply_payload_template(payload_template, topic, topic_groups, action, payload):
+    hydrated_payload = {}
+    for key, value in payload_template.items():
+
+        optional = False
+        if value.startswith('OPTIONAL:'):
+            optional = True
+            value = value.replace('OPTIONAL:', '')
+
+        try:
+            hydrated_payload[key] = value.format(
+                _topic=topic,
+                _topic_groups=topic_groups,
+                _action=action,
+                **payload
+            )
+        except KeyError as ex:
+            if optional:
+                continue
+            raise ex
+
+        if hydrated_payload[key].startswith('INT:'):
+            hydrated_payload[key] = int(hydrated_payload[key].replace('INT:', ''))
+        elif hydrated_payload[key].startswith('DICT:'):
+            hydrated_payload[key] = dict(hydrated_payload[key].replace('DICT:', ''))
+        elif hydrated_payload[key].startswith('EVAL:'):
+            hydrated_payload[key] = eval(hydrated_payload[key].replace('EVAL:', ''))
+
+    return hydrated_payload
+
+
+TEMPLATE = {
+    'status': 'processed',
+    'parent': '{payload[id]}',
+    'child': '{gama[id]}',
+    'sequence': 'INT:{beta[position]}',
+    'step': '{_topic_groups[step_name]}',
+    'comment': 'OPTIONAL:{payload[comment]}',
+}
+
+
+def build_entries(entries_count):
+    return [
+        {
+            'payload': {'id': 'MESSAGE_ID', 'company_name': 'mycompany'},
+            'alfa': {'id': 'ALFA_ID'},
+            'beta': {'id': 'BETA_ID', 'position': str(index)},
+            'gama': {'id': 'FINAL_{}'.format(index)},
+        }
+        for index in range(entries_count)
+    ]
+
+
+def run(entries_count=1000, repetitions=20):
+    entries = build_entries(entries_count)
+    args = ('step__alfa__finished', {'step_name': 'alfa'}, {'method': 'POST'})
+    compiled = compile_payload_template(TEMPLATE)
+
+    for entry in entries[:10]:
+        assert compiled.render(*args, entry) == legacy_apply_payload_template(TEMPLATE, *args, entry)
+
+    def do_legacy():
+        for entry in entries:
+            legacy_apply_payload_template(TEMPLATE, *args, entry)
+
+    def do_compiled():
+        for entry in entries:
+            compiled.render(*args, entry)
+
+    legacy = min(timeit.repeat(do_legacy, number=repetitions, repeat=3))
+    rendered = min(timeit.repeat(do_compiled, number=repetitions, repeat=3))
+    per_entry = entries_count * repetitions
+
+    print('{} entries: legacy {:6.2f}us/entry, compiled {:6.2f}us/entry ({:.1f}x)'.format(
+        entries_count,
+        legacy / per_entry * 1e6,
+        rendered / per_entry * 1e6,
+        legacy / rendered,
+    ))
+
+
+if __name__ == '__main__':
+    run()
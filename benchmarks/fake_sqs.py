@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import itertools
+import json
+import threading
+import time
+
+
+class FakeMessage:
+    # The parts of boto3's `sqs.Message` the dequeuers use.
+
+    def __init__(self, queue, message_id, body, message_attributes):
+        self.queue = queue
+        self.message_id = message_id
+        self.receipt_handle = 'RECEIPT-{}'.format(message_id)
+        self.body = body
+        self.message_attributes = message_attributes
+
+        self.sent_at = time.perf_counter()
+        self.received_at = None
+        self.deleted_at = None
+        self.receive_count = 0
+        self.visible_at = 0.0
+
+    def delete(self):
+        self.queue.delete(self.receipt_handle)
+
+    def change_visibility(self, VisibilityTimeout):
+        self.queue.change_visibility(self.receipt_handle, VisibilityTimeout)
+
+
+class FakeQueue:
+    # An in-memory stand-in for boto3's `sqs.Queue`, to be set as the
+    # `queue` of any `SQSDequeuer`. `visibility_timeout`, when given,
+    # replaces the one asked by `receive_messages` (SQSDequeuer asks for
+    # 30s, too long for a benchmark with failures).
+
+    def __init__(self, visibility_timeout=None, max_wait=0.05):
+        self.visibility_timeout = visibility_timeout
+        self.max_wait = max_wait
+        self.messages = OrderedDict()
+        self.deleted = []
+        self.ids = itertools.count()
+        self.condition = threading.Condition()
+
+    def send_message(self, MessageBody, MessageAttributes=None):
+        with self.condition:
+            message_id = str(next(self.ids))
+            message = FakeMessage(self, message_id, MessageBody, MessageAttributes or {})
+            self.messages[message.receipt_handle] = message
+            self.condition.notify()
+        return {'MessageId': message_id}
+
+    def send(self, topic, payload):
+        return self.send_message(json.dumps(payload), {'topic': {'StringValue': topic, 'DataType': 'String'}})
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=30, **kwargs):
+        visibility_timeout = self.visibility_timeout if self.visibility_timeout is not None else VisibilityTimeout
+        deadline = time.perf_counter() + min(WaitTimeSeconds, self.max_wait)
+
+        with self.condition:
+            while True:
+                now = time.perf_counter()
+                received = []
+                for message in self.messages.values():
+                    if message.visible_at <= now:
+                        message.visible_at = now + visibility_timeout
+                        message.receive_count += 1
+                        if message.received_at is None:
+                            message.received_at = now
+                        received.append(message)
+                        if len(received) >= MaxNumberOfMessages:
+                            break
+
+                if received or now >= deadline:
+                    return received
+                self.condition.wait(deadline - now)
+
+    def delete(self, receipt_handle):
+        with self.condition:
+            message = self.messages.pop(receipt_handle, None)
+            if message is not None:
+                message.deleted_at = time.perf_counter()
+                self.deleted.append(message)
+                self.condition.notify_all()
+
+    def delete_messages(self, Entries):
+        for entry in Entries:
+            self.delete(entry['ReceiptHandle'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def change_visibility(self, receipt_handle, visibility_timeout):
+        with self.condition:
+            message = self.messages.get(receipt_handle, None)
+            if message is not None:
+                message.visible_at = time.perf_counter() + visibility_timeout
+
+    @property
+    def pending_count(self):
+        return len(self.messages)
+
+    def wait_until_empty(self, timeout=None):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self.condition:
+            while self.messages:
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
@@ -0,0 +1,17 @@
+import os.path
+import threading
+
+
+class Plugin:
+    def __init__(self, dequeuer):
+        self.dequeuer = dequeuer
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, action, topic, payload):
+        with self.lock:
+            self.counts[topic] = self.counts.get(topic, 0) + 1
+
+    def notify(self, action, topic, payload):
+        url = os.path.join(self.dequeuer.config['base_url'], 'notifications/')
+        self.dequeuer.post(url, json={'topic': topic, 'id': payload['id']})
@@ -0,0 +1,109 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status_code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        server = self.server
+        server.count_request(self.command, self.path)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.error_rate and random.random() < server.error_rate:
+            self.send_json(503, {'detail': 'Service Unavailable'})
+            return
+
+        if self.command != 'GET':
+            self.send_json(200, {'status': 'ok'})
+            return
+
+        query = parse_qs(urlparse(self.path).query)
+        results_count = int(query.get('results', [server.results_per_page])[0])
+        path = urlparse(self.path).path
+        self.send_json(200, {
+            'results': [
+                {'id': '{}{}'.format(path.strip('/').replace('/', '_'), index)}
+                for index in range(results_count)
+            ]
+        })
+
+    do_GET = handle_request
+    do_POST = handle_request
+    do_PATCH = handle_request
+    do_PUT = handle_request
+    do_DELETE = handle_request
+
+
+class StubAPI:
+    # A local HTTP API answering every GET with a page of `results` and
+    # every write with a small JSON document, after `latency` seconds.
+
+    def __init__(self, latency=0.0, error_rate=0.0, results_per_page=2, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), StubAPIHandler)
+        self.server.latency = latency
+        self.server.error_rate = error_rate
+        self.server.results_per_page = results_per_page
+        self.server.requests_count = 0
+        self.server.requests_by_method = {}
+        self.server.lock = threading.Lock()
+        self.server.count_request = self.count_request
+        self.thread = None
+
+    def count_request(self, method, path):
+        with self.server.lock:
+            self.server.requests_count += 1
+            self.server.requests_by_method[method] = self.server.requests_by_method.get(method, 0) + 1
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    @property
+    def requests_count(self):
+        return self.server.requests_count
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -1,233 +1,803 @@
-from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import partial
 import glob
-import importlib
-import json
+import math
 import os.path
-import re
+import queue
 import sys
+import time
 import traceback
-
-import requests
+import warnings
 
 from powerlibs.aws.sqs.dequeuer import SQSDequeuer
-from .transformations import accumulate, apply_data_map
+from .acknowledgements import AcknowledgementBuffer
+from .batching import BatchStats, get_batch_body, iter_batches
+from .cache import CacheStats, build_step_cache
+from .coalescing import WriteCoalescer, when_all
+from .compiler import CompiledConfig, check_artifact, compile_config
+from .instrumentation import build_metrics
+from .journal import JournalStats, MessageProgress, build_journal, parse_journal
+from .plans import ActionPlan, HydrationStats, LazyEntries
+from .plugins import PluginRegistry, import_plugin_module
+from .retries import (
+    DEFAULT_CIRCUIT_BREAKER, CircuitBreakers, CircuitOpenError, call_with_retry, get_retry_defaults,
+    parse_circuit_breaker, parse_retry
+)
+from .scheduling import ActionScheduler, ExecutionStats
+from .serialization import JSON_HEADERS, decode_response, get_serializer, parse_serialization
+from .sessions import SessionPool
+from .templates import compile_payload_template
+from .throttling import RateLimiters, get_status_code
+from .transformations import iter_accumulate
 
 
 class DequeueToAPI(SQSDequeuer):
+    MAX_PAYLOAD_TEMPLATES = 1024  # Compiled ones kept for `apply_payload_template`.
+
     def __init__(self, config_data, queue_name, *args, **kwargs):
         super().__init__(queue_name, None, *args, **kwargs)
         self.load_config(config_data)
 
         self.load_request_methods()
 
-        self.custom_handlers = {}
-        self.load_custom_handlers(self.config.get('custom_handlers', {}))
+        # Opt-in: `{"batch_size": 10, "max_delay": 1.0}` deletes handled
+        # messages with DeleteMessageBatch instead of one by one.
+        acknowledgements_config = self.config.get('acknowledgements', None)
+        self.acknowledgements = None
+        if acknowledgements_config:
+            self.acknowledgements = AcknowledgementBuffer(
+                self.delete_messages_batch, logger=self.logger, on_deleted=self.forget_message,
+                **({} if acknowledgements_config is True else acknowledgements_config)
+            )
+
+        # Only the plugins the actions use, built when first needed (or
+        # right away, with `"loading": "eager"`).
+        self.plugins = PluginRegistry.from_config(self.compiled_actions, self.config, owner=self)
+        self.custom_handlers = self.plugins.plugins  # Plugin name: instance.
+        if (self.config.get('custom_handlers', None) or {}).get('loading', 'lazy') == 'eager':
+            self.plugins.load()
 
     @property
     def requests_headers(self):
         return {}
 
     def load_request_methods(self, requests_module=None):
-        requests_module = requests_module or requests
         self.request_methods = {}
 
-        def do_request(request_method, *args, **kwargs):
-            headers = kwargs.get('headers', {})
-            headers.update(self.requests_headers)
-            kwargs['headers'] = headers
+        if requests_module is None:
+            # Pooled sessions, with `requests_headers` set on each session.
+            self.sessions = SessionPool(lambda: self.requests_headers, **self.config.get('http', {}))
+        else:
+            self.sessions = None
+
+        def do_request(method_name, request_method, *args, **kwargs):
+            if self.sessions is None:
+                headers = kwargs.get('headers', {})
+                headers.update(self.requests_headers)
+                kwargs['headers'] = headers
             response = request_method(*args, **kwargs)
+            return self.check_response(method_name, response, args, kwargs)
 
-            method_name = request_method.__name__
-            if method_name == 'delete' and response.status_code == 404:
-                return response
+        for method_name in ('get', 'post', 'patch', 'delete', 'put'):
+            if self.sessions is None:
+                method = getattr(requests_module, method_name)
+            else:
+                method = partial(self.sessions.request, method_name)
+            self.request_methods[method_name] = partial(do_request, method_name, method)
+            # With the default retry policy (and circuit breakers, if configured).
+            setattr(self, method_name, partial(self.send_request, method_name))
 
-            try:
-                response.raise_for_status()
-            except Exception as ex:
-                print('do_request:', method_name, ':', args, kwargs)
-                print(response.content)
-                raise ex
+    def check_response(self, method_name, response, args, kwargs):
+        if method_name == 'delete' and response.status_code == 404:
             return response
 
-        for method_name in ('get', 'post', 'patch', 'delete', 'put'):
-            method = getattr(requests_module, method_name)
-            requester = partial(do_request, method)
-            self.request_methods[method_name] = requester
-            setattr(self, method_name, requester)
-
-    def load_config(self, config_data):
-        self.config = config_data['config']
-        self.actions = config_data['actions']
-        self.topics = defaultdict(list)
+        try:
+            response.raise_for_status()
+        except Exception as ex:
+            print('do_request:', method_name, ':', args, kwargs)
+            print(response.content)
+            raise ex
+        return response
+
+    def run_thread(self):
+        # As in SQSDequeuer, but marking every task done (for `drain`),
+        # surviving exceptions and noticing `alive` within a second.
+        while self.alive:
+            try:
+                function, args, kwargs = self.thread_queue.get(timeout=1)
+            except queue.Empty:
+                continue
 
-        for action_name, action_data in self.actions.items():
-            topic_name = action_data['topic']
+            try:
+                function(*args, **kwargs)
+            except Exception as ex:
+                self.logger.error(f'Exception {ex.__class__.__name__}: {ex}')
+            finally:
+                self.thread_queue.task_done()
+
+    def drain(self, timeout=None):
+        # Waits for the messages already received to be handled. Returns
+        # False if some still weren't after `timeout` seconds. Buffered
+        # writes and acknowledgements are sent by `shutdown`.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.thread_queue.all_tasks_done:
+            while self.thread_queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.thread_queue.all_tasks_done.wait(remaining)
+        return True
+
+    def shutdown(self):
+        super().shutdown()
+
+        coalescer = getattr(self, 'coalescer', None)
+        if coalescer is not None:
+            coalescer.close()
+
+        acknowledgements = getattr(self, 'acknowledgements', None)
+        if acknowledgements is not None:
+            acknowledgements.close()
+
+        sessions = getattr(self, 'sessions', None)
+        if sessions is not None:
+            sessions.close()
+
+        actions_executor = getattr(self, 'actions_executor', None)
+        if actions_executor is not None:
+            actions_executor.shutdown(wait=False)
+
+        journal = getattr(self, 'journal', None)
+        if journal is not None:
+            journal.close()
+
+        plugins = getattr(self, 'plugins', None)
+        if plugins is not None:
+            plugins.close()
 
-            self.topics[topic_name].append((action_name, action_data))
+    def load_config(self, config_data):
+        # A config dict (compiled here) or a `CompiledConfig`, from
+        # `compile_config` or `load_compiled_config`.
+        if isinstance(config_data, CompiledConfig):
+            compiled_config = check_artifact(config_data)
+        else:
+            compiled_config = compile_config(config_data)
+        for warning in compiled_config.warnings:
+            self.logger.warning(f'Config: {warning}')
+
+        self.compiled_config = compiled_config
+        self.config = compiled_config.config
+        self.actions = compiled_config.actions
+        self.topics = compiled_config.topics
+        self.router = compiled_config.router
+        self.compiled_actions = compiled_config.compiled_actions
+
+        # Compiled payload templates by `id`, each with its template: held
+        # here, it can't be collected and its `id` reused by another one.
+        self.payload_templates = {
+            id(compiled_action.data['payload']): (compiled_action.data['payload'], compiled_action.payload_template)
+            for compiled_action in self.compiled_actions.values() if compiled_action.payload_template is not None
+        }
+        # By action too: two actions may share a step name and URL but not
+        # its options (`fields`, `pagination`), hence not the results.
+        self.url_caches = {}
+        self.url_cache_stats = CacheStats()
+        for compiled_action in self.compiled_actions.values():
+            for step_name, url_template, options in compiled_action.accumulators:
+                step_cache = build_step_cache(options)
+                if step_cache is not None:
+                    self.url_caches[(compiled_action.name, step_name, url_template)] = step_cache
+
+        self.default_retry = parse_retry('*', None, get_retry_defaults(self.config))
+        self.circuit_breakers = CircuitBreakers(
+            **(parse_circuit_breaker(self.config.get('circuit_breaker', None)) or DEFAULT_CIRCUIT_BREAKER)
+        )
+        self.rate_limiters = RateLimiters(self.config.get('rate_limit', None))
+
+        self.coalescer = None
+        if any(compiled_action.coalesce for compiled_action in self.compiled_actions.values()):
+            self.coalescer = WriteCoalescer(self.send_coalesced_write, self.config.get('coalescing_senders', 4))
+
+        self.batch_stats = {
+            action_name: BatchStats()
+            for action_name, compiled_action in self.compiled_actions.items()
+            if compiled_action.batch
+        }
+
+        # Independent actions matched by the same message run in parallel
+        # (dependencies permitting) when this is greater than 1.
+        self.actions_concurrency = self.config.get('actions_concurrency', 1)
+        self.actions_executor = None
+        if self.actions_concurrency > 1:
+            self.actions_executor = ThreadPoolExecutor(max_workers=self.actions_concurrency)
+        self.execution_stats = ExecutionStats()
+        self.hydration_stats = HydrationStats()
+        self.metrics = build_metrics(self.config.get('metrics', None))
+
+        self.serialization = parse_serialization(self.config.get('serialization', None))
+        self.serializer = get_serializer(self.serialization['backend'])
+
+        # Which writes of each message already succeeded, so a redelivered
+        # message resumes where it failed instead of repeating them.
+        self.journal_options = parse_journal(self.config.get('journal', None))
+        self.journal = build_journal(self.journal_options)
+        self.journal_stats = JournalStats()
+        self.journal_expires_at = 0.0
+
+    def get_payload_template(self, payload_template):
+        # The actions' templates are compiled already; others (from plugins)
+        # are cached too, up to MAX_PAYLOAD_TEMPLATES.
+        cached = self.payload_templates.get(id(payload_template), None)
+        if cached is not None and cached[0] is payload_template:
+            return cached[1]
+
+        compiled_template = compile_payload_template(payload_template)
+        if len(self.payload_templates) < self.MAX_PAYLOAD_TEMPLATES:
+            self.payload_templates[id(payload_template)] = (payload_template, compiled_template)
+        return compiled_template
 
     def apply_payload_template(self, payload_template, topic, topic_groups, action, payload):
-        hydrated_payload = {}
-        for key, value in payload_template.items():
-
-            optional = False
-            if value.startswith('OPTIONAL:'):
-                optional = True
-                value = value.replace('OPTIONAL:', '')
-
+        compiled_template = self.get_payload_template(payload_template)
+        return compiled_template.render(topic, topic_groups, action, payload)
+
+    def get_url_cache_stats(self):
+        stats = {'request': self.url_cache_stats.as_dict()}
+        for (action_name, step_name, url_template), step_cache in self.url_caches.items():
+            stats['{} {} {}'.format(action_name, step_name, url_template)] = step_cache.stats.as_dict()
+        return stats
+
+    @staticmethod
+    def get_entry_body(entry):
+        if len(entry) == 1 and 'payload' in entry:
+            return entry['payload']
+        return entry
+
+    def send_request(self, method_name, url, retry=None, action_name=None, **kwargs):
+        retry = retry or self.default_retry
+        breaker = self.circuit_breakers.get(url) if retry['circuit_breaker'] else None
+        function = partial(self.request_methods[method_name], url, **kwargs)
+        if self.metrics.enabled:
+            function = partial(self.measure_request, function, action_name, method_name)
+
+        limiter = self.rate_limiters.get(url)
+        if limiter is not None:
+            function = partial(limiter.call, function)
+        return call_with_retry(function, retry, breaker)
+
+    def measure_request(self, function, action_name, method_name):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = function()
+            status = getattr(response, 'status_code', status)
+            return response
+        except Exception as ex:
+            status = get_status_code(ex=ex) or status
+            raise
+        finally:
+            self.metrics.observe(
+                'http_request_seconds', time.perf_counter() - started,
+                action=action_name or '', method=method_name, status=str(status)
+            )
+
+    def get_body_kwargs(self, body):
+        # How a write sends its body: with `encode_writes`, encoded only
+        # once (whatever the retries) by the configured serializer.
+        if not self.serialization['encode_writes']:
+            return {'json': body}
+        return {'data': self.serializer.dumps(body), 'headers': dict(JSON_HEADERS)}
+
+    def decode_response(self, response):
+        return decode_response(self.serializer, response)
+
+    def endpoint_run(self, request_method_name, url, the_entries, retry=None, action_name=None, progress=None):
+        for index, entry in enumerate(the_entries):
+            if progress is not None and progress.is_done(action_name, index):
+                continue
+            self.send_request(
+                request_method_name, url, retry, action_name, **self.get_body_kwargs(self.get_entry_body(entry))
+            )
+            if progress is not None:
+                progress.mark_done(action_name, index)
+
+    def batch_endpoint_run(self, plan):
+        # Entries go out in chunks of `max_size`, in one request each.
+        # With a journal, each batch counts as one "entry".
+        batch = plan.batch
+        bodies = (self.get_entry_body(entry) for entry in plan.entries)
+        progress = plan.progress
+        errors = []
+
+        for index, batch_bodies in enumerate(iter_batches(bodies, batch['max_size'])):
+            if progress is not None and progress.is_done(plan.action_name, index):
+                continue
+            started = time.perf_counter()
             try:
-                hydrated_payload[key] = value.format(
-                    _topic=topic,
-                    _topic_groups=topic_groups,
-                    _action=action,
-                    **payload
+                self.send_request(
+                    plan.method, plan.url, plan.retry, plan.action_name,
+                    **self.get_body_kwargs(get_batch_body(batch_bodies, batch['key']))
                 )
-            except KeyError as ex:
-                if optional:
-                    continue
-                raise ex
-
-            if hydrated_payload[key].startswith('INT:'):
-                hydrated_payload[key] = int(hydrated_payload[key].replace('INT:', ''))
-            elif hydrated_payload[key].startswith('DICT:'):
-                hydrated_payload[key] = dict(hydrated_payload[key].replace('DICT:', ''))
-            elif hydrated_payload[key].startswith('EVAL:'):
-                hydrated_payload[key] = eval(hydrated_payload[key].replace('EVAL:', ''))
-
-        return hydrated_payload
-
-    def hydrate_action(self, topic, topic_groups, action, payload):
-        action['message_topic'] = topic  # TODO: deprecate this!
-        endpoint = action.get('endpoint', None)
-        if endpoint:
-            self.hydrate_action_with_endpoint(topic, topic_groups, action, payload, endpoint)
-
-        custom_handlers = action.get('custom_handlers', None)
-        if custom_handlers:
-            self.hydrate_action_with_custom_handlers(action, topic, payload, custom_handlers)
-
-    def endpoint_run(self, request_method_name, url, the_entries):
-        request_method = self.request_methods[request_method_name]
-        for entry in the_entries:
-            if len(entry) == 1 and 'payload' in entry:
-                request_method(url, json=entry['payload'])
+            except Exception as ex:
+                self.record_batch(plan, batch_bodies, started, ex)
+                if batch['on_failure'] == 'fail':
+                    raise
+                errors.append(ex)
             else:
-                request_method(url, json=entry)
-
-    def hydrate_action_with_endpoint(self, topic, topic_groups, action, payload, endpoint):
-        url_str = os.path.join(self.config['base_url'], endpoint)
-        url = url_str.format(config=self.config, payload=payload, topic=topic)
-
-        accumulators = action.get('accumulators', [])
-        accumulation_entries = accumulate(self, payload, accumulators)
-
-        payload_template = action.get('payload', None)
-        if payload_template:
-            hydrated_entries = [
-                self.apply_payload_template(payload_template, topic, topic_groups, action, entry)
+                self.record_batch(plan, batch_bodies, started)
+                if progress is not None:
+                    progress.mark_done(plan.action_name, index)
+
+        if errors and batch['on_failure'] == 'continue':
+            raise errors[0]
+
+    def record_batch(self, plan, batch_bodies, started, error=None):
+        elapsed = time.perf_counter() - started
+        self.batch_stats[plan.action_name].record_batch(len(batch_bodies), elapsed, failed=error is not None)
+        if self.metrics.enabled:
+            self.metrics.observe('batch_seconds', elapsed, action=plan.action_name)
+            self.metrics.observe('batch_entries', len(batch_bodies), action=plan.action_name)
+
+        description = f'Action "{plan.action_name}": batch of {len(batch_bodies)} entries to {plan.url}'
+        if error is None:
+            self.logger.debug(f'{description} sent in {elapsed:.3f}s')
+        else:
+            self.logger.warning(f'{description} failed in {elapsed:.3f}s: {error.__class__.__name__}: {error}')
+
+    def coalesced_endpoint_run(self, plan):
+        futures = []
+        for index, entry in enumerate(plan.entries):
+            future = self.submit_coalesced_write(plan, index, entry)
+            if future is not None:
+                futures.append(future)
+        return futures
+
+    def submit_coalesced_write(self, plan, index, entry):
+        # None if the journal has this write done already.
+        progress = plan.progress
+        if progress is not None and progress.is_done(plan.action_name, index):
+            return None
+
+        coalesce = plan.coalesce
+        future = self.coalescer.submit(
+            plan.method, plan.url, self.get_entry_body(entry), coalesce['window'], coalesce['strategy'],
+            {'retry': plan.retry, 'action_name': plan.action_name}
+        )
+        if progress is not None:
+            future.add_done_callback(partial(self.record_write_progress, progress, plan.action_name, index))
+        return future
+
+    @staticmethod
+    def record_write_progress(progress, action_name, index, future):
+        if future.exception() is None:
+            progress.mark_done(action_name, index)
+
+    def send_coalesced_write(self, method_name, url, body, retry=None, action_name=None):
+        return self.send_request(method_name, url, retry, action_name, **self.get_body_kwargs(body))
+
+    def get_rate_limit_stats(self):
+        return self.rate_limiters.get_stats()
+
+    def get_batch_stats(self):
+        return {action_name: stats.as_dict() for action_name, stats in self.batch_stats.items()}
+
+    def get_endpoint_url(self, compiled_action, topic, payload):
+        return compiled_action.endpoint_url.render({'payload': payload, 'topic': topic})
+
+    def get_message_action(self, compiled_action, topic):
+        # What templates (as `_action`) and custom handlers get to see.
+        return {**compiled_action.data, 'message_topic': topic}  # TODO: deprecate "message_topic"!
+
+    def timed_render(self, action_name, render, *args):
+        started = time.perf_counter()
+        result = render(*args)
+        self.metrics.observe('template_render_seconds', time.perf_counter() - started, action=action_name)
+        return result
+
+    def record_fetch(self, action_name, step_name, elapsed, results_count):
+        self.metrics.observe('accumulation_request_seconds', elapsed, action=action_name, level=step_name)
+        self.metrics.increment('accumulation_results', results_count, action=action_name, level=step_name)
+
+    def get_fetch_recorder(self, compiled_action):
+        if self.metrics.enabled:
+            return partial(self.record_fetch, compiled_action.name)
+        return None
+
+    def render_entries(self, compiled_action, topic, topic_groups, action, accumulation_entries):
+        compiled_template = compiled_action.payload_template
+        if compiled_template:
+            render = compiled_template.render
+            if self.metrics.enabled:
+                render = partial(self.timed_render, compiled_action.name, render)
+            hydrated_entries = (
+                render(topic, topic_groups, action, entry)
                 for entry in accumulation_entries
                 if entry
-            ]
+            )
         else:
             hydrated_entries = accumulation_entries
 
-        data_map = action.get('data_map', {})
-        mapped_entries = [apply_data_map(entry, data_map) for entry in hydrated_entries]
+        data_mapper = compiled_action.data_mapper
+        if data_mapper.is_noop:
+            return hydrated_entries
+        return (data_mapper.apply(entry) for entry in hydrated_entries)
+
+    def build_plan(self, compiled_action, topic, topic_groups, payload, progress=None):
+        # Nothing is fetched nor rendered here: the plan's entries are
+        # hydrated as it runs.
+        self.record_built(compiled_action)
+        action = self.get_message_action(compiled_action, topic)
+
+        if compiled_action.custom_handlers:
+            # Custom handlers take precedence over the endpoint.
+            handlers = tuple(self.get_custom_handler(name) for name in compiled_action.custom_handlers)
+            return ActionPlan(
+                compiled_action.name, action, topic, topic_groups, payload, self.run_plan,
+                handlers=handlers, progress=progress
+            )
+
+        if not compiled_action.has_endpoint:
+            return ActionPlan(
+                compiled_action.name, action, topic, topic_groups, payload, self.run_plan, progress=progress
+            )
+
+        accumulation_entries = iter_accumulate(
+            self, payload, compiled_action.accumulators,
+            concurrency=compiled_action.accumulators_concurrency,
+            caches=self.url_caches,
+            cache_stats=self.url_cache_stats,
+            on_fetch=self.get_fetch_recorder(compiled_action),
+            compiled_urls=compiled_action.accumulator_urls,
+            action_name=compiled_action.name,
+        )
+        return ActionPlan(
+            compiled_action.name, action, topic, topic_groups, payload, self.run_plan,
+            url=self.get_endpoint_url(compiled_action, topic, payload),
+            method=compiled_action.method,
+            entries=LazyEntries(
+                self.render_entries(compiled_action, topic, topic_groups, action, accumulation_entries)
+            ),
+            batch=compiled_action.batch,
+            coalesce=compiled_action.coalesce,
+            retry=compiled_action.retry,
+            progress=progress,
+        )
+
+    def get_message_progress(self, message):
+        # None without a journal (or a message ID to key it with).
+        if self.journal is None:
+            return None
+        message_id = getattr(message, 'message_id', None)
+        if message_id is None:
+            return None
+
+        self.expire_journal()
+        return MessageProgress(self.journal, message_id, self.journal_stats)
+
+    def forget_message(self, message):
+        # Deleted messages don't come back: their progress is of no use.
+        if self.journal is None:
+            return
+        message_id = getattr(message, 'message_id', None)
+        if message_id is not None:
+            self.journal_stats.increment('forgotten', self.journal.forget(message_id))
+
+    def expire_journal(self, force=False):
+        now = time.monotonic()
+        if not force and now < self.journal_expires_at:
+            return 0
+        self.journal_expires_at = now + self.journal_options['expire_interval']
+
+        expired = self.journal.expire()
+        self.journal_stats.increment('expired', expired)
+        return expired
+
+    def get_journal_stats(self):
+        return self.journal_stats.as_dict()
+
+    def is_action_done(self, compiled_action, topic, progress):
+        # Whether a previous delivery of the message already ran the action.
+        if progress is None or not progress.is_done(compiled_action.name):
+            return False
+        self.logger.debug(
+            f'Action "{compiled_action.name}" already done for message {progress.message_id} ("{topic}"): skipping it'
+        )
+        return True
+
+    def record_progress(self, progress, action_name, deferred_writes=()):
+        if progress is None:
+            return
+        if deferred_writes:
+            when_all(deferred_writes, partial(self.record_deferred_progress, progress, action_name))
+        else:
+            progress.mark_done(action_name)
+
+    @staticmethod
+    def record_deferred_progress(progress, action_name, errors):
+        if not errors:
+            progress.mark_done(action_name)
+
+    def record_matched(self, count):
+        self.hydration_stats.increment('actions_matched', count)
+        if self.metrics.enabled:
+            self.metrics.increment('actions_matched', count)
+
+    def record_built(self, compiled_action):
+        self.hydration_stats.increment('actions_built')
+        if self.metrics.enabled:
+            self.metrics.increment('actions_built', action=compiled_action.name)
+
+    def record_hydration(self, plan, failed=False):
+        # After the plan ran: a failed one gives up on the entries (and
+        # GETs) it didn't get to.
+        entries = plan.entries
+        if not isinstance(entries, LazyEntries):
+            return
+
+        abandoned = failed and not entries.complete
+        if abandoned:
+            entries.close()
+        self.hydration_stats.record_plan(len(entries.hydrated), abandoned)
+        if self.metrics.enabled:
+            self.metrics.increment('entries_hydrated', len(entries.hydrated), action=plan.action_name)
+            if abandoned:
+                self.metrics.increment('plans_abandoned', action=plan.action_name)
+
+    def get_hydration_stats(self):
+        return self.hydration_stats.as_dict()
+
+    def run_plan(self, plan):
+        if plan.handlers:
+            return self.run_custom_handlers(plan.action, plan.topic, plan.payload, plan.handlers)
+        if plan.coalesce:
+            return self.coalesced_endpoint_run(plan)
+        if plan.batch:
+            return self.batch_endpoint_run(plan)
+        if plan.url is not None:
+            return self.endpoint_run(plan.method, plan.url, plan.entries, plan.retry, plan.action_name, plan.progress)
+        raise ValueError('Action "{}" has neither an endpoint nor custom handlers'.format(plan.action_name))
+
+    def get_custom_handler(self, name):
+        return self.plugins.get_handler(name)
 
-        partial_run = partial(self.endpoint_run, action.get('method').lower(), url, mapped_entries)
-        action['run'] = partial_run
+    # Deprecated: plugins are loaded by `self.plugins` (see `PluginRegistry`)
+    # when the actions need them. These still load every plugin of a path
+    # right away, as they used to.
 
     def load_custom_handlers(self, config):
+        warnings.warn('load_custom_handlers is deprecated: plugins are loaded as needed', DeprecationWarning, 2)
         for path in config.get('paths', []):
-            self.load_custom_handlers_from_path(path)
+            self.load_plugins_from_path(path)
 
     def load_custom_handlers_from_path(self, path):
-        assert os.path.isdir(path)
-
-        sys.path.append(path)
-
-        globbing_str = '{}/*/plugin.py'.format(path)
-        for filepath in glob.glob(globbing_str):
-            self.load_custom_handler(filepath)
+        warnings.warn(
+            'load_custom_handlers_from_path is deprecated: plugins are loaded as needed', DeprecationWarning, 2
+        )
+        self.load_plugins_from_path(path)
 
     def load_custom_handler(self, filepath):
-        dirname = os.path.basename(os.path.dirname(filepath))
-        module_name = '{}.plugin'.format(dirname)
-        module = importlib.import_module(module_name)
-        try:
-            the_plugin_class = getattr(module, 'Plugin')
-        except AttributeError:
-            return
+        warnings.warn('load_custom_handler is deprecated: plugins are loaded as needed', DeprecationWarning, 2)
+        self.load_plugin_file(filepath)
 
-        self.custom_handlers[dirname] = the_plugin_class(self)
+    def load_plugins_from_path(self, path):
+        assert os.path.isdir(path)
+        for filepath in glob.glob('{}/*/plugin.py'.format(path)):
+            self.load_plugin_file(filepath)
 
-    def get_custom_handler(self, name):
-        if name not in self.custom_handlers:
-            plugin_name, function_name = name.split('.')
-            plugin = self.custom_handlers[plugin_name]
-            function = getattr(plugin, function_name)
-            self.custom_handlers[name] = function
+    def load_plugin_file(self, filepath):
+        path, plugin_name = os.path.split(os.path.dirname(filepath))
+        self.plugins.add_path(path)
+        if hasattr(import_plugin_module(self.plugins.paths, plugin_name), 'Plugin'):
+            self.plugins.get_plugin(plugin_name)
 
-        return self.custom_handlers[name]
+    def record_handler(self, name, elapsed, failed=False):
+        self.plugins.record_call(name, elapsed, failed)
+        if self.metrics.enabled:
+            self.metrics.observe('custom_handler_seconds', elapsed, handler=name)
+
+    def get_handler_stats(self):
+        return self.plugins.get_stats()
 
     def run_custom_handlers(self, action, topic, payload, the_handlers):
-        for handler in the_handlers:
-            handler(action, topic, payload)
+        for name, handler in zip(action['custom_handlers'], the_handlers):
+            started = time.perf_counter()
+            failed = True
+            try:
+                handler(action, topic, payload)
+                failed = False
+            finally:
+                self.record_handler(name, time.perf_counter() - started, failed)
 
-    def hydrate_action_with_custom_handlers(self, action, topic, payload, custom_handlers_names):
-        handlers = [self.get_custom_handler(name) for name in custom_handlers_names]
-        partial_run = partial(self.run_custom_handlers, action, topic, payload, handlers)
+    def route(self, topic, payload):
+        if not self.metrics.enabled:
+            return self.router.route(topic, payload)
 
-        action['run'] = partial_run
+        with self.metrics.timer('routing_seconds'):
+            return self.router.route(topic, payload)
+
+    def get_matching_actions(self, topic, payload):
+        for topic_name, topic_groups in self.route(topic, payload):
+            for action_name, _ in self.topics[topic_name]:
+                yield self.compiled_actions[action_name], topic_groups
 
     def get_actions_for_topic(self, topic, payload):
-        for topic_name, actions in self.topics.items():
-            expanded_topic_name = topic_name.format(config=self.config, payload=payload)
+        for compiled_action, topic_groups in self.get_matching_actions(topic, payload):
+            self.record_matched(1)
+            yield compiled_action.name, self.build_plan(compiled_action, topic, topic_groups, payload)
+
+    def log_action_exception(self, ex, topic, action_name):
+        cls = ex.__class__.__name__
+        type_, value_, traceback_ = sys.exc_info()
+        formatted_traceback = traceback.format_tb(traceback_)
+        pretty_traceback = ''.join(formatted_traceback)
+
+        self.logger.error(
+            f'Exception {cls} on topic "{topic}", action "{action_name}": '
+            f'{value_}. Traceback: {pretty_traceback}'
+        )
+
+        response = getattr(ex, 'response', None)
+        if response is not None:
+            content = getattr(response, 'content', None)
+            if content is None:
+                content = getattr(response, 'text', None)
+            if content is None:
+                content = response
+            self.logger.error(' Response: {}'.format(content))
+
+    def record_action(self, action_name, elapsed, failed=False):
+        self.execution_stats.record_action(elapsed, failed)
+        if self.metrics.enabled:
+            self.metrics.observe('action_seconds', elapsed, action=action_name, result='failed' if failed else 'ok')
+
+    def record_message(self, elapsed, failed=False):
+        self.execution_stats.record_message(elapsed)
+        if self.metrics.enabled:
+            result = 'failed' if failed else 'ok'
+            self.metrics.observe('message_seconds', elapsed, result=result)
+            self.metrics.increment('messages', result=result)
+
+    def execute_action(self, compiled_action, topic, topic_groups, payload, progress=None):
+        if self.is_action_done(compiled_action, topic, progress):
+            return None
+
+        started = time.perf_counter()
+        failed = True
+        plan = self.build_plan(compiled_action, topic, topic_groups, payload, progress)
+        try:
+            deferred_writes = plan.run()
+            failed = False
+            self.record_progress(progress, compiled_action.name, deferred_writes)
+            return deferred_writes
+        finally:
+            self.record_hydration(plan, failed)
+            self.record_action(compiled_action.name, time.perf_counter() - started, failed)
+
+    def run_actions_serially(self, topic, payload, matched_actions, deferred_writes, progress=None):
+        for compiled_action, topic_groups in ActionScheduler(matched_actions).ordered():
+            if self.is_action_done(compiled_action, topic, progress):
+                continue
+            started = time.perf_counter()
+            plan = self.build_plan(compiled_action, topic, topic_groups, payload, progress)
+            try:
+                action_writes = plan.run() or ()
+                deferred_writes.extend(action_writes)
+            except Exception as ex:
+                self.record_hydration(plan, failed=True)
+                self.record_action(compiled_action.name, time.perf_counter() - started, failed=True)
+                if getattr(plan.entries, 'error', None) is ex:
+                    # Bad templates or accumulations raise, as they did
+                    # when plans were hydrated before running.
+                    raise
+                self.log_action_exception(ex, topic, compiled_action.name)
+                return [ex]
+            self.record_hydration(plan)
+            self.record_action(compiled_action.name, time.perf_counter() - started)
+            self.record_progress(progress, compiled_action.name, action_writes)
+
+        return []
+
+    def run_actions_concurrently(self, topic, payload, matched_actions, deferred_writes, progress=None):
+        # Once an action fails, nothing new is started, but the ones
+        # already running are waited for.
+        scheduler = ActionScheduler(matched_actions)
+        running = {}
+        errors = []
+
+        while True:
+            if not errors:
+                for compiled_action, topic_groups in scheduler.ready():
+                    future = self.actions_executor.submit(
+                        self.execute_action, compiled_action, topic, topic_groups, payload, progress
+                    )
+                    running[future] = compiled_action.name
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                action_name = running.pop(future)
+                try:
+                    deferred_writes.extend(future.result() or ())
+                except Exception as ex:
+                    self.log_action_exception(ex, topic, action_name)
+                    errors.append(ex)
+                else:
+                    scheduler.succeed(action_name)
 
-            match = re.match(expanded_topic_name, topic)
-            if match:
-                topic_groups = match.groupdict()
-                for action_name, action_data in actions:
-                    self.hydrate_action(topic, topic_groups, action_data, payload)
-                    yield (action_name, action_data)
+        return errors
 
     def do_handle_message(self, message, topic, payload):
-        treated_messages = 0
-        for action_name, action_data in self.get_actions_for_topic(topic, payload):
-            try:
-                action_data['run']()
-            except Exception as ex:
-                cls = ex.__class__.__name__
-                type_, value_, traceback_ = sys.exc_info()
-                formatted_traceback = traceback.format_tb(traceback_)
-                pretty_traceback = ''.join(formatted_traceback)
-
-                self.logger.error(
-                    f'Exception {cls} on topic "{topic}", action "{action_name}": '
-                    f'{value_}. Traceback: {pretty_traceback}'
-                )
+        started = time.perf_counter()
+        matched_actions = list(self.get_matching_actions(topic, payload))
+        self.record_matched(len(matched_actions))
+        progress = self.get_message_progress(message)
+        deferred_writes = []
+
+        if self.actions_concurrency > 1 and len(matched_actions) > 1:
+            errors = self.run_actions_concurrently(topic, payload, matched_actions, deferred_writes, progress)
+        else:
+            errors = self.run_actions_serially(topic, payload, matched_actions, deferred_writes, progress)
+        self.record_message(time.perf_counter() - started, failed=bool(errors))
 
-                response = getattr(ex, 'response', None)
-                if response is not None:
-                    content = getattr(response, 'content', None)
-                    if content is None:
-                        content = getattr(response, 'text', None)
-                    if content is None:
-                        content = response
-                    self.logger.error(' Response: {}'.format(content))
-                break
+        if errors:
+            self.postpone_message(message, errors)
+            return 0
+
+        self.acknowledge_message(message, topic, deferred_writes)
+        return 1
+
+    def postpone_message(self, message, errors):
+        # While a circuit is open, the message comes back once it may be
+        # closed again instead of after the whole visibility timeout.
+        delays = [ex.retry_in for ex in errors if isinstance(ex, CircuitOpenError)]
+        if not delays:
+            return
+
+        visibility_timeout = int(math.ceil(max(delays)))
+        try:
+            message.change_visibility(VisibilityTimeout=visibility_timeout)
+        except Exception as ex:
+            self.logger.warning(f'Could not change the message visibility: {ex.__class__.__name__}: {ex}')
+
+    def delete_messages_batch(self, entries):
+        return self.queue.delete_messages(Entries=entries)
+
+    def delete_message(self, message):
+        if self.acknowledgements is not None:
+            self.acknowledgements.add(message)
         else:
-            treated_messages += 1
             message.delete()
+            self.forget_message(message)
 
-        return treated_messages
+    def acknowledge_message(self, message, topic, deferred_writes=()):
+        if not deferred_writes:
+            self.delete_message(message)
+            return
 
-    def parse_and_handle_message(self, message):
-        payload = json.loads(message.body)
+        # Only once the coalesced writes that absorbed this message's ones
+        # were sent.
+        when_all(deferred_writes, partial(self.acknowledge_after_writes, message, topic))
+
+    def acknowledge_after_writes(self, message, topic, errors):
+        if errors:
+            ex = errors[0]
+            self.logger.error(
+                f'Coalesced write for topic "{topic}" failed ({ex.__class__.__name__}: {ex}): '
+                'leaving the message in the queue'
+            )
+            return
+        self.delete_message(message)
+
+    def parse_message(self, message):
+        payload = self.serializer.loads(message.body)
 
         attributes = message.message_attributes
         topic = attributes['topic']['StringValue']
 
+        return topic, payload
+
+    def parse_and_handle_message(self, message):
+        topic, payload = self.parse_message(message)
         return self.do_handle_message(message, topic, payload)
 
     def handle_message(self, message):
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+
+from .instrumentation import Stats
+
+
+MAX_BATCH_SIZE = 10  # SQS DeleteMessageBatch limit.
+
+
+class AcknowledgementStats(Stats):
+    COUNTERS = ('messages', 'batches', 'retried', 'failed')
+
+
+class AcknowledgementBuffer:
+    # Collects handled messages and deletes them with `delete_batch`
+    # (`Queue.delete_messages`, that is, DeleteMessageBatch) once there are
+    # `batch_size` of them, `max_delay` seconds after the oldest one
+    # arrived, or on `close`. Entries the batch couldn't delete are
+    # retried one by one with `message.delete()`. `on_deleted` is called
+    # with each message actually deleted.
+
+    def __init__(self, delete_batch, batch_size=MAX_BATCH_SIZE, max_delay=1.0, logger=None, on_deleted=None):
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            raise ValueError('batch_size must be between 1 and {}'.format(MAX_BATCH_SIZE))
+
+        self.delete_batch = delete_batch
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self.on_deleted = on_deleted
+
+        self.messages = []
+        self.deadline = None
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.stats = AcknowledgementStats()
+
+    def add(self, message):
+        batch = None
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('AcknowledgementBuffer is closed')
+
+            self.messages.append(message)
+            self.stats.increment('messages')
+            if len(self.messages) >= self.batch_size:
+                batch = self.take()
+            elif self.deadline is None:
+                self.deadline = time.monotonic() + self.max_delay
+                self.start()
+                self.condition.notify()
+
+        if batch:
+            self.delete(batch)
+
+    def take(self):
+        batch, self.messages = self.messages[:self.batch_size], self.messages[self.batch_size:]
+        self.deadline = time.monotonic() + self.max_delay if self.messages else None
+        return batch
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (self.deadline is None or self.deadline > time.monotonic()):
+                    timeout = None if self.deadline is None else self.deadline - time.monotonic()
+                    self.condition.wait(timeout)
+                if self.closed:
+                    return
+                batch = self.take()
+
+            if batch:
+                self.delete(batch)
+
+    def delete(self, batch):
+        entries = [
+            {'Id': str(index), 'ReceiptHandle': message.receipt_handle}
+            for index, message in enumerate(batch)
+        ]
+        self.stats.increment('batches')
+
+        try:
+            response = self.delete_batch(entries)
+        except Exception as ex:
+            self.logger.warning('DeleteMessageBatch failed ({}: {}): retrying one by one'.format(
+                ex.__class__.__name__, ex
+            ))
+            failed = batch
+        else:
+            failed = [batch[int(entry['Id'])] for entry in response.get('Failed', [])]
+
+        undeleted = []
+        for message in failed:
+            self.stats.increment('retried')
+            try:
+                message.delete()
+            except Exception as ex:
+                self.stats.increment('failed')
+                self.logger.error('Could not delete message {} ({}: {})'.format(
+                    getattr(message, 'message_id', None), ex.__class__.__name__, ex
+                ))
+                undeleted.append(message)
+
+        if self.on_deleted is not None:
+            for message in batch:
+                if not any(message is other for other in undeleted):
+                    self.on_deleted(message)
+
+    def flush(self):
+        while True:
+            with self.condition:
+                batch = self.take()
+            if not batch:
+                return
+            self.delete(batch)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.flush()
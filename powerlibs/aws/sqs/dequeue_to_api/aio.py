@@ -0,0 +1,720 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from itertools import repeat
+import asyncio
+import json
+import threading
+import time
+
+import requests
+from requests.utils import parse_header_links
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from . import DequeueToAPI
+from .batching import get_batch_body
+from .cache import CacheStats
+from .plans import ActionPlan, LazyEntries
+from .retries import get_delay, is_retryable
+from .scheduling import ActionScheduler
+from .serialization import project_fields
+from .throttling import get_status_code
+from .transformations import (
+    CACHED_MAX_PAGES, DEFAULT_PAGINATION, expand_entry, get_next_page_url, get_url_renderer, parse_accumulator
+)
+
+
+class AsyncResponse:
+    # Just enough of `requests.Response` for the rest of the library (and
+    # its plugins) to handle aiohttp responses the same way.
+
+    def __init__(self, method, url, status_code, reason, headers, content):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    @property
+    def links(self):
+        links = {}
+        header = self.headers.get('link', None)
+        if header:
+            for link in parse_header_links(header):
+                links[link.get('rel') or link.get('url')] = link
+        return links
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise requests.HTTPError(
+                '{} Error: {} for url: {}'.format(self.status_code, self.reason, self.url),
+                response=self
+            )
+
+
+async def get_page(dequeuer, url, pagination, fields=None):
+    response = await dequeuer.async_send_request('get', url)
+    response_data = dequeuer.decode_response(response)
+
+    results_field = pagination['results_field']
+    if not isinstance(response_data, dict) or results_field not in response_data:
+        return project_fields([response_data], fields), None
+    next_url = get_next_page_url(url, response, response_data, pagination)
+    return project_fields(response_data[results_field], fields), next_url
+
+
+async def iter_url_pages(dequeuer, url, pagination=None, fields=None, page_getter=get_page):
+    pagination = {**DEFAULT_PAGINATION, **(pagination or {})}
+    max_pages = pagination['max_pages']
+    pages = 0
+
+    while url:
+        results, url = await page_getter(dequeuer, url, pagination, fields)
+        pages += 1
+        yield results
+
+        if max_pages and pages >= max_pages:
+            return
+
+
+async def iter_url_results(dequeuer, url, pagination=None):
+    async for page in iter_url_pages(dequeuer, url, pagination):
+        for result in page:
+            yield result
+
+
+async def url_get(dequeuer, url, pagination=None, fields=None):
+    return [result async for page in iter_url_pages(dequeuer, url, pagination, fields) for result in page]
+
+
+async def chain_pages(results, pages):
+    try:
+        for result in results:
+            yield result
+        async for page in pages:
+            for result in page:
+                yield result
+    finally:
+        await aclose(pages)
+
+
+async def aclose(iterator):
+    # Async generators (and the like) left half-way aren't closed by `async
+    # for`: this gives up on what they were fetching right away.
+    close = getattr(iterator, 'aclose', None)
+    if close is not None:
+        await close()
+
+
+class AsyncRequestCache:
+    # Same as `cache.RequestCache`, for coroutines running on one loop.
+
+    def __init__(self, stats=None, maxsize=256):
+        self.stats = stats or CacheStats()
+        self.maxsize = maxsize
+        self.futures = OrderedDict()
+
+    async def get(self, url, fetch):
+        future = self.futures.get(url, None)
+        if future is not None:
+            self.futures.move_to_end(url)
+            self.stats.increment('hits' if future.done() else 'coalesced')
+            return await asyncio.shield(future)
+
+        self.stats.increment('misses')
+        future = asyncio.ensure_future(fetch(url))
+        self.futures[url] = future
+        try:
+            result = await asyncio.shield(future)
+        except BaseException:
+            self.futures.pop(url, None)
+            raise
+        self.evict()
+        return result
+
+    def evict(self):
+        for url in list(self.futures):
+            if len(self.futures) <= self.maxsize:
+                break
+            if self.futures[url].done():
+                del self.futures[url]
+                self.stats.increment('evictions')
+
+
+def get_cached_url_getter(url_getter, request_cache, step_cache):
+    async def fetch(dequeuer, url):
+        if step_cache is not None:
+            results = step_cache.get(url, None)
+            if results is None:
+                results = await url_getter(dequeuer, url)
+                step_cache.set(url, results)
+            return results
+        return await url_getter(dequeuer, url)
+
+    async def cached_url_getter(dequeuer, url):
+        return await request_cache.get(url, lambda url: fetch(dequeuer, url))
+
+    return cached_url_getter
+
+
+def get_cached_page_getter(request_cache, step_name=None, on_fetch=None):
+    async def fetch_page(dequeuer, url, pagination, fields):
+        started = time.perf_counter()
+        page = await get_page(dequeuer, url, pagination, fields)
+        if on_fetch is not None:
+            on_fetch(step_name, time.perf_counter() - started, len(page[0]))
+        return page
+
+    async def cached_page_getter(dequeuer, url, pagination, fields):
+        return await request_cache.get(url, lambda url: fetch_page(dequeuer, url, pagination, fields))
+
+    return cached_page_getter
+
+
+def get_url_streamer(page_getter, pagination=None, fields=None, step_cache=None, max_cached_pages=CACHED_MAX_PAGES):
+    # As `transformations.get_url_streamer`: the results left to fetch come
+    # as an async iterator.
+    async def stream(dequeuer, url):
+        if step_cache is not None:
+            results = step_cache.get(url, None)
+            if results is not None:
+                return results
+
+        pages = iter_url_pages(dequeuer, url, pagination, fields, page_getter)
+        results = []
+        # The first page, or up to `max_cached_pages` and one more (to know
+        # if there's any left).
+        for _ in range(1 if step_cache is None else max_cached_pages + 1):
+            try:
+                results.extend(await pages.__anext__())
+            except StopAsyncIteration:
+                if step_cache is not None:
+                    step_cache.set(url, results)
+                return results
+        return chain_pages(results, pages)
+
+    return stream
+
+
+def get_timed_url_getter(url_getter, step_name, on_fetch):
+    async def timed_url_getter(dequeuer, url):
+        started = time.perf_counter()
+        results = await url_getter(dequeuer, url)
+        on_fetch(step_name, time.perf_counter() - started, len(results))
+        return results
+
+    return timed_url_getter
+
+
+async def expand_results(step_name, entry, results):
+    # `results`: a list or, for streamed ones, an async iterator.
+    if not hasattr(results, '__aiter__'):
+        for new_entry in expand_entry(step_name, entry, results):
+            yield new_entry
+        return
+
+    try:
+        async for result in results:
+            for new_entry in expand_entry(step_name, entry, (result,)):
+                yield new_entry
+    finally:
+        await aclose(results)
+
+
+async def iter_level(dequeuer, entries, step_name, url_template, url_getter, concurrency=1, compiled_url=None):
+    render_url = get_url_renderer(dequeuer, url_template, compiled_url)
+
+    async def fetch(entry):
+        return await url_getter(dequeuer, render_url(entry))
+
+    in_flight = deque()
+    try:
+        async for entry in entries:
+            in_flight.append((entry, asyncio.ensure_future(fetch(entry))))
+            if len(in_flight) >= concurrency:
+                entry, task = in_flight.popleft()
+                async for new_entry in expand_results(step_name, entry, await task):
+                    yield new_entry
+
+        while in_flight:
+            entry, task = in_flight.popleft()
+            async for new_entry in expand_results(step_name, entry, await task):
+                yield new_entry
+    finally:
+        for _, task in in_flight:
+            task.cancel()
+        await aclose(entries)  # Closing a level closes the ones before it too.
+
+
+async def iter_payload(payload):
+    yield {'payload': payload}
+
+
+def iter_accumulate(dequeuer, payload, accumulators, url_getter=None, concurrency=1, caches=None, cache_stats=None,
+                    on_fetch=None, compiled_urls=None, action_name=None):
+    entries = iter_payload(payload)
+    caches = caches or {}
+    request_cache = AsyncRequestCache(cache_stats)
+    compiled_urls = compiled_urls or repeat(None)
+
+    for accumulator, compiled_url in zip(accumulators, compiled_urls):
+        step_name, url_template, options = parse_accumulator(accumulator)
+        step_cache = caches.get((action_name, step_name, url_template), None)
+        if url_getter is None:
+            step_url_getter = get_url_streamer(
+                get_cached_page_getter(request_cache, step_name, on_fetch),
+                options.get('pagination', None), options.get('fields', None), step_cache,
+                (options.get('cache', None) or {}).get('max_pages', CACHED_MAX_PAGES)
+            )
+        else:
+            step_url_getter = get_cached_url_getter(url_getter, request_cache, step_cache)
+            if on_fetch is not None:
+                step_url_getter = get_timed_url_getter(step_url_getter, step_name, on_fetch)
+
+        entries = iter_level(
+            dequeuer, entries, step_name, url_template, step_url_getter, max(concurrency, 1), compiled_url
+        )
+
+    return entries
+
+
+async def accumulate(dequeuer, payload, accumulators, url_getter=None, concurrency=1, caches=None, cache_stats=None,
+                     on_fetch=None, compiled_urls=None, action_name=None):
+    entries = iter_accumulate(
+        dequeuer, payload, accumulators, url_getter, concurrency, caches, cache_stats, on_fetch, compiled_urls,
+        action_name
+    )
+    return [entry async for entry in entries]
+
+
+class AsyncLazyEntries(LazyEntries):
+    # `LazyEntries` from an async iterator (`iter_accumulate`, rendered):
+    # iterated with `async for` (synchronously too once complete). `close`
+    # can't wait for the source to close, so it's `aclose` that does.
+    __slots__ = ('abandoned',)
+
+    def __init__(self, source):
+        self.source = source
+        self.hydrated = []
+        self.error = None
+        self.abandoned = None  # The source given up on by `close`.
+
+    def __iter__(self):
+        if not self.complete:
+            raise TypeError('Entries not hydrated yet: iterate them with "async for"')
+        return super().__iter__()
+
+    async def __aiter__(self):
+        index = 0
+        while True:
+            if index < len(self.hydrated):
+                yield self.hydrated[index]
+                index += 1
+                continue
+            if self.source is None:
+                return
+            try:
+                entry = await self.source.__anext__()
+            except StopAsyncIteration:
+                self.source = None
+                return
+            except Exception as ex:
+                self.error = ex
+                raise
+            self.hydrated.append(entry)
+
+    def close(self):
+        if self.source is not None:
+            self.abandoned, self.source = self.source, None
+
+    async def aclose(self):
+        self.close()
+        source, self.abandoned = self.abandoned, None
+        if source is not None:
+            await aclose(source)
+
+
+async def iter_rendered_entries(dequeuer, compiled_action, topic, topic_groups, action, accumulation_entries):
+    # `DequeueToAPI.render_entries`, entry by entry as they're accumulated.
+    try:
+        async for entry in accumulation_entries:
+            for rendered_entry in dequeuer.render_entries(compiled_action, topic, topic_groups, action, (entry,)):
+                yield rendered_entry
+    finally:
+        await aclose(accumulation_entries)
+
+
+async def enumerate_entries(entries):
+    # `enumerate` for a plan's entries, `AsyncLazyEntries` or any iterable.
+    index = 0
+    if hasattr(entries, '__aiter__'):
+        async for entry in entries:
+            yield index, entry
+            index += 1
+    else:
+        for entry in entries:
+            yield index, entry
+            index += 1
+
+
+async def iter_batches(bodies, max_size):
+    # `batching.iter_batches`, for an async iterator.
+    batch = []
+    async for body in bodies:
+        batch.append(body)
+        if len(batch) >= max_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def async_call_with_retry(coroutine_function, retry, breaker=None):
+    # Same as `retries.call_with_retry`, sleeping without blocking the loop.
+    attempt = 0
+    while True:
+        attempt += 1
+        if breaker is not None:
+            breaker.before_request()
+
+        try:
+            result = await coroutine_function()
+        except Exception as ex:
+            retryable = is_retryable(ex, retry)
+            if breaker is not None:
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            if not retryable or attempt >= retry['max_attempts']:
+                raise
+            await asyncio.sleep(get_delay(attempt, ex, retry))
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+
+class AsyncDequeueToAPI(DequeueToAPI):
+    # Runs every message as a coroutine on a single event loop (in its own
+    # thread), with up to `config['async']['max_in_flight']` messages being
+    # handled at the same time. HTTP goes through aiohttp when it's
+    # installed; otherwise (and for blocking work such as sync plugins and
+    # message deletion) through a thread pool.
+
+    def __init__(self, config_data, queue_name, *args, **kwargs):
+        super().__init__(config_data, queue_name, *args, **kwargs)
+
+        async_config = self.config.get('async', {})
+        self.max_in_flight = async_config.get('max_in_flight', 1000)
+        self.use_aiohttp = async_config.get('aiohttp', aiohttp is not None)
+        self.executor = ThreadPoolExecutor(max_workers=async_config.get('executor_threads', 16))
+        self.in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self.pending_futures = set()
+
+        self.loop = None
+        self.loop_thread = None
+        self.loop_lock = threading.Lock()
+        self.client_sessions = {}
+
+    def get_loop(self):
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self.loop_thread.start()
+        return self.loop
+
+    def drain(self, timeout=None):
+        started = time.monotonic()
+        if not super().drain(timeout):
+            return False
+
+        remaining = None if timeout is None else max(timeout - (time.monotonic() - started), 0)
+        _, not_done = wait(list(self.pending_futures), timeout=remaining)
+        return not not_done
+
+    def shutdown(self):
+        super().shutdown()
+
+        loop = getattr(self, 'loop', None)
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.close_client_sessions(), loop).result(timeout=10)
+            loop.call_soon_threadsafe(loop.stop)
+            self.loop_thread.join(timeout=10)
+
+        executor = getattr(self, 'executor', None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    async def run_in_executor(self, function, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(function, *args))
+
+    # HTTP
+    async def get_client_session(self):
+        loop = asyncio.get_event_loop()
+        session = self.client_sessions.get(loop, None)
+        if session is None or session.closed:
+            http_config = self.config.get('http', {})
+            timeout = http_config.get('timeout', None)
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=http_config.get('pool_maxsize', 100),
+                    force_close=not http_config.get('keep_alive', True),
+                ),
+                headers=self.requests_headers,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            )
+            self.client_sessions[loop] = session
+        return session
+
+    async def close_client_sessions(self):
+        loop = asyncio.get_event_loop()
+        session = self.client_sessions.pop(loop, None)
+        if session is not None:
+            await session.close()
+
+    async def async_request(self, method_name, url, **kwargs):
+        if not self.use_aiohttp or self.sessions is None:
+            # Blocking requests (including injected `requests` modules).
+            return await self.run_in_executor(partial(self.request_methods[method_name], url, **kwargs))
+
+        session = await self.get_client_session()
+        async with session.request(method_name.upper(), url, **kwargs) as response:
+            content = await response.read()
+            wrapped = AsyncResponse(
+                method_name, str(response.url), response.status, response.reason, response.headers, content
+            )
+        return self.check_response(method_name, wrapped, (url,), kwargs)
+
+    async def async_send_request(self, method_name, url, retry=None, action_name=None, **kwargs):
+        retry = retry or self.default_retry
+        breaker = self.circuit_breakers.get(url) if retry['circuit_breaker'] else None
+        coroutine_function = partial(self.async_request, method_name, url, **kwargs)
+        if self.metrics.enabled:
+            coroutine_function = partial(self.async_measure_request, coroutine_function, action_name, method_name)
+
+        limiter = self.rate_limiters.get(url)
+        if limiter is not None:
+            coroutine_function = partial(limiter.async_call, coroutine_function)
+        return await async_call_with_retry(coroutine_function, retry, breaker)
+
+    async def async_measure_request(self, coroutine_function, action_name, method_name):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = await coroutine_function()
+            status = getattr(response, 'status_code', status)
+            return response
+        except Exception as ex:
+            status = get_status_code(ex=ex) or status
+            raise
+        finally:
+            self.metrics.observe(
+                'http_request_seconds', time.perf_counter() - started,
+                action=action_name or '', method=method_name, status=str(status)
+            )
+
+    # Actions
+    async def async_endpoint_run(self, request_method_name, url, the_entries, retry=None, action_name=None,
+                                 progress=None):
+        async for index, entry in enumerate_entries(the_entries):
+            if progress is not None and progress.is_done(action_name, index):
+                continue
+            await self.async_send_request(
+                request_method_name, url, retry, action_name, **self.get_body_kwargs(self.get_entry_body(entry))
+            )
+            if progress is not None:
+                progress.mark_done(action_name, index)
+
+    async def async_batch_endpoint_run(self, plan):
+        batch = plan.batch
+        bodies = (self.get_entry_body(entry) async for _, entry in enumerate_entries(plan.entries))
+        progress = plan.progress
+        errors = []
+
+        async for index, batch_bodies in enumerate_entries(iter_batches(bodies, batch['max_size'])):
+            if progress is not None and progress.is_done(plan.action_name, index):
+                continue
+            started = time.perf_counter()
+            try:
+                await self.async_send_request(
+                    plan.method, plan.url, plan.retry, plan.action_name,
+                    **self.get_body_kwargs(get_batch_body(batch_bodies, batch['key']))
+                )
+            except Exception as ex:
+                self.record_batch(plan, batch_bodies, started, ex)
+                if batch['on_failure'] == 'fail':
+                    raise
+                errors.append(ex)
+            else:
+                self.record_batch(plan, batch_bodies, started)
+                if progress is not None:
+                    progress.mark_done(plan.action_name, index)
+
+        if errors and batch['on_failure'] == 'continue':
+            raise errors[0]
+
+    async def async_coalesced_endpoint_run(self, plan):
+        futures = []
+        async for index, entry in enumerate_entries(plan.entries):
+            future = self.submit_coalesced_write(plan, index, entry)
+            if future is not None:
+                futures.append(future)
+        return futures
+
+    async def async_run_custom_handler(self, handler, action, topic, payload):
+        if asyncio.iscoroutinefunction(handler):
+            await handler(action, topic, payload)
+        else:
+            await self.run_in_executor(handler, action, topic, payload)
+
+    async def async_run_custom_handlers(self, action, topic, payload, the_handlers):
+        for name, handler in zip(action['custom_handlers'], the_handlers):
+            started = time.perf_counter()
+            failed = True
+            try:
+                await self.async_run_custom_handler(handler, action, topic, payload)
+                failed = False
+            finally:
+                self.record_handler(name, time.perf_counter() - started, failed)
+
+    async def async_build_plan(self, compiled_action, topic, topic_groups, payload, progress=None):
+        # Same plan as `build_plan`, with its entries accumulated (GETs
+        # awaited, not blocking the loop) and rendered as they're sent.
+        if compiled_action.custom_handlers or not compiled_action.has_endpoint:
+            return self.build_plan(compiled_action, topic, topic_groups, payload, progress)
+
+        self.record_built(compiled_action)
+        action = self.get_message_action(compiled_action, topic)
+        accumulation_entries = iter_accumulate(
+            self, payload, compiled_action.accumulators,
+            concurrency=compiled_action.accumulators_concurrency,
+            caches=self.url_caches,
+            cache_stats=self.url_cache_stats,
+            on_fetch=self.get_fetch_recorder(compiled_action),
+            compiled_urls=compiled_action.accumulator_urls,
+            action_name=compiled_action.name,
+        )
+        return ActionPlan(
+            compiled_action.name, action, topic, topic_groups, payload, self.run_plan,
+            url=self.get_endpoint_url(compiled_action, topic, payload),
+            method=compiled_action.method,
+            entries=AsyncLazyEntries(
+                iter_rendered_entries(self, compiled_action, topic, topic_groups, action, accumulation_entries)
+            ),
+            batch=compiled_action.batch,
+            coalesce=compiled_action.coalesce,
+            retry=compiled_action.retry,
+            progress=progress,
+        )
+
+    async def run_plan(self, plan):
+        if plan.handlers:
+            return await self.async_run_custom_handlers(plan.action, plan.topic, plan.payload, plan.handlers)
+        if plan.coalesce:
+            return await self.async_coalesced_endpoint_run(plan)
+        if plan.batch:
+            return await self.async_batch_endpoint_run(plan)
+        if plan.url is not None:
+            return await self.async_endpoint_run(
+                plan.method, plan.url, plan.entries, plan.retry, plan.action_name, plan.progress
+            )
+        raise ValueError('Action "{}" has neither an endpoint nor custom handlers'.format(plan.action_name))
+
+    async def async_execute_action(self, compiled_action, topic, topic_groups, payload, progress=None):
+        if self.is_action_done(compiled_action, topic, progress):
+            return None
+
+        started = time.perf_counter()
+        failed = True
+        plan = None
+        try:
+            plan = await self.async_build_plan(compiled_action, topic, topic_groups, payload, progress)
+            deferred_writes = await plan.run()
+            failed = False
+            self.record_progress(progress, compiled_action.name, deferred_writes)
+            return deferred_writes
+        finally:
+            if plan is not None:
+                self.record_hydration(plan, failed)
+                if isinstance(plan.entries, AsyncLazyEntries):
+                    await plan.entries.aclose()  # Closes what a failed plan gave up on.
+            self.record_action(compiled_action.name, time.perf_counter() - started, failed)
+
+    async def async_do_handle_message(self, message, topic, payload):
+        # Same scheduling as `run_actions_concurrently`, with at most
+        # `actions_concurrency` actions of the message running at once.
+        started = time.perf_counter()
+        matched_actions = list(self.get_matching_actions(topic, payload))
+        self.record_matched(len(matched_actions))
+        progress = self.get_message_progress(message)
+        scheduler = ActionScheduler(matched_actions)
+        running = {}
+        errors = []
+        deferred_writes = []
+
+        while True:
+            if not errors:
+                for compiled_action, topic_groups in scheduler.ready(self.actions_concurrency - len(running)):
+                    task = asyncio.ensure_future(
+                        self.async_execute_action(compiled_action, topic, topic_groups, payload, progress)
+                    )
+                    running[task] = compiled_action.name
+            if not running:
+                break
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                action_name = running.pop(task)
+                try:
+                    deferred_writes.extend(task.result() or ())
+                except Exception as ex:
+                    self.log_action_exception(ex, topic, action_name)
+                    errors.append(ex)
+                else:
+                    scheduler.succeed(action_name)
+
+        self.record_message(time.perf_counter() - started, failed=bool(errors))
+        if errors:
+            await self.run_in_executor(self.postpone_message, message, errors)
+            return 0
+
+        await self.run_in_executor(self.acknowledge_message, message, topic, deferred_writes)
+        return 1
+
+    async def async_parse_and_handle_message(self, message):
+        topic, payload = self.parse_message(message)
+        return await self.async_do_handle_message(message, topic, payload)
+
+    def log_message_exception(self, future):
+        if future.cancelled():
+            return
+
+        ex = future.exception()
+        if ex is not None:
+            self.logger.error('Exception {}: {}'.format(ex.__class__.__name__, ex))
+
+    def handle_message(self, message):
+        # Blocks while `max_in_flight` messages are being handled, so the
+        # dequeuing loop doesn't fetch more than the event loop can take.
+        self.in_flight.acquire()
+        future = asyncio.run_coroutine_threadsafe(self.async_parse_and_handle_message(message), self.get_loop())
+        self.pending_futures.add(future)
+        future.add_done_callback(self.pending_futures.discard)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        future.add_done_callback(self.log_message_exception)
+        return future
@@ -0,0 +1,71 @@
+from .instrumentation import Stats
+
+
+ON_FAILURE_POLICIES = (
+    'fail',  # Stop at the first failed batch: the action fails.
+    'continue',  # Send every batch anyway, then fail with the first error.
+    'ignore',  # Log failed batches and carry on: the action succeeds.
+)
+
+DEFAULT_BATCH = {
+    'max_size': 100,
+    'key': None,  # None: the body is a JSON array; else {key: [...]}.
+    'on_failure': 'fail',
+}
+
+
+def parse_batch(action_name, batch):
+    # `"batch": true` or `"batch": {"max_size": 50, "key": "items", ...}`
+    if not batch:
+        return None
+    if batch is True:
+        batch = {}
+
+    batch = {**DEFAULT_BATCH, **batch}
+    if not isinstance(batch['max_size'], int) or batch['max_size'] < 1:
+        raise ValueError('Action "{}": batch max_size must be a positive integer'.format(action_name))
+    if batch['on_failure'] not in ON_FAILURE_POLICIES:
+        raise ValueError('Action "{}": batch on_failure must be one of {}'.format(
+            action_name, ', '.join(ON_FAILURE_POLICIES)
+        ))
+    return batch
+
+
+def iter_batches(bodies, max_size):
+    batch = []
+    for body in bodies:
+        batch.append(body)
+        if len(batch) >= max_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_batch_body(bodies, key=None):
+    if key is None:
+        return bodies
+    return {key: bodies}
+
+
+class BatchStats(Stats):
+    COUNTERS = ('batches', 'entries', 'failed_batches', 'failed_entries', 'time', 'max_time', 'max_entries')
+
+    def record_batch(self, entries_count, elapsed, failed=False):
+        with self.lock:
+            counters = self.counters
+            counters['batches'] += 1
+            counters['entries'] += entries_count
+            counters['time'] += elapsed
+            counters['max_time'] = max(counters['max_time'], elapsed)
+            counters['max_entries'] = max(counters['max_entries'], entries_count)
+            if failed:
+                counters['failed_batches'] += 1
+                counters['failed_entries'] += entries_count
+
+    def as_dict(self):
+        stats = super().as_dict()
+        batches = stats['batches']
+        stats['mean_time'] = stats['time'] / batches if batches else 0.0
+        stats['mean_entries'] = stats['entries'] / batches if batches else 0.0
+        return stats
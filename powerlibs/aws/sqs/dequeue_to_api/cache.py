@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+
+from .instrumentation import Stats
+
+
+class CacheStats(Stats):
+    COUNTERS = ('hits', 'misses', 'evictions', 'expirations', 'coalesced')
+
+
+class TTLCache:
+    # Cross-message cache: LRU bounded by `maxsize`, entries expiring after
+    # `ttl` seconds.
+
+    def __init__(self, maxsize=1024, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.entries.get(key, None)
+            if item is None:
+                self.stats.increment('misses')
+                return default
+
+            expires_at, value = item
+            if expires_at <= self.clock():
+                del self.entries[key]
+                self.stats.increment('expirations')
+                self.stats.increment('misses')
+                return default
+
+            self.entries.move_to_end(key)
+            self.stats.increment('hits')
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats.increment('evictions')
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RequestCache:
+    # Message-scoped deduplication: every URL is fetched only once, even
+    # if other threads ask for it while the first request is in flight.
+    # Only the `maxsize` most recent results are kept, so that streamed
+    # accumulations don't end up holding every response in memory.
+
+    def __init__(self, stats=None, maxsize=256):
+        self.stats = stats or CacheStats()
+        self.maxsize = maxsize
+        self.futures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, url, fetch):
+        with self.lock:
+            future = self.futures.get(url, None)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.futures[url] = future
+            else:
+                self.futures.move_to_end(url)
+
+        if not is_owner:
+            if future.done():
+                self.stats.increment('hits')
+            else:
+                self.stats.increment('coalesced')
+            return future.result()
+
+        self.stats.increment('misses')
+        try:
+            result = fetch(url)
+        except BaseException as ex:
+            future.set_exception(ex)
+            with self.lock:
+                self.futures.pop(url, None)
+            raise
+
+        future.set_result(result)
+        with self.lock:
+            self.evict()
+        return result
+
+    def evict(self):
+        if len(self.futures) <= self.maxsize:
+            return
+
+        for url in list(self.futures):
+            if len(self.futures) <= self.maxsize:
+                break
+            if self.futures[url].done():
+                del self.futures[url]
+                self.stats.increment('evictions')
+
+
+def build_step_cache(step_options):
+    cache_options = step_options.get('cache', None)
+    if not cache_options:
+        return None
+    return TTLCache(
+        maxsize=cache_options.get('maxsize', 1024),
+        ttl=cache_options.get('ttl', 60),
+    )
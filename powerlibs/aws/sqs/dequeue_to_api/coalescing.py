@@ -0,0 +1,177 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
+
+from .instrumentation import Stats
+
+
+COALESCING_STRATEGIES = (
+    'last',  # The last body wins.
+    'merge',  # Bodies are merged (dict.update) in arrival order.
+)
+
+DEFAULT_COALESCE = {
+    'window': 1.0,
+    'strategy': 'last',
+}
+
+
+def parse_coalesce(action_name, coalesce):
+    # `"coalesce": true` or `"coalesce": {"window": 0.5, "strategy": "merge"}`
+    if not coalesce:
+        return None
+    if coalesce is True:
+        coalesce = {}
+
+    coalesce = {**DEFAULT_COALESCE, **coalesce}
+    if not isinstance(coalesce['window'], (int, float)) or coalesce['window'] < 0:
+        raise ValueError('Action "{}": coalesce window must be a non-negative number'.format(action_name))
+    if coalesce['strategy'] not in COALESCING_STRATEGIES:
+        raise ValueError('Action "{}": coalesce strategy must be one of {}'.format(
+            action_name, ', '.join(COALESCING_STRATEGIES)
+        ))
+    return coalesce
+
+
+def merge_bodies(old_body, new_body):
+    if isinstance(old_body, dict) and isinstance(new_body, dict):
+        return {**old_body, **new_body}
+    return new_body
+
+
+def when_all(futures, callback):
+    # Calls `callback(errors)` once every future is done.
+    futures = list(futures)
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        callback([future.exception() for future in futures if future.exception() is not None])
+
+    if not futures:
+        callback([])
+    for future in futures:
+        future.add_done_callback(on_done)
+
+
+class CoalescingStats(Stats):
+    COUNTERS = ('writes', 'absorbed', 'sent', 'failed')
+
+
+class PendingWrite:
+    __slots__ = ('body', 'deadline', 'futures', 'options')
+
+    def __init__(self, body, deadline, future, options):
+        self.body = body
+        self.deadline = deadline
+        self.futures = [future]
+        self.options = options  # Keyword arguments for `send`.
+
+
+class WriteCoalescer:
+    # Holds writes for up to `window` seconds, keyed by (method, URL), so
+    # writes to the same resource arriving meanwhile are absorbed into a
+    # single request. Every `submit` returns a Future resolved with the
+    # result of the request that carried it. `options` (retry policy,
+    # action name...) are passed on to `send`; the last write's win.
+    #
+    # Each key has a single request in flight at a time: a window expiring
+    # meanwhile waits for it (absorbing further writes), so an older body
+    # can never land after a newer one, retries included.
+
+    def __init__(self, send, max_workers=4):
+        self.send = send
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = {}
+        self.in_flight = set()  # Keys being sent.
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.stats = CoalescingStats()
+
+    def submit(self, method_name, url, body, window=1.0, strategy='last', options=None):
+        future = Future()
+        key = (method_name, url)
+
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('WriteCoalescer is closed')
+
+            write = self.pending.get(key, None)
+            if write is None:
+                self.pending[key] = PendingWrite(body, time.monotonic() + window, future, options or {})
+                self.stats.increment('writes')
+                self.start()
+                self.condition.notify_all()
+            else:
+                write.body = merge_bodies(write.body, body) if strategy == 'merge' else body
+                write.futures.append(future)
+                write.options = options or {}
+                self.stats.increment('absorbed')
+
+        return future
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        with self.condition:
+            while not self.closed:
+                now = time.monotonic()
+                waiting = [(key, write) for key, write in self.pending.items() if key not in self.in_flight]
+                for key, write in waiting:
+                    if write.deadline <= now:
+                        self.dispatch(key, self.pending.pop(key))
+
+                deadlines = [write.deadline for key, write in waiting if key in self.pending]
+                self.condition.wait(min(deadlines) - now if deadlines else None)
+
+    def dispatch(self, key, write):
+        # With `condition` held.
+        self.in_flight.add(key)
+        self.executor.submit(self.send_write, key, write)
+
+    def send_write(self, key, write):
+        method_name, url = key
+        try:
+            result = self.send(method_name, url, write.body, **write.options)
+        except Exception as ex:
+            self.stats.increment('failed')
+            for future in write.futures:
+                future.set_exception(ex)
+        else:
+            self.stats.increment('sent')
+            for future in write.futures:
+                future.set_result(result)
+        finally:
+            with self.condition:
+                self.in_flight.discard(key)
+                write = self.pending.get(key, None)
+                if write is not None and write.deadline <= time.monotonic():
+                    self.dispatch(key, self.pending.pop(key))
+                self.condition.notify_all()
+
+    def flush(self):
+        # Every window expires now: those of keys in flight are sent right
+        # after.
+        with self.condition:
+            for write in self.pending.values():
+                write.deadline = 0
+            for key in [key for key in self.pending if key not in self.in_flight]:
+                self.dispatch(key, self.pending.pop(key))
+            self.condition.notify_all()
+
+    def close(self):
+        self.flush()
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+            self.closed = True
+            self.condition.notify_all()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,475 @@
+from argparse import ArgumentParser
+import hashlib
+import importlib
+import json
+import os.path
+import pickle
+import re
+import string
+import sys
+
+from .batching import DEFAULT_BATCH
+from .coalescing import DEFAULT_COALESCE
+from .data_maps import DEFAULT_DATA_MAP_OPTIONS
+from .journal import DEFAULT_JOURNAL, parse_journal
+from .plans import CompiledAction
+from .plugins import PLUGIN_LOADING, find_plugin_path
+from .retries import DEFAULT_CIRCUIT_BREAKER, DEFAULT_RETRY
+from .routing import TopicRouter, is_literal
+from .scheduling import check_dependencies
+from .serialization import DEFAULT_SERIALIZATION, SERIALIZERS
+from .templates import compile_payload_template
+from .throttling import DEFAULT_AIMD
+from .transformations import DEFAULT_PAGINATION
+
+
+ARTIFACT_VERSION = 1
+REQUEST_METHODS = ('get', 'post', 'patch', 'put', 'delete')
+
+ACTION_FIELDS = frozenset((
+    'topic', 'endpoint', 'method', 'payload', 'data_map', 'data_map_options', 'accumulators', 'accumulators_concurrency',
+    'custom_handlers', 'depends_on', 'batch', 'coalesce', 'retry',
+))
+ACTION_OPTIONS = {
+    'retry': frozenset(DEFAULT_RETRY),
+    'batch': frozenset(DEFAULT_BATCH),
+    'coalesce': frozenset(DEFAULT_COALESCE),
+    'data_map_options': frozenset(DEFAULT_DATA_MAP_OPTIONS),
+}
+ACCUMULATOR_OPTIONS = {
+    'cache': frozenset(('maxsize', 'ttl', 'max_pages')),
+    'pagination': frozenset(DEFAULT_PAGINATION),
+}
+ACCUMULATOR_FIELDS = frozenset(ACCUMULATOR_OPTIONS) | {'fields'}
+RATE_LIMIT_OPTIONS = frozenset(('rate', 'burst', 'max_concurrency', 'aimd'))
+# Other keys of `config` are the user's own, for `{config[...]}` fields.
+CONFIG_OPTIONS = {
+    'retry': frozenset(DEFAULT_RETRY),
+    'circuit_breaker': frozenset(DEFAULT_CIRCUIT_BREAKER),
+    'rate_limit': RATE_LIMIT_OPTIONS | {'hosts'},
+    'http': frozenset(('pool_connections', 'pool_maxsize', 'keep_alive', 'timeout')),
+    'acknowledgements': frozenset(('batch_size', 'max_delay')),
+    'metrics': frozenset(('buckets', 'statsd')),
+    'async': frozenset(('max_in_flight', 'aiohttp', 'executor_threads')),
+    'custom_handlers': frozenset(('paths', 'loading')),
+    'workers': frozenset(('processes', 'drain_timeout', 'report_interval', 'restart_delay')),
+    'serialization': frozenset(DEFAULT_SERIALIZATION),
+    'journal': frozenset(DEFAULT_JOURNAL),
+}
+
+
+class ConfigError(ValueError):
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super().__init__('Invalid config:\n' + '\n'.join('  - {}'.format(error) for error in self.errors))
+
+
+def check_options(errors, where, options, known, allow_true=True):
+    # `true` or an object with (only) the `known` keys.
+    if not options or (allow_true and options is True):
+        return
+    if not isinstance(options, dict):
+        errors.append('{}: must be {}an object'.format(where, 'true or ' if allow_true else ''))
+        return
+    for key in sorted(set(options) - known):
+        errors.append('{}: unknown field "{}"'.format(where, key))
+
+
+def check_template(errors, where, template, variables):
+    # `variables`: the names a `str.format` template can use, or None to
+    # only check its syntax.
+    try:
+        fields = [field_name for _, field_name, _, _ in string.Formatter().parse(template) if field_name]
+    except ValueError as ex:
+        errors.append('{}: invalid template "{}": {}'.format(where, template, ex))
+        return
+
+    if variables is None:
+        return
+    roots = {re.split(r'[.\[]', field_name, 1)[0] for field_name in fields}
+    for root in sorted(roots - set(variables)):
+        errors.append('{}: unknown variable "{}" in "{}" (known: {})'.format(
+            where, root, template, ', '.join(sorted(variables))
+        ))
+
+
+def check_topic(errors, where, topic, config):
+    if not isinstance(topic, str):
+        errors.append('{}: topic must be a string'.format(where))
+        return
+
+    try:
+        expanded = topic.format(config=config)
+    except (KeyError, IndexError, AttributeError):
+        # Depends on the payload: only its syntax can be checked now.
+        check_template(errors, where, topic, None)
+        return
+    except ValueError as ex:
+        errors.append('{}: invalid topic template "{}": {}'.format(where, topic, ex))
+        return
+
+    if not is_literal(expanded):
+        try:
+            re.compile(expanded)
+        except re.error as ex:
+            errors.append('{}: invalid topic regex "{}": {}'.format(where, expanded, ex))
+
+
+def check_accumulators(errors, where, accumulators):
+    if not isinstance(accumulators, (list, tuple)):
+        errors.append('{}: accumulators must be a list'.format(where))
+        return
+
+    variables = {'payload', 'config'}
+    for position, accumulator in enumerate(accumulators):
+        step_where = '{} accumulator #{}'.format(where, position + 1)
+        if not isinstance(accumulator, (list, tuple)) or len(accumulator) not in (2, 3):
+            errors.append('{}: must be [name, url] or [name, url, options]'.format(step_where))
+            continue
+
+        step_name, url_template, *rest = accumulator
+        if not isinstance(step_name, str) or not isinstance(url_template, str):
+            errors.append('{}: name and url must be strings'.format(step_where))
+            continue
+        if step_name in variables:
+            errors.append('{}: name "{}" is already used'.format(step_where, step_name))
+
+        check_template(errors, step_where, url_template, variables)
+        options = rest[0] if rest else {}
+        check_options(errors, step_where, options, ACCUMULATOR_FIELDS, allow_true=False)
+        if isinstance(options, dict):
+            fields = options.get('fields', None)
+            if fields is not None and not (
+                isinstance(fields, (list, tuple)) and all(isinstance(field, str) for field in fields)
+            ):
+                errors.append('{}: fields must be a list of names'.format(step_where))
+            for option_name, known in ACCUMULATOR_OPTIONS.items():
+                check_options(
+                    errors, '{} {}'.format(step_where, option_name), options.get(option_name, None), known,
+                    allow_true=False
+                )
+        variables.add(step_name)
+
+
+def check_action(errors, warnings, action_name, data, config):
+    where = 'Action "{}"'.format(action_name)
+    if not isinstance(data, dict):
+        errors.append('{}: must be an object'.format(where))
+        return False
+
+    # Unknown fields are only warnings: templates (`_action`) and custom
+    # handlers get to see the whole action.
+    for key in sorted(set(data) - ACTION_FIELDS):
+        warnings.append('{}: unknown field "{}"'.format(where, key))
+
+    if 'topic' not in data:
+        errors.append('{}: missing "topic"'.format(where))
+        return False
+    check_topic(errors, where, data['topic'], config)
+
+    endpoint = data.get('endpoint', None)
+    method = data.get('method', None)
+    custom_handlers = data.get('custom_handlers', None)
+    if endpoint:
+        check_template(errors, where + ' endpoint', os.path.join(config.get('base_url', ''), endpoint),
+                       {'config', 'payload', 'topic'})
+        if not isinstance(method, str) or method.lower() not in REQUEST_METHODS:
+            errors.append('{}: method must be one of {}'.format(where, ', '.join(REQUEST_METHODS)))
+    elif not custom_handlers:
+        warnings.append('{}: has neither an endpoint nor custom handlers'.format(where))
+
+    payload = data.get('payload', None)
+    if payload is not None:
+        if not isinstance(payload, dict):
+            errors.append('{}: payload must be an object'.format(where))
+        else:
+            try:
+                compiled_template = compile_payload_template(payload)
+            except (ValueError, SyntaxError) as ex:
+                errors.append('{} payload: {}'.format(where, ex))
+            else:
+                for error in compiled_template.errors:
+                    errors.append('{} payload: {}'.format(where, error))
+
+    if not isinstance(data.get('data_map', {}), dict):
+        errors.append('{}: data_map must be an object'.format(where))
+    check_accumulators(errors, where, data.get('accumulators', []))
+
+    concurrency = data.get('accumulators_concurrency', 1)
+    if not isinstance(concurrency, int) or concurrency < 1:
+        errors.append('{}: accumulators_concurrency must be a positive integer'.format(where))
+
+    if custom_handlers is not None:
+        if not isinstance(custom_handlers, (list, tuple)):
+            errors.append('{}: custom_handlers must be a list'.format(where))
+        else:
+            for name in custom_handlers:
+                if not isinstance(name, str) or name.count('.') != 1:
+                    errors.append('{}: custom handler "{}" must be named "plugin.function"'.format(where, name))
+
+    depends_on = data.get('depends_on', None)
+    if depends_on is not None and not isinstance(depends_on, (str, list, tuple)):
+        errors.append('{}: depends_on must be an action name or a list of them'.format(where))
+
+    for option_name, known in ACTION_OPTIONS.items():
+        check_options(errors, '{} {}'.format(where, option_name), data.get(option_name, None), known,
+                      allow_true=option_name not in ('retry', 'data_map_options'))
+    return True
+
+
+def check_config_options(errors, config):
+    for option_name, known in CONFIG_OPTIONS.items():
+        check_options(errors, 'config {}'.format(option_name), config.get(option_name, None), known,
+                      allow_true=option_name in ('acknowledgements', 'metrics', 'journal'))
+
+    serialization = config.get('serialization', None)
+    if isinstance(serialization, dict):
+        backend = serialization.get('backend', 'auto')
+        if backend != 'auto' and backend not in SERIALIZERS:
+            errors.append('config serialization: unknown (or not installed) backend "{}"'.format(backend))
+
+    custom_handlers = config.get('custom_handlers', None)
+    if isinstance(custom_handlers, dict) and custom_handlers.get('loading', 'lazy') not in PLUGIN_LOADING:
+        errors.append('config custom_handlers: loading must be one of {}'.format(', '.join(PLUGIN_LOADING)))
+
+    journal = config.get('journal', None)
+    if isinstance(journal, dict):
+        try:
+            parse_journal(journal)
+        except ValueError as ex:
+            errors.append('config {}'.format(ex))
+
+    rate_limit = config.get('rate_limit', None)
+    if isinstance(rate_limit, dict):
+        check_options(errors, 'config rate_limit aimd', rate_limit.get('aimd', None), frozenset(DEFAULT_AIMD))
+        hosts = rate_limit.get('hosts', {})
+        if not isinstance(hosts, dict):
+            errors.append('config rate_limit hosts: must be an object')
+        else:
+            for host, host_config in hosts.items():
+                where = 'config rate_limit host "{}"'.format(host)
+                check_options(errors, where, host_config, RATE_LIMIT_OPTIONS, allow_true=False)
+                if isinstance(host_config, dict):
+                    check_options(errors, where + ' aimd', host_config.get('aimd', None), frozenset(DEFAULT_AIMD))
+
+
+def get_plugin_paths(config):
+    custom_handlers = config.get('custom_handlers', None)
+    return custom_handlers.get('paths', []) if isinstance(custom_handlers, dict) else []
+
+
+def check_custom_handlers(errors, actions, config, import_plugins=True):
+    # Plugins live in "<path>/<plugin>/plugin.py" and handlers are
+    # "<plugin>.<method of its Plugin class>".
+    paths = get_plugin_paths(config)
+    for path in paths:
+        if not os.path.isdir(path):
+            errors.append('config custom_handlers: "{}" is not a directory'.format(path))
+
+    plugins = {}
+    for action_name, data in actions.items():
+        for name in data.get('custom_handlers', None) or ():
+            if not isinstance(name, str) or name.count('.') != 1:
+                continue  # Already reported.
+            plugin_name, function_name = name.split('.')
+            where = 'Action "{}" custom handler "{}"'.format(action_name, name)
+
+            if plugin_name not in plugins:
+                plugins[plugin_name] = find_plugin_class(paths, plugin_name, import_plugins)
+            plugin_class = plugins[plugin_name]
+
+            if plugin_class is None:
+                errors.append('{}: no plugin "{}" in {}'.format(where, plugin_name, paths or 'no paths'))
+            elif isinstance(plugin_class, str):
+                errors.append('{}: {}'.format(where, plugin_class))
+            elif plugin_class is not True and not hasattr(plugin_class, function_name):
+                errors.append('{}: plugin "{}" has no "{}"'.format(where, plugin_name, function_name))
+
+
+def find_plugin_class(paths, plugin_name, import_plugins):
+    # The plugin's class, True if it exists but wasn't imported, None if it
+    # doesn't exist or an error message.
+    path = find_plugin_path(paths, plugin_name)
+    if path is None:
+        return None
+    if not import_plugins:
+        return True
+
+    if path not in sys.path:
+        sys.path.append(path)
+    try:
+        module = importlib.import_module('{}.plugin'.format(plugin_name))
+    except Exception as ex:
+        return 'could not import plugin "{}": {}'.format(plugin_name, ex)
+    plugin_class = getattr(module, 'Plugin', None)
+    if plugin_class is None:
+        return 'plugin "{}" has no Plugin class'.format(plugin_name)
+    return plugin_class
+
+
+def validate_config(config_data, check_handlers=False, import_plugins=True):
+    # Returns (errors, warnings): lists of messages.
+    errors = []
+    warnings = []
+
+    if not isinstance(config_data, dict):
+        return ['The config must be an object with "config" and "actions"'], warnings
+    config = config_data.get('config', None)
+    actions = config_data.get('actions', None)
+    if not isinstance(config, dict):
+        errors.append('Missing "config" object')
+    elif not isinstance(config.get('base_url', None), str):
+        errors.append('config: missing "base_url"')
+    if not isinstance(actions, dict):
+        errors.append('Missing "actions" object')
+    if errors:
+        return errors, warnings
+
+    check_config_options(errors, config)
+
+    compiled_actions = {}
+    for action_name, data in actions.items():
+        if not check_action(errors, warnings, action_name, data, config) or errors:
+            continue
+        try:
+            compiled_actions[action_name] = CompiledAction(action_name, data, config)
+        except ValueError as ex:
+            errors.append(str(ex))
+
+    if errors:
+        return errors, warnings
+
+    try:
+        check_dependencies(compiled_actions)
+    except ValueError as ex:
+        errors.append(str(ex))
+
+    # Coalesced writes are only sent after their window closes, so
+    # nothing can wait for them within the handling of a message.
+    for action_name, compiled_action in compiled_actions.items():
+        for dependency in compiled_action.depends_on:
+            if dependency in compiled_actions and compiled_actions[dependency].coalesce:
+                errors.append('Action "{}" can\'t depend on coalesced action "{}"'.format(action_name, dependency))
+
+    if check_handlers:
+        check_custom_handlers(errors, actions, config, import_plugins)
+
+    return errors, warnings
+
+
+def get_source_hash(config_data):
+    source = json.dumps(config_data, sort_keys=True, default=repr)
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+class CompiledConfig:
+    # What `DequeueToAPI.load_config` needs, validated and prepared once:
+    # the router with its compiled regexes and every `CompiledAction`.
+    # Picklable, so it can be built offline (see `main`) and loaded by
+    # worker processes and cold starts without parsing the config again.
+
+    def __init__(self, config_data, warnings=()):
+        self.version = ARTIFACT_VERSION
+        self.source_hash = get_source_hash(config_data)
+        self.config = config_data['config']
+        self.actions = config_data['actions']
+        self.warnings = list(warnings)
+
+        self.topics = {}
+        for action_name, action_data in self.actions.items():
+            self.topics.setdefault(action_data['topic'], []).append((action_name, action_data))
+        self.router = TopicRouter(self.topics.keys(), self.config)
+
+        self.compiled_actions = {
+            action_name: CompiledAction(action_name, action_data, self.config)
+            for action_name, action_data in self.actions.items()
+        }
+
+    def dump(self, file):
+        pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def dumps(self):
+        return pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def matches(self, config_data):
+        return self.source_hash == get_source_hash(config_data)
+
+
+def check_artifact(compiled_config):
+    if not isinstance(compiled_config, CompiledConfig):
+        raise ValueError('Not a compiled config')
+    if getattr(compiled_config, 'version', None) != ARTIFACT_VERSION:
+        raise ValueError('Compiled config version {} is not supported (expected {}): compile it again'.format(
+            getattr(compiled_config, 'version', None), ARTIFACT_VERSION
+        ))
+    return compiled_config
+
+
+def load_compiled_config(file):
+    # Only load artifacts you built yourself: this is `pickle.load`.
+    return check_artifact(pickle.load(file))
+
+
+def compile_config(config_data, strict=False, check_handlers=False, import_plugins=True):
+    # `strict`: warnings (unknown action fields, actions doing nothing) are
+    # errors too. `check_handlers`: look for the custom handlers' plugins
+    # (importing them, unless `import_plugins` is False).
+    errors, warnings = validate_config(config_data, check_handlers, import_plugins)
+    if strict:
+        errors = errors + warnings
+    if errors:
+        raise ConfigError(errors)
+    return CompiledConfig(config_data, warnings)
+
+
+def read_config_file(path):
+    with open(path) as config_file:
+        if not path.endswith(('.yaml', '.yml')):
+            return json.load(config_file)
+
+        import yaml
+        try:
+            return yaml.safe_load(config_file)
+        except yaml.YAMLError as ex:
+            raise ValueError(str(ex))
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        prog='dequeue-to-api-compile',
+        description='Validate a DequeueToAPI config (JSON) and, optionally, save it compiled.'
+    )
+    parser.add_argument('config_file', help='JSON, or YAML (with PyYAML installed).')
+    parser.add_argument('-o', '--output', help='Where to save the compiled config (a pickle).')
+    parser.add_argument('--lenient', action='store_true', help='Only fail on errors, not on warnings.')
+    parser.add_argument('--no-handlers', action='store_true', help='Don\'t look for the custom handlers.')
+    parser.add_argument('--no-import', action='store_true', help='Look for the plugins without importing them.')
+    args = parser.parse_args(argv)
+
+    try:
+        config_data = read_config_file(args.config_file)
+    except (OSError, ValueError, ImportError) as ex:
+        print('{}: {}'.format(args.config_file, ex), file=sys.stderr)
+        return 2
+
+    errors, warnings = validate_config(config_data, not args.no_handlers, not args.no_import)
+    for error in errors:
+        print('error: {}'.format(error), file=sys.stderr)
+    for warning in warnings:
+        print('warning: {}'.format(warning), file=sys.stderr)
+    if errors or (warnings and not args.lenient):
+        return 1
+
+    compiled_config = CompiledConfig(config_data, warnings)
+    if args.output:
+        with open(args.output, 'wb') as output_file:
+            compiled_config.dump(output_file)
+
+    print('{}: {} actions, {} topics: OK'.format(
+        args.config_file, len(compiled_config.compiled_actions), len(compiled_config.topics)
+    ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+import string
+
+from .templates import COERCION_PREFIXES, EXPRESSION_PREFIX, OPTIONAL_PREFIX
+
+
+MAP_PREFIX = 'MAP:'
+MISSING_POLICIES = (
+    'drop',  # The value is left out (what `apply_data_map` always did).
+    'keep',  # The "MAP:..." value is left as is.
+    'default',  # The value is `default`.
+    'error',  # KeyError: the action fails.
+)
+DEFAULT_DATA_MAP_OPTIONS = {
+    'missing': 'drop',
+    'default': None,
+    'nested': False,  # Map values inside dicts and lists too (`apply_data_map` never did).
+}
+
+DROP = object()  # What a value mapped to nothing becomes (never kept around).
+
+
+def parse_data_map_options(action_name, options):
+    options = {**DEFAULT_DATA_MAP_OPTIONS, **(options or {})}
+    if options['missing'] not in MISSING_POLICIES:
+        raise ValueError('Action "{}": data_map_options missing must be one of {}'.format(
+            action_name, ', '.join(MISSING_POLICIES)
+        ))
+    return options
+
+
+def get_leading_text(template):
+    # The literal text before the first field (and whether there's one).
+    try:
+        for literal_text, field_name, _, _ in string.Formatter().parse(template):
+            if field_name is not None:
+                return literal_text, True
+            if literal_text:
+                return literal_text, False
+    except ValueError:
+        return '', True  # Broken templates fail when rendered.
+    return '', False
+
+
+def get_map_site(template):
+    # How a payload template value relates to "MAP:": None if it can't
+    # render to anything with "MAP:..." in it, the value it renders to if
+    # it's constant and True if it has to be checked once rendered.
+    if template.startswith(OPTIONAL_PREFIX):
+        template = template[len(OPTIONAL_PREFIX):]
+    if template.startswith(EXPRESSION_PREFIX) or template.startswith('EVAL:') or template.startswith('DICT:'):
+        return True  # Any value at all.
+    if any(template.startswith(prefix) for prefix in COERCION_PREFIXES):
+        return None
+
+    leading_text, has_fields = get_leading_text(template)
+    if not has_fields:
+        return template.format() if leading_text.startswith(MAP_PREFIX) else None
+    if leading_text.startswith(MAP_PREFIX) or MAP_PREFIX.startswith(leading_text):
+        return True
+    return None
+
+
+class DataMapper:
+    # `apply_data_map` compiled for one action. With a payload template,
+    # the "MAP:" sites are found in its shape once: values that can't
+    # render to "MAP:..." are never looked at again, and constant ones
+    # (nested included) are mapped right away. Without one, every value of
+    # every entry is checked, unless there's no data map at all.
+
+    def __init__(self, data_map, payload_template=None, options=None):
+        self.data_map = data_map or {}
+        self.options = {**DEFAULT_DATA_MAP_OPTIONS, **(options or {})}
+        self.missing = self.options['missing']
+        self.default = self.options['default']
+        self.nested = self.options['nested']
+
+        self.shaped = payload_template is not None
+        self.checks = []  # Keys whose rendered values are checked.
+        self.constants = []  # (key, mapped value)
+        self.drops = []  # Keys mapped to nothing.
+        if self.shaped:
+            self.find_sites(payload_template)
+        self.checks = tuple(self.checks)
+        self.constants = tuple(self.constants)
+        self.drops = tuple(self.drops)
+
+    def find_sites(self, payload_template):
+        for key, value in payload_template.items():
+            if isinstance(value, str):
+                site = get_map_site(value)
+                if site is None:
+                    continue
+                if site is True:
+                    self.checks.append(key)
+                    continue
+                value = site
+            elif not self.nested or not isinstance(value, (dict, list)):
+                continue
+
+            try:
+                mapped = self.map_value(value)
+            except KeyError:
+                self.checks.append(key)  # Fail when rendered, not when compiled.
+                continue
+            if mapped is DROP:
+                self.drops.append(key)
+            elif mapped != value:
+                self.constants.append((key, mapped))
+
+    @property
+    def is_noop(self):
+        if not self.shaped:
+            return not self.data_map
+        return not (self.checks or self.constants or self.drops)
+
+    def lookup(self, value):
+        map_key = value[len(MAP_PREFIX):]
+        if map_key and map_key in self.data_map:
+            return self.data_map[map_key]
+
+        missing = self.missing
+        if missing == 'drop':
+            return DROP
+        if missing == 'keep':
+            return value
+        if missing == 'default':
+            return self.default
+        raise KeyError('data_map has no "{}"'.format(map_key))
+
+    def map_value(self, value):
+        if value.__class__ is str:
+            return self.lookup(value) if value.startswith(MAP_PREFIX) else value
+        if not self.nested:
+            return value
+
+        if isinstance(value, dict):
+            mapped = {}
+            for key, item in value.items():
+                item = self.map_value(item)
+                if item is not DROP:
+                    mapped[key] = item
+            return mapped
+        if isinstance(value, list):
+            return [item for item in map(self.map_value, value) if item is not DROP]
+        return value
+
+    def apply(self, entry):
+        # Entries rendered by a payload template are new dicts, changed in
+        # place; others are copied.
+        if not self.shaped:
+            mapped = {}
+            for key, value in entry.items():
+                value = self.map_value(value)
+                if value is not DROP:
+                    mapped[key] = value
+            return mapped
+
+        for key in self.checks:
+            value = entry.get(key, None)  # Missing if OPTIONAL.
+            if value.__class__ is str:
+                if not value.startswith(MAP_PREFIX):
+                    continue
+                value = self.lookup(value)
+            elif value is None or not self.nested:
+                continue
+            else:
+                value = self.map_value(value)
+
+            if value is DROP:
+                del entry[key]
+            else:
+                entry[key] = value
+
+        for key, value in self.constants:
+            if key in entry:
+                entry[key] = value
+        for key in self.drops:
+            entry.pop(key, None)
+        return entry
@@ -0,0 +1,225 @@
+from collections import OrderedDict
+import ast
+import re
+import threading
+
+
+MAX_EXPONENT = 1000
+MAX_INT_BITS = 8192  # Integers computed by `*` and `**`, at most.
+MAX_SEQUENCE_LENGTH = 100000  # Strings and lists repeated by `*`, at most.
+SEQUENCE_TYPES = (str, bytes, list, tuple)
+INT_RE = re.compile(r'(0|[1-9][0-9]*)\Z')
+FLOAT_RE = re.compile(r'([0-9]+\.[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?\Z')
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+def safe_pow(base, exponent):
+    if isinstance(exponent, (int, float)) and abs(exponent) > MAX_EXPONENT:
+        raise ExpressionError('Exponent too large: {}'.format(exponent))
+    if isinstance(base, int) and isinstance(exponent, int) and abs(base).bit_length() * exponent > MAX_INT_BITS:
+        raise ExpressionError('Result too large: {} ** {}'.format(base, exponent))
+    return base ** exponent
+
+
+def safe_mult(left, right):
+    if isinstance(left, int) and isinstance(right, int):
+        if left.bit_length() + right.bit_length() > MAX_INT_BITS:
+            raise ExpressionError('Result too large: {} * {}'.format(left, right))
+    elif isinstance(left, SEQUENCE_TYPES) and isinstance(right, int) or (
+        isinstance(right, SEQUENCE_TYPES) and isinstance(left, int)
+    ):
+        sequence, times = (left, right) if isinstance(left, SEQUENCE_TYPES) else (right, left)
+        if len(sequence) * times > MAX_SEQUENCE_LENGTH:
+            raise ExpressionError('Result too long: {} items'.format(len(sequence) * times))
+    return left * right
+
+
+FUNCTIONS = {
+    'abs': abs,
+    'bool': bool,
+    'dict': dict,
+    'float': float,
+    'int': int,
+    'len': len,
+    'list': list,
+    'max': max,
+    'min': min,
+    'round': round,
+    'sorted': sorted,
+    'str': str,
+    'sum': sum,
+    'tuple': tuple,
+}
+
+
+ALLOWED_NODES = tuple(
+    getattr(ast, name) for name in (
+        'Expression', 'Load',
+        'Constant', 'Num', 'Str', 'Bytes', 'NameConstant', 'Ellipsis',
+        'Name', 'List', 'Tuple', 'Dict', 'Set',
+        'BinOp', 'Add', 'Sub', 'Mult', 'Div', 'FloorDiv', 'Mod', 'Pow',
+        'UnaryOp', 'UAdd', 'USub', 'Not',
+        'BoolOp', 'And', 'Or',
+        'Compare', 'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'In', 'NotIn', 'Is', 'IsNot',
+        'IfExp', 'Subscript', 'Index', 'Slice',
+        'Call', 'keyword',
+    )
+    if hasattr(ast, name)
+)
+
+
+class SafeOperatorsTransformer(ast.NodeTransformer):
+    # `**` and `*`, whose results can be huge, go through `safe_pow` and
+    # `safe_mult`.
+    SAFE_FUNCTIONS = {ast.Pow: '_safe_pow', ast.Mult: '_safe_mult'}
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        function_name = self.SAFE_FUNCTIONS.get(node.op.__class__, None)
+        if function_name is None:
+            return node
+
+        call = ast.Call(
+            func=ast.Name(id=function_name, ctx=ast.Load()),
+            args=[node.left, node.right],
+            keywords=[],
+        )
+        return ast.copy_location(call, node)
+
+
+def validate(tree, source, functions):
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ExpressionError('{} is not allowed in expression "{}"'.format(node.__class__.__name__, source))
+
+        if isinstance(node, ast.Name) and node.id.startswith('__'):
+            raise ExpressionError('Name "{}" is not allowed in expression "{}"'.format(node.id, source))
+
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in functions:
+                raise ExpressionError('Only {} can be called in expression "{}"'.format(
+                    ', '.join(sorted(functions)), source
+                ))
+            if any(isinstance(arg, getattr(ast, 'Starred', ())) for arg in node.args):
+                raise ExpressionError('Star-arguments are not allowed in expression "{}"'.format(source))
+            if any(kw.arg is None for kw in node.keywords):
+                raise ExpressionError('Keyword expansion is not allowed in expression "{}"'.format(source))
+
+
+class Expression:
+    def __init__(self, source, functions=None):
+        self.source = source
+        self.functions = FUNCTIONS if functions is None else functions
+
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError as ex:
+            raise ExpressionError('Invalid expression "{}": {}'.format(source, ex))
+
+        validate(tree, source, self.functions)
+        self.names = frozenset(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+
+        tree = ast.fix_missing_locations(SafeOperatorsTransformer().visit(tree))
+        self.code = compile(tree, '<expression>', 'eval')
+        self.globals = {'__builtins__': {}, '_safe_pow': safe_pow, '_safe_mult': safe_mult, **self.functions}
+
+    def evaluate(self, variables=None):
+        return eval(self.code, self.globals, variables or {})
+
+
+class ExpressionCache:
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.expressions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, source):
+        with self.lock:
+            expression = self.expressions.get(source, None)
+            if expression is not None:
+                self.expressions.move_to_end(source)
+                return expression
+
+        expression = Expression(source)
+        with self.lock:
+            self.expressions[source] = expression
+            if len(self.expressions) > self.maxsize:
+                self.expressions.popitem(last=False)
+        return expression
+
+
+expressions_cache = ExpressionCache()
+
+
+def compile_expression(source, functions=None):
+    return Expression(source, functions)
+
+
+def evaluate_source(source):
+    # Compatibility path for text-substituted "EVAL:" values: same results
+    # as `eval` for everything the restricted language accepts, compiled
+    # once per distinct source.
+    return expressions_cache.get(source).evaluate()
+
+
+def parse_simple_literal(text):
+    if text in ('True', 'False', 'None'):
+        return True, {'True': True, 'False': False, 'None': None}[text]
+    if INT_RE.match(text):
+        return True, int(text)
+    if FLOAT_RE.match(text):
+        return True, float(text)
+    return False, None
+
+
+def parse_field_value(text):
+    # A rendered field as the value text substitution would have made of
+    # it, if it's a literal ("21", "-1.5", "[1, 2]"...); any other text
+    # (such as "1 + 1") is data, never code: it stays a string.
+    is_literal, value = parse_simple_literal(text)
+    if is_literal:
+        return value
+    try:
+        return ast.literal_eval(text.strip())
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return text
+
+
+class BoundExpression:
+    # An "EVAL:" template whose fields are bound as variables instead of
+    # being substituted into the source text on every render.
+
+    def __init__(self, source, renderers):
+        self.expression = Expression(source)
+        self.renderers = renderers
+
+    def evaluate(self, specials, entry):
+        variables = {name: parse_field_value(renderer(specials, entry)) for name, renderer in self.renderers}
+        return self.expression.evaluate(variables)
+
+
+def bind_expression(parts, prefix):
+    # `parts` are the compiled parts of a template: literal strings and
+    # field renderers. Returns None if the fields can't be bound as
+    # variables (for instance, when they are inside quotes).
+    source_parts = []
+    renderers = []
+    for part in parts:
+        if part.__class__ is str:
+            source_parts.append(part.replace(prefix, ''))
+        else:
+            name = '_field_{}'.format(len(renderers))
+            source_parts.append(' {} '.format(name))
+            renderers.append((name, part))
+
+    try:
+        bound = BoundExpression(''.join(source_parts), renderers)
+    except ExpressionError:
+        return None
+
+    if not all(name in bound.expression.names for name, _ in renderers):
+        return None
+    return bound
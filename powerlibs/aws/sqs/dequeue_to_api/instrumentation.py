@@ -0,0 +1,268 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import math
+import socket
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def get_labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Stats:
+    # Thread-safe counters, one per name in `COUNTERS` (also readable as
+    # attributes). Subclasses add their derived stats in `as_dict`.
+    COUNTERS = ()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def as_dict(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def __getattr__(self, name):
+        if name in self.COUNTERS:
+            return self.counters[name]
+        raise AttributeError(name)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class NullMetrics:
+    # What the dequeuer uses when metrics are disabled: hot paths check
+    # `enabled` before measuring anything, so this is never called there.
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    @contextmanager
+    def timer(self, name, **labels):
+        yield
+
+    def add_exporter(self, exporter):
+        raise RuntimeError('Metrics are disabled')
+
+
+NULL_METRICS = NullMetrics()
+
+
+class Metrics:
+    # Counters and histograms (of seconds, mostly), keyed by name and labels.
+    # Every measurement is also passed to the exporters, callables like
+    # `exporter(kind, name, value, labels)` ("counter" or "histogram").
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, exporters=()):
+        self.buckets = tuple(sorted(float(bucket) for bucket in buckets))
+        self.exporters = list(exporters)
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, get_labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for exporter in self.exporters:
+            exporter('counter', name, value, labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, get_labels_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+        for exporter in self.exporters:
+            exporter('histogram', name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def get_counter(self, name, **labels):
+        return self.counters.get((name, get_labels_key(labels)), 0)
+
+    def get_histogram(self, name, **labels):
+        return self.histograms.get((name, get_labels_key(labels)), None)
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {
+                key: (histogram.buckets, list(histogram.get_cumulative_counts()), histogram.sum, histogram.count)
+                for key, histogram in self.histograms.items()
+            }
+        return counters, histograms
+
+
+class AggregatedMetrics:
+    # The sum of the `Metrics.snapshot()` of several sources (the worker
+    # processes, mostly), each one replacing its previous snapshot. Works
+    # with `render_prometheus`.
+    enabled = True
+
+    def __init__(self):
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def update(self, source, snapshot):
+        with self.lock:
+            self.snapshots[source] = snapshot
+
+    def snapshot(self):
+        counters = {}
+        histograms = {}
+        with self.lock:
+            snapshots = list(self.snapshots.values())
+
+        for source_counters, source_histograms in snapshots:
+            for key, value in source_counters.items():
+                counters[key] = counters.get(key, 0) + value
+            for key, (buckets, counts, total, count) in source_histograms.items():
+                if key not in histograms:
+                    histograms[key] = (buckets, list(counts), total, count)
+                    continue
+                _, merged_counts, merged_total, merged_count = histograms[key]
+                histograms[key] = (
+                    buckets,
+                    [merged + new for merged, new in zip(merged_counts, counts)],
+                    merged_total + total,
+                    merged_count + count,
+                )
+        return counters, histograms
+
+    def get_counter(self, name, **labels):
+        counters, _ = self.snapshot()
+        return counters.get((name, get_labels_key(labels)), 0)
+
+
+def build_metrics(config):
+    # config['metrics'] = {"buckets": [...], "statsd": {"host": ..., "port": ..., "prefix": ...}}
+    if not config:
+        return NULL_METRICS
+    if config is True:
+        config = {}
+
+    metrics = Metrics(config.get('buckets', DEFAULT_BUCKETS))
+    statsd_config = config.get('statsd', None)
+    if statsd_config:
+        metrics.add_exporter(StatsDExporter(**statsd_config))
+    return metrics
+
+
+# Exporters
+def format_prometheus_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in items
+    ) + '}'
+
+
+def format_prometheus_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(metrics, namespace='dequeue_to_api'):
+    # The Prometheus text exposition format, to be served by whatever HTTP
+    # server the application already has.
+    counters, histograms = metrics.snapshot()
+    lines = []
+
+    names = sorted({name for name, _ in counters})
+    for name in names:
+        metric_name = '{}_{}_total'.format(namespace, name)
+        lines.append('# TYPE {} counter'.format(metric_name))
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append('{}{} {}'.format(metric_name, format_prometheus_labels(labels), value))
+
+    names = sorted({name for name, _ in histograms})
+    for name in names:
+        metric_name = '{}_{}'.format(namespace, name)
+        lines.append('# TYPE {} histogram'.format(metric_name))
+        for (histogram_name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            for bucket, bucket_count in zip(tuple(buckets) + (math.inf,), counts):
+                bucket_labels = format_prometheus_labels(labels, [('le', format_prometheus_value(bucket))])
+                lines.append('{}_bucket{} {}'.format(metric_name, bucket_labels, bucket_count))
+            lines.append('{}_sum{} {}'.format(metric_name, format_prometheus_labels(labels), repr(total)))
+            lines.append('{}_count{} {}'.format(metric_name, format_prometheus_labels(labels), count))
+
+    return '\n'.join(lines) + '\n'
+
+
+class StatsDExporter:
+    # Sends every measurement as a StatsD datagram, with the labels as
+    # DogStatsD tags: "prefix.http_request:12.500|ms|#method:post" (timers
+    # in milliseconds, named without their "_seconds" suffix).
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='dequeue_to_api', tags=True, sock=None):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.tags = tags
+        self.socket = sock or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, kind, name, value, labels):
+        if kind == 'counter':
+            line = '{}.{}:{}|c'.format(self.prefix, name, value)
+        elif name.endswith('_seconds'):
+            line = '{}.{}:{:.3f}|ms'.format(self.prefix, name[:-len('_seconds')], value * 1000)
+        else:
+            line = '{}.{}:{}|h'.format(self.prefix, name, value)
+
+        if self.tags and labels:
+            line += '|#' + ','.join('{}:{}'.format(key, value) for key, value in sorted(labels.items()))
+        return line
+
+    def __call__(self, kind, name, value, labels):
+        try:
+            self.socket.sendto(self.format(kind, name, value, labels).encode('utf-8'), self.address)
+        except OSError:
+            pass  # Metrics are never worth failing a message for.
@@ -0,0 +1,178 @@
+import sqlite3
+import threading
+import time
+
+from .instrumentation import Stats
+
+
+DEFAULT_JOURNAL = {
+    'backend': 'memory',  # "memory" (per process), "sqlite" or a registered name.
+    'path': ':memory:',  # The SQLite database file.
+    'retention': 345600,  # Seconds: SQS's default message retention (set it to the queue's).
+    'expire_interval': 60,  # Seconds between each removal of expired records.
+}
+
+WHOLE_ACTION = -1  # The "entry index" recording a whole action as done.
+
+
+def parse_journal(journal):
+    # `"journal": true` or `"journal": {"backend": "sqlite", "path": "journal.db"}`
+    if not journal:
+        return None
+    if journal is True:
+        journal = {}
+
+    journal = {**DEFAULT_JOURNAL, **journal}
+    for key in ('retention', 'expire_interval'):
+        if not isinstance(journal[key], (int, float)) or journal[key] <= 0:
+            raise ValueError('journal {} must be a positive number'.format(key))
+    if journal['backend'] not in JOURNALS:
+        raise ValueError('Unknown journal backend "{}"'.format(journal['backend']))
+    return journal
+
+
+class MemoryJournal:
+    # Records of which writes of each message succeeded, keyed by message
+    # ID and then (action name, entry index). A message's records are
+    # forgotten once it's deleted from the queue, or kept `retention`
+    # seconds if it never is: after that, SQS won't deliver it anymore
+    # anyway.
+    #
+    # It lives in the process: workers (see `workers.py`) each have their
+    # own, so a message redelivered to another worker starts over. Use the
+    # "sqlite" backend with a file for a journal shared by a host's workers.
+
+    def __init__(self, retention=DEFAULT_JOURNAL['retention'], clock=time.time, **options):
+        self.retention = retention
+        self.clock = clock
+        self.records = {}  # message ID: {(action name, entry index): done at}
+        self.lock = threading.Lock()
+
+    def is_done(self, message_id, action_name, index):
+        with self.lock:
+            done_at = self.records.get(message_id, {}).get((action_name, index), None)
+        return done_at is not None and done_at > self.clock() - self.retention
+
+    def mark_done(self, message_id, action_name, index):
+        with self.lock:
+            self.records.setdefault(message_id, {})[(action_name, index)] = self.clock()
+
+    def forget(self, message_id):
+        with self.lock:
+            return len(self.records.pop(message_id, ()))
+
+    def expire(self):
+        oldest = self.clock() - self.retention
+        expired = 0
+        with self.lock:
+            for message_id, message_records in list(self.records.items()):
+                for key, done_at in list(message_records.items()):
+                    if done_at <= oldest:
+                        del message_records[key]
+                        expired += 1
+                if not message_records:
+                    del self.records[message_id]
+        return expired
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(message_records) for message_records in self.records.values())
+
+
+class SQLiteJournal:
+    # Same as MemoryJournal, in a SQLite database: with a file `path`, the
+    # journal survives restarts of the process and is shared by the
+    # workers using the same file (but it's still local to the host:
+    # workers elsewhere don't see it).
+
+    def __init__(self, path=DEFAULT_JOURNAL['path'], retention=DEFAULT_JOURNAL['retention'], clock=time.time,
+                 **options):
+        self.retention = retention
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS progress ('
+                'message_id TEXT, action TEXT, entry INTEGER, done_at REAL, '
+                'PRIMARY KEY (message_id, action, entry))'
+            )
+
+    def is_done(self, message_id, action_name, index):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT done_at FROM progress WHERE message_id = ? AND action = ? AND entry = ?',
+                (message_id, action_name, index)
+            ).fetchone()
+        return row is not None and row[0] > self.clock() - self.retention
+
+    def mark_done(self, message_id, action_name, index):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO progress (message_id, action, entry, done_at) VALUES (?, ?, ?, ?)',
+                (message_id, action_name, index, self.clock())
+            )
+
+    def forget(self, message_id):
+        with self.lock:
+            cursor = self.connection.execute('DELETE FROM progress WHERE message_id = ?', (message_id,))
+        return cursor.rowcount
+
+    def expire(self):
+        with self.lock:
+            cursor = self.connection.execute(
+                'DELETE FROM progress WHERE done_at <= ?', (self.clock() - self.retention,)
+            )
+        return cursor.rowcount
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM progress').fetchone()[0]
+
+
+JOURNALS = {'memory': MemoryJournal, 'sqlite': SQLiteJournal}
+
+
+def register_journal(name, journal_class):
+    # Any class built with the journal options as keyword arguments and
+    # implementing `is_done`, `mark_done`, `forget`, `expire` and `close`.
+    JOURNALS[name] = journal_class
+
+
+def build_journal(options):
+    if options is None:
+        return None
+    journal_options = {key: value for key, value in options.items() if key != 'backend'}
+    return JOURNALS[options['backend']](**journal_options)
+
+
+class MessageProgress:
+    # One message's view of the journal, handed to its action plans.
+    __slots__ = ('journal', 'message_id', 'stats')
+
+    def __init__(self, journal, message_id, stats):
+        self.journal = journal
+        self.message_id = message_id
+        self.stats = stats
+
+    def is_done(self, action_name, index=WHOLE_ACTION):
+        done = self.journal.is_done(self.message_id, action_name, index)
+        if done:
+            self.stats.increment('skipped_actions' if index == WHOLE_ACTION else 'skipped_writes')
+        return done
+
+    def mark_done(self, action_name, index=WHOLE_ACTION):
+        self.journal.mark_done(self.message_id, action_name, index)
+        self.stats.increment('recorded')
+
+
+class JournalStats(Stats):
+    COUNTERS = ('recorded', 'skipped_actions', 'skipped_writes', 'forgotten', 'expired')
@@ -0,0 +1,187 @@
+import os.path
+
+from .batching import parse_batch
+from .coalescing import parse_coalesce
+from .data_maps import DataMapper, parse_data_map_options
+from .instrumentation import Stats
+from .retries import get_retry_defaults, parse_retry
+from .scheduling import get_dependencies
+from .templates import UrlTemplate, compile_payload_template
+from .transformations import AccumulationUrl, parse_accumulator
+
+
+class CompiledAction:
+    # Everything about an action that doesn't depend on the message,
+    # prepared once by `compile_config` (and picklable along with it).
+    __slots__ = (
+        'name', 'data', 'topic', 'url_template', 'endpoint_url', 'method', 'payload_template',
+        'data_map', 'data_mapper', 'accumulators', 'accumulator_urls', 'accumulators_concurrency', 'custom_handlers',
+        'depends_on', 'batch', 'coalesce', 'retry',
+    )
+
+    def __init__(self, name, data, config):
+        self.name = name
+        self.data = data
+        self.topic = data['topic']
+
+        endpoint = data.get('endpoint', None)
+        self.url_template = os.path.join(config['base_url'], endpoint) if endpoint else None
+        self.endpoint_url = UrlTemplate(self.url_template, config) if endpoint else None
+        method = data.get('method', None)
+        self.method = method.lower() if method else None
+
+        payload_template = data.get('payload', None)
+        self.payload_template = compile_payload_template(payload_template) if payload_template else None
+        self.data_map = data.get('data_map', {})
+        self.data_mapper = DataMapper(
+            self.data_map, payload_template, parse_data_map_options(name, data.get('data_map_options', None))
+        )
+
+        self.accumulators = tuple(parse_accumulator(accumulator) for accumulator in data.get('accumulators', []))
+        self.accumulator_urls = tuple(
+            AccumulationUrl(url_template, config) for _, url_template, _ in self.accumulators
+        )
+        self.accumulators_concurrency = data.get(
+            'accumulators_concurrency', config.get('accumulators_concurrency', 1)
+        )
+        self.custom_handlers = tuple(data.get('custom_handlers', None) or ())
+        self.depends_on = get_dependencies(data)
+        self.batch = parse_batch(name, data.get('batch', None))
+        self.coalesce = parse_coalesce(name, data.get('coalesce', None))
+        self.retry = parse_retry(name, data.get('retry', None), get_retry_defaults(config))
+        if self.batch and self.coalesce:
+            raise ValueError('Action "{}": batch and coalesce can\'t be used together'.format(name))
+
+    @property
+    def has_endpoint(self):
+        return self.url_template is not None
+
+
+class LazyEntries:
+    # The entries of an ActionPlan, accumulated (GETs and all) and rendered
+    # only as they're iterated: they stream straight into the writes, and a
+    # failed write stops the rest from being fetched. Hydrated entries are
+    # kept, so iterating again (or `len`, indexing, comparing) doesn't
+    # repeat any work.
+    __slots__ = ('source', 'hydrated', 'error')
+
+    def __init__(self, source):
+        self.source = iter(source)
+        self.hydrated = []
+        self.error = None  # What hydrating them raised, if anything.
+
+    @property
+    def complete(self):
+        return self.source is None
+
+    def __iter__(self):
+        index = 0
+        while True:
+            if index < len(self.hydrated):
+                yield self.hydrated[index]
+                index += 1
+                continue
+            if self.source is None:
+                return
+            try:
+                entry = next(self.source)
+            except StopIteration:
+                self.source = None
+                return
+            except Exception as ex:
+                self.error = ex
+                raise
+            self.hydrated.append(entry)
+
+    def close(self):
+        # Gives up on the entries not hydrated yet (and their GETs).
+        if self.source is not None:
+            close = getattr(self.source, 'close', None)
+            self.source = None
+            if close is not None:
+                close()
+
+    def as_tuple(self):
+        return tuple(iter(self))  # Not `tuple(self)`: it would ask for `len(self)`.
+
+    def __len__(self):
+        return len(self.as_tuple())
+
+    def __getitem__(self, index):
+        return self.as_tuple()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, LazyEntries):
+            other = other.as_tuple()
+        return self.as_tuple() == other
+
+    def __repr__(self):
+        return '<LazyEntries {} hydrated{}>'.format(len(self.hydrated), '' if self.complete else ', more pending')
+
+
+class HydrationStats(Stats):
+    # How much of the matched work was actually done: actions never built
+    # (an earlier one failed the message) did no GETs nor rendering at all,
+    # and abandoned plans stopped hydrating entries at their first failed
+    # write.
+    COUNTERS = ('actions_matched', 'actions_built', 'entries_hydrated', 'plans_abandoned')
+
+    def record_plan(self, entries_hydrated, abandoned=False):
+        with self.lock:
+            self.counters['entries_hydrated'] += entries_hydrated
+            if abandoned:
+                self.counters['plans_abandoned'] += 1
+
+    def as_dict(self):
+        stats = super().as_dict()
+        stats['actions_skipped'] = stats['actions_matched'] - stats['actions_built']
+        return stats
+
+
+class ActionPlan:
+    # What one message makes one action do: built per message and never
+    # changed afterwards, so concurrent messages can't step on each other.
+    __slots__ = (
+        'action_name', 'action', 'topic', 'topic_groups', 'payload', 'url', 'method', 'entries', 'handlers', 'batch',
+        'coalesce', 'retry', 'progress', 'runner',
+    )
+
+    def __init__(self, action_name, action, topic, topic_groups, payload, runner,
+                 url=None, method=None, entries=(), handlers=(), batch=None, coalesce=None, retry=None,
+                 progress=None):
+        set_attribute = super().__setattr__
+        set_attribute('action_name', action_name)
+        set_attribute('action', action)
+        set_attribute('topic', topic)
+        set_attribute('topic_groups', topic_groups)
+        set_attribute('payload', payload)
+        set_attribute('runner', runner)
+        set_attribute('url', url)
+        set_attribute('method', method)
+        set_attribute('entries', entries)
+        set_attribute('handlers', handlers)
+        set_attribute('batch', batch)
+        set_attribute('coalesce', coalesce)
+        set_attribute('retry', retry)
+        set_attribute('progress', progress)  # A `journal.MessageProgress`, with a journal.
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ActionPlan is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('ActionPlan is immutable')
+
+    def __repr__(self):
+        entries = self.entries
+        if isinstance(entries, LazyEntries) and not entries.complete:
+            entries_count = '{}+'.format(len(entries.hydrated))  # Not hydrating them just for this.
+        else:
+            entries_count = len(entries)
+        return '<ActionPlan {} {} {} ({} entries, {} handlers)>'.format(
+            self.action_name, self.method, self.url, entries_count, len(self.handlers)
+        )
+
+    def run(self):
+        # Returns the Futures of the writes it left to a `WriteCoalescer`,
+        # if any.
+        return self.runner(self)
@@ -0,0 +1,148 @@
+import importlib
+import os.path
+import sys
+import threading
+
+from .instrumentation import Stats
+
+
+PLUGIN_LOADING = (
+    'lazy',  # Each plugin is imported and built when a message first needs it.
+    'eager',  # All the referenced plugins are built (and warmed up) with the dequeuer.
+)
+
+
+def find_plugin_path(paths, plugin_name):
+    # The first of `paths` with a "<plugin_name>/plugin.py".
+    for path in paths:
+        if os.path.isfile(os.path.join(path, plugin_name, 'plugin.py')):
+            return path
+    return None
+
+
+def import_plugin_module(paths, plugin_name):
+    path = find_plugin_path(paths, plugin_name)
+    if path is None:
+        raise ImportError('No plugin "{}" in {}'.format(plugin_name, paths))
+    if path not in sys.path:
+        sys.path.append(path)
+    return importlib.import_module('{}.plugin'.format(plugin_name))
+
+
+def get_referenced_handlers(compiled_actions):
+    # Every "plugin.function" the actions use, in order and once.
+    handler_names = {}
+    for compiled_action in compiled_actions.values():
+        for name in compiled_action.custom_handlers:
+            handler_names[name] = None
+    return tuple(handler_names)
+
+
+class HandlerStats(Stats):
+    COUNTERS = ('calls', 'failures', 'time', 'max_time')
+
+    def record_call(self, elapsed, failed=False):
+        with self.lock:
+            counters = self.counters
+            counters['calls'] += 1
+            counters['time'] += elapsed
+            counters['max_time'] = max(counters['max_time'], elapsed)
+            if failed:
+                counters['failures'] += 1
+
+    def as_dict(self):
+        stats = super().as_dict()
+        stats['mean_time'] = stats['time'] / stats['calls'] if stats['calls'] else 0.0
+        return stats
+
+
+class PluginRegistry:
+    # The plugins ("<path>/<name>/plugin.py" with a `Plugin` class) whose
+    # functions the actions use as custom handlers, and only those: each is
+    # imported and built (`Plugin(owner)`) when first needed, or all at
+    # once by `load`. `preload` only imports them: a supervisor does it
+    # before forking, so workers share the modules' memory.
+    #
+    # Plugins may have `warm_up()`, called once built, and `close()`,
+    # called by `close`.
+
+    def __init__(self, paths, handler_names, owner=None):
+        self.paths = list(paths)
+        self.handler_names = tuple(handler_names)
+        self.owner = owner
+        self.plugins = {}  # name: Plugin instance
+        self.handlers = {}  # "plugin.function": bound method
+        self.stats = {name: HandlerStats() for name in self.handler_names}
+        self.lock = threading.RLock()
+
+    @classmethod
+    def from_config(cls, compiled_actions, config, owner=None):
+        custom_handlers = config.get('custom_handlers', None) or {}
+        return cls(custom_handlers.get('paths', []), get_referenced_handlers(compiled_actions), owner)
+
+    def add_path(self, path):
+        if path not in self.paths:
+            self.paths.append(path)
+
+    @property
+    def plugin_names(self):
+        return tuple({name.split('.')[0]: None for name in self.handler_names})
+
+    def preload(self):
+        for plugin_name in self.plugin_names:
+            import_plugin_module(self.paths, plugin_name)
+
+    def get_plugin(self, plugin_name):
+        plugin = self.plugins.get(plugin_name, None)
+        if plugin is not None:
+            return plugin
+
+        with self.lock:
+            plugin = self.plugins.get(plugin_name, None)
+            if plugin is None:
+                module = import_plugin_module(self.paths, plugin_name)
+                plugin_class = getattr(module, 'Plugin', None)
+                if plugin_class is None:
+                    raise ImportError('Plugin "{}" has no Plugin class'.format(plugin_name))
+                plugin = plugin_class(self.owner)
+                warm_up = getattr(plugin, 'warm_up', None)
+                if warm_up is not None:
+                    warm_up()
+                self.plugins[plugin_name] = plugin
+        return plugin
+
+    def get_handler(self, name):
+        handler = self.handlers.get(name, None)
+        if handler is None:
+            plugin_name, function_name = name.split('.')
+            handler = self.handlers[name] = getattr(self.get_plugin(plugin_name), function_name)
+        return handler
+
+    def load(self):
+        for name in self.handler_names:
+            self.get_handler(name)
+
+    def record_call(self, name, elapsed, failed=False):
+        stats = self.stats.get(name, None)
+        if stats is None:
+            with self.lock:
+                stats = self.stats.setdefault(name, HandlerStats())
+        stats.record_call(elapsed, failed)
+
+    def get_stats(self):
+        return {name: stats.as_dict() for name, stats in list(self.stats.items())}
+
+    def close(self):
+        # Closed plugins are forgotten (built again if needed), so closing
+        # twice doesn't close them twice.
+        with self.lock:
+            plugins = list(self.plugins.values())
+            self.plugins.clear()  # Not a new dict: it's the dequeuer's `custom_handlers` too.
+            self.handlers.clear()
+        for plugin in plugins:
+            close = getattr(plugin, 'close', None)
+            if close is not None:
+                close()
+
+    def __len__(self):
+        return len(self.plugins)
@@ -0,0 +1,360 @@
+from argparse import ArgumentParser
+from collections import Counter
+from urllib.parse import urlsplit, urlunsplit
+import json
+import sys
+import threading
+import time
+
+import requests
+
+from . import DequeueToAPI
+from .compiler import read_config_file
+from .instrumentation import Metrics
+
+
+# Replays recorded messages through DequeueToAPI offline: routing,
+# accumulation, templating and all, with GETs answered from recorded
+# responses (or stubbed) and writes recorded instead of sent (or sent to
+# a local stub API).
+#
+#   dequeue-to-api-replay config.json messages.jsonl --responses gets.json --output writes.jsonl
+#   dequeue-to-api-replay config.json messages.jsonl --compare new-config.json
+
+MISSING_RESPONSES = (
+    'empty',  # `{"results": []}`: the accumulation finds nothing.
+    'error',  # A 404: the action fails.
+)
+EMPTY_RESPONSE = {'results': []}
+WRITE_METHODS = ('post', 'patch', 'put', 'delete')
+
+
+def read_messages(path):
+    # JSONL: {"topic": "...", "body": {...} or "...", "id": "..."} per line.
+    messages = []
+    with open(path) as messages_file:
+        for line_number, line in enumerate(messages_file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                messages.append(ReplayMessage(
+                    record['topic'], record['body'], record.get('id', None) or 'replay-{}'.format(line_number)
+                ))
+            except (ValueError, KeyError, TypeError) as ex:
+                raise ValueError('{}:{}: invalid message ({})'.format(path, line_number, ex))
+    return messages
+
+
+def read_responses(path):
+    # JSON: {"<url>": <response body>, ...}
+    with open(path) as responses_file:
+        responses = json.load(responses_file)
+    if not isinstance(responses, dict):
+        raise ValueError('{}: must be an object of URLs to response bodies'.format(path))
+    return responses
+
+
+class ReplayMessage:
+    # What DequeueToAPI needs of an SQS message.
+
+    def __init__(self, topic, body, message_id):
+        self.topic = topic
+        self.body = body if isinstance(body, str) else json.dumps(body)
+        self.message_id = message_id
+        self.message_attributes = {'topic': {'StringValue': topic}}
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+    def change_visibility(self, **kwargs):
+        pass
+
+
+class ReplayResponse:
+    def __init__(self, url, body=None, status_code=200):
+        self.url = url
+        self.status_code = status_code
+        self.content = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.encoding = 'utf-8'
+        self.headers = {'Content-Type': 'application/json'}
+        self.links = {}
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('{} for {} (replay)'.format(self.status_code, self.url), response=self)
+
+
+class ReplayTransport:
+    # Stands for the `requests` module (see `DequeueToAPI.load_request_methods`).
+    # Writes are attributed to `current_message`, the one being replayed:
+    # coalesced writes, sent later, go to whichever message is current then.
+
+    def __init__(self, responses=None, missing='empty', send_to=None):
+        self.responses = responses or {}
+        self.missing = missing
+        self.send_to = urlsplit(send_to) if send_to else None
+        self.writes = []
+        self.gets = 0
+        self.unrecorded_gets = Counter()
+        self.current_message = None
+        self.lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        with self.lock:
+            self.gets += 1
+            if url in self.responses:
+                return ReplayResponse(url, self.responses[url])
+            self.unrecorded_gets[url] += 1
+        if self.missing == 'error':
+            return ReplayResponse(url, status_code=404)
+        return ReplayResponse(url, EMPTY_RESPONSE)
+
+    def write(self, method, url, **kwargs):
+        body = kwargs.get('json', None)
+        if body is None and kwargs.get('data', None) is not None:
+            body = json.loads(kwargs['data'])
+        self.record({'method': method.upper(), 'url': url, 'body': body})
+
+        if self.send_to is None:
+            return ReplayResponse(url, {})
+        parts = urlsplit(url)._replace(scheme=self.send_to.scheme, netloc=self.send_to.netloc)
+        return requests.request(method, urlunsplit(parts), timeout=10, **kwargs)
+
+    def record_handler(self, name, action, topic, payload):
+        # Custom handlers aren't run: what they would be called with is
+        # recorded, as a planned write.
+        self.record({'handler': name, 'topic': topic, 'payload': payload})
+
+    def record(self, write):
+        message = self.current_message
+        write = {
+            'message': message.message_id if message is not None else None,
+            'topic': message.topic if message is not None else None,
+            **write,
+        }
+        with self.lock:
+            self.writes.append(write)
+
+    def __getattr__(self, name):
+        if name in WRITE_METHODS:
+            return lambda url, **kwargs: self.write(name, url, **kwargs)
+        raise AttributeError(name)
+
+
+class ReplayDequeuer(DequeueToAPI):
+    # A DequeueToAPI that never touches SQS, with metrics always on (for
+    # the per-action report) and, unless `run_handlers`, custom handlers
+    # recorded instead of run (their plugins aren't even imported).
+
+    def __init__(self, config_data, transport, run_handlers=False):
+        self.transport = transport
+        self.run_handlers = run_handlers
+        super().__init__(
+            config_data, 'REPLAY',
+            process_pool_size=0,
+            thread_pool_size=0,
+            aws_access_key_id='REPLAY',
+            aws_secret_access_key='REPLAY',
+            aws_region='REPLAY'
+        )
+        if self.acknowledgements is not None:
+            self.acknowledgements.close()
+            self.acknowledgements = None
+        if not self.metrics.enabled:
+            self.metrics = Metrics()
+        self.load_request_methods(transport)
+
+    def get_custom_handler(self, name):
+        if self.run_handlers:
+            return super().get_custom_handler(name)
+        return lambda action, topic, payload: self.transport.record_handler(name, action, topic, payload)
+
+
+def get_histogram_counts(metrics, name, label):
+    counts = Counter()
+    for (metric_name, labels), histogram in list(metrics.histograms.items()):
+        if metric_name == name:
+            labels = dict(labels)
+            counts[(labels.get(label, ''), labels.get('result', None))] += histogram.count
+    return counts
+
+
+def get_actions_report(dequeuer):
+    metrics = dequeuer.metrics
+    actions = {
+        action_name: {'runs': 0, 'failed': 0, 'gets': 0, 'entries': 0, 'writes': 0}
+        for action_name in dequeuer.compiled_actions
+    }
+
+    for (action_name, result), count in get_histogram_counts(metrics, 'action_seconds', 'action').items():
+        actions[action_name]['runs'] += count
+        if result == 'failed':
+            actions[action_name]['failed'] += count
+    for (action_name, _), count in get_histogram_counts(metrics, 'accumulation_request_seconds', 'action').items():
+        actions[action_name]['gets'] += count
+    for (action_name, _), count in get_histogram_counts(metrics, 'http_request_seconds', 'action').items():
+        if action_name in actions:
+            actions[action_name]['writes'] += count
+    handler_calls = get_histogram_counts(metrics, 'custom_handler_seconds', 'handler')
+    for action_name, action in actions.items():
+        action['entries'] = metrics.get_counter('entries_hydrated', action=action_name)
+        for name in dequeuer.compiled_actions[action_name].custom_handlers:
+            action['writes'] += handler_calls[(name, None)]
+    return actions
+
+
+def replay(config_data, messages, responses=None, missing='empty', send_to=None, run_handlers=False):
+    # Returns (planned writes, report).
+    transport = ReplayTransport(responses, missing, send_to)
+    dequeuer = ReplayDequeuer(config_data, transport, run_handlers)
+
+    errors = {}
+    handled = 0
+    started = time.perf_counter()
+    try:
+        for message in messages:
+            transport.current_message = message
+            try:
+                handled += dequeuer.parse_and_handle_message(message)
+            except Exception as ex:
+                errors[message.message_id] = '{}: {}'.format(ex.__class__.__name__, ex)
+        elapsed = time.perf_counter() - started
+    finally:
+        transport.current_message = None
+        dequeuer.shutdown()  # Coalesced writes still pending are sent.
+
+    report = {
+        'messages': len(messages),
+        'handled': handled,
+        'failed': len(messages) - handled,
+        'errors': errors,
+        'elapsed': round(elapsed, 3),
+        'messages_per_second': round(len(messages) / elapsed, 1) if elapsed else 0.0,
+        'gets': transport.gets,
+        'unrecorded_gets': sum(transport.unrecorded_gets.values()),
+        'writes': len(transport.writes),
+        'actions': get_actions_report(dequeuer),
+    }
+    return transport.writes, report
+
+
+def get_write_key(write):
+    return json.dumps({key: value for key, value in write.items() if key != 'message'}, sort_keys=True)
+
+
+def diff_writes(writes, other_writes):
+    # Per message: the writes only the first replay planned ("removed")
+    # and the ones only the second did ("added"), whatever their order.
+    by_message = {}
+    for index, replay_writes in enumerate((writes, other_writes)):
+        for write in replay_writes:
+            counters = by_message.setdefault(write['message'], (Counter(), Counter()))
+            counters[index][get_write_key(write)] += 1
+
+    diff = []
+    for message_id, (before, after) in by_message.items():
+        removed = sorted((before - after).elements())
+        added = sorted((after - before).elements())
+        if removed or added:
+            diff.append({
+                'message': message_id,
+                'removed': [json.loads(key) for key in removed],
+                'added': [json.loads(key) for key in added],
+            })
+    return diff
+
+
+def write_jsonl(path, records):
+    with open(path, 'w') as output_file:
+        for record in records:
+            output_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def print_report(name, report, file=None):
+    print('{}: {} messages ({} handled, {} failed) in {}s: {} msg/s, {} GETs ({} unrecorded), {} writes'.format(
+        name, report['messages'], report['handled'], report['failed'], report['elapsed'],
+        report['messages_per_second'], report['gets'], report['unrecorded_gets'], report['writes']
+    ), file=file)
+    print('  {:<30} {:>7} {:>7} {:>7} {:>8} {:>7}'.format('action', 'runs', 'failed', 'GETs', 'entries', 'writes'),
+          file=file)
+    for action_name, action in sorted(report['actions'].items()):
+        print('  {:<30} {:>7} {:>7} {:>7} {:>8} {:>7}'.format(
+            action_name, action['runs'], action['failed'], action['gets'], action['entries'], action['writes']
+        ), file=file)
+    for message_id, error in report['errors'].items():
+        print('  error: message {}: {}'.format(message_id, error), file=file)
+
+
+def print_diff(diff, file=None):
+    for message_diff in diff:
+        print('message {}:'.format(message_diff['message']), file=file)
+        for write in message_diff['removed']:
+            print('  - {}'.format(json.dumps(write, sort_keys=True)), file=file)
+        for write in message_diff['added']:
+            print('  + {}'.format(json.dumps(write, sort_keys=True)), file=file)
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        prog='dequeue-to-api-replay',
+        description='Replay recorded messages through a DequeueToAPI config, without SQS nor the real API.'
+    )
+    parser.add_argument('config_file', help='JSON, or YAML (with PyYAML installed).')
+    parser.add_argument('messages_file', help='JSONL: {"topic": ..., "body": ..., "id": ...} per line.')
+    parser.add_argument('--responses', help='JSON: {"<url>": <response body>} for the accumulation GETs.')
+    parser.add_argument('--missing', choices=MISSING_RESPONSES, default='empty',
+                        help='What GETs of URLs not in --responses get.')
+    parser.add_argument('-o', '--output', help='Where to save the planned writes (JSONL).')
+    parser.add_argument('--send-to', help='Send the writes to this (stub) API, e.g. http://127.0.0.1:8000.')
+    parser.add_argument('--run-handlers', action='store_true', help='Run the custom handlers instead of recording them.')
+    parser.add_argument('--compare', metavar='OTHER_CONFIG_FILE',
+                        help='Replay with this config too, and show how the planned writes differ.')
+    parser.add_argument('--json', action='store_true', help='Print the report (and diff) as JSON.')
+    args = parser.parse_args(argv)
+
+    try:
+        config_files = [args.config_file] + ([args.compare] if args.compare else [])
+        configs = [read_config_file(path) for path in config_files]
+        messages = read_messages(args.messages_file)
+        responses = read_responses(args.responses) if args.responses else None
+    except (OSError, ValueError, ImportError) as ex:
+        print(ex, file=sys.stderr)
+        return 2
+
+    results = []
+    for config_data in configs:
+        try:
+            results.append(replay(
+                config_data, messages, responses, args.missing, args.send_to, args.run_handlers
+            ))
+        except ValueError as ex:  # ConfigError included.
+            print(ex, file=sys.stderr)
+            return 2
+
+    writes, report = results[0]
+    if args.output:
+        write_jsonl(args.output, writes)
+
+    diff = diff_writes(writes, results[1][0]) if args.compare else None
+    if args.json:
+        output = {'reports': dict(zip(config_files, [result[1] for result in results]))}
+        if diff is not None:
+            output['diff'] = diff
+        print(json.dumps(output, indent=2, sort_keys=True))
+    else:
+        for path, (_, config_report) in zip(config_files, results):
+            print_report(path, config_report)
+        if diff is not None:
+            print_diff(diff)
+            print('{} messages with different writes'.format(len(diff)))
+    return 1 if diff else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import datetime
+import random
+import threading
+import time
+
+import requests
+
+
+DEFAULT_RETRY = {
+    'max_attempts': 1,  # 1: no retries at all.
+    'backoff': 0.5,  # Seconds before the first retry, doubled on each one...
+    'max_backoff': 30,  # ...up to this.
+    'jitter': True,  # Sleep a random time between 0 and the backoff.
+    'statuses': (429, 500, 502, 503, 504),
+    'retry_after': True,  # Honor `Retry-After` (up to `max_backoff`).
+    'circuit_breaker': False,  # On by default if the config has a `circuit_breaker`.
+}
+
+DEFAULT_CIRCUIT_BREAKER = {
+    'failure_threshold': 5,  # Consecutive failures opening the circuit...
+    'reset_timeout': 30,  # ...for this many seconds.
+}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, host, retry_in):
+        super().__init__('Circuit open for {} (retry in {:.1f}s)'.format(host, retry_in))
+        self.host = host
+        self.retry_in = retry_in
+
+
+def parse_retry(action_name, retry, defaults=None):
+    retry = {**DEFAULT_RETRY, **(defaults or {}), **(retry or {})}
+    if not isinstance(retry['max_attempts'], int) or retry['max_attempts'] < 1:
+        raise ValueError('Action "{}": retry max_attempts must be a positive integer'.format(action_name))
+    retry['statuses'] = frozenset(retry['statuses'])
+    return retry
+
+
+def parse_circuit_breaker(options):
+    # `"circuit_breaker": true` or `{"failure_threshold": 3}` in the config.
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    return {**DEFAULT_CIRCUIT_BREAKER, **options}
+
+
+def get_retry_defaults(config):
+    # The config's `retry`, with the circuit breakers on if it has a
+    # `circuit_breaker` (an action's `retry` can still turn them off).
+    defaults = dict(config.get('retry', None) or {})
+    if config.get('circuit_breaker', None):
+        defaults.setdefault('circuit_breaker', True)
+    return defaults
+
+
+def get_response(ex):
+    return getattr(ex, 'response', None)
+
+
+def is_retryable(ex, retry):
+    if isinstance(ex, (requests.ConnectionError, requests.Timeout)):
+        return True
+
+    response = get_response(ex)
+    return response is not None and getattr(response, 'status_code', None) in retry['statuses']
+
+
+def get_retry_after(response):
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Retry-After', None)
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((date - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+
+def get_delay(attempt, ex, retry, random_function=random.random):
+    # `attempt` is the number of the attempt that just failed (1, 2, ...).
+    if retry['retry_after']:
+        retry_after = get_retry_after(get_response(ex))
+        if retry_after is not None:
+            return min(retry_after, retry['max_backoff'])
+
+    delay = min(retry['backoff'] * 2 ** (attempt - 1), retry['max_backoff'])
+    if retry['jitter']:
+        delay *= random_function()
+    return delay
+
+
+def get_host(url):
+    parts = urlsplit(url)
+    return '{}://{}'.format(parts.scheme, parts.netloc)
+
+
+class CircuitBreaker:
+    # Closed: requests go through. After `failure_threshold` consecutive
+    # failures it opens, failing fast for `reset_timeout` seconds; then a
+    # single trial request is let through (half-open), closing the circuit
+    # if it works and reopening it otherwise.
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_request(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half-open' and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+            retry_in = max(self.reset_timeout - (self.clock() - self.opened_at), 0.0)
+            raise CircuitOpenError(self.host, retry_in or self.reset_timeout)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self.trial_in_flight = False
+
+
+class CircuitBreakers:
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        host = get_host(url)
+        breaker = self.breakers.get(host, None)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(
+                    host, CircuitBreaker(host, self.failure_threshold, self.reset_timeout, self.clock)
+                )
+        return breaker
+
+
+def call_with_retry(function, retry, breaker=None, sleep=time.sleep):
+    attempt = 0
+    while True:
+        attempt += 1
+        if breaker is not None:
+            breaker.before_request()
+
+        try:
+            result = function()
+        except Exception as ex:
+            retryable = is_retryable(ex, retry)
+            if breaker is not None:
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()  # The host answered.
+            if not retryable or attempt >= retry['max_attempts']:
+                raise
+            sleep(get_delay(attempt, ex, retry))
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            return result
@@ -0,0 +1,203 @@
+from collections import OrderedDict
+import re
+import string
+import threading
+
+
+REGEX_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+NAMED_GROUP_RE = re.compile(r'\(\?P<[^>]+>')
+UNPREFILTERABLE_RE = re.compile(r'\(\?P=|\\[1-9]|\(\?[aiLmsux]')
+
+
+def is_literal(pattern):
+    return not any(char in REGEX_METACHARACTERS for char in pattern)
+
+
+def as_prefilter_alternative(pattern):
+    # The alternation only tells us *which* topic matched, so named groups
+    # become non-capturing ones (their values are recovered later from the
+    # topic's own compiled pattern). Backreferences and inline flags can't
+    # survive that.
+    if UNPREFILTERABLE_RE.search(pattern):
+        return None
+    return '({})'.format(NAMED_GROUP_RE.sub('(?:', pattern))
+
+
+def get_template_fields(template):
+    fields = []
+    for _, field_name, format_spec, conversion in string.Formatter().parse(template):
+        if field_name is None:
+            continue
+
+        field = field_name
+        if conversion:
+            field += '!' + conversion
+        if format_spec:
+            field += ':' + format_spec
+        fields.append('{' + field + '}')
+    return fields
+
+
+class TopicRouter:
+    LITERAL = 'literal'
+    REGEX = 'regex'
+    TEMPLATE = 'template'
+
+    def __init__(self, topic_names, config, cache_size=1024):
+        self.topic_names = list(topic_names)
+        self.config = config
+        self.cache_size = cache_size
+
+        self.literals = {}
+        self.literal_lengths = []
+        self.regexes = []
+        self.isolated_regexes = []
+        self.templates = []
+        self.kinds = {}
+
+        self.prefilters = {}
+        self.template_routers = OrderedDict()
+        self.lock = threading.Lock()  # For `template_routers`, shared by the worker threads.
+
+        for index, topic_name in enumerate(self.topic_names):
+            try:
+                expanded = topic_name.format(config=self.config)
+            except (KeyError, IndexError, AttributeError):
+                # Depends on the message payload: must be expanded per message.
+                self.kinds[topic_name] = self.TEMPLATE
+                self.templates.append((index, topic_name))
+            else:
+                self.kinds[topic_name] = self.add_expanded(index, expanded)
+
+        self.literal_lengths = sorted(set(len(literal) for literal in self.literals))
+
+        # All the payload-dependent parts of every templated topic, in one
+        # string: rendering it tells which (cached) expansion of the
+        # templated topics applies to a given message.
+        template_fields = OrderedDict()
+        for _, topic_name in self.templates:
+            for field in get_template_fields(topic_name):
+                template_fields[field] = True
+        self.templates_key = '\x00'.join(template_fields)
+
+    @classmethod
+    def from_expanded(cls, patterns):
+        router = cls((), {})
+        for index, pattern in enumerate(patterns):
+            router.add_expanded(index, pattern)
+        router.literal_lengths = sorted(set(len(literal) for literal in router.literals))
+        return router
+
+    def add_expanded(self, index, expanded):
+        if is_literal(expanded):
+            self.literals.setdefault(expanded, []).append(index)
+            return self.LITERAL
+
+        compiled = re.compile(expanded)
+        alternative = as_prefilter_alternative(expanded)
+        if alternative is None:
+            self.isolated_regexes.append((index, compiled))
+        else:
+            alternative_groups = re.compile(alternative).groups
+            self.regexes.append((index, compiled, alternative, alternative_groups))
+        return self.REGEX
+
+    def get_prefilter(self, start):
+        # Alternation of every prefilterable regex from `start` onwards.
+        # Each alternative is wrapped in its own group, and that group is
+        # the last one to close, so `lastindex` identifies the first
+        # alternative that matched.
+        prefilter = self.prefilters.get(start, None)
+        if prefilter is None:
+            alternatives = []
+            positions = {}
+            group_number = 1
+            for position in range(start, len(self.regexes)):
+                _, _, alternative, alternative_groups = self.regexes[position]
+                alternatives.append(alternative)
+                positions[group_number] = position
+                group_number += alternative_groups
+
+            prefilter = (re.compile('|'.join(alternatives)), positions)
+            self.prefilters[start] = prefilter
+        return prefilter
+
+    def __getstate__(self):
+        # Pickled (in compiled configs) without the lock and the cache.
+        state = dict(self.__dict__)
+        del state['lock']
+        state['template_routers'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_template_router(self, payload):
+        key = self.templates_key.format(config=self.config, payload=payload)
+
+        with self.lock:
+            router = self.template_routers.get(key, None)
+            if router is not None:
+                self.template_routers.move_to_end(key)
+                return router
+
+        router = self.from_expanded(
+            topic_name.format(config=self.config, payload=payload)
+            for _, topic_name in self.templates
+        )
+        with self.lock:
+            self.template_routers[key] = router
+            if len(self.template_routers) > self.cache_size:
+                self.template_routers.popitem(last=False)
+        return router
+
+    def match_literals(self, topic):
+        # `re.match` semantics: a literal topic matches any topic it prefixes.
+        topic_length = len(topic)
+        for length in self.literal_lengths:
+            if length > topic_length:
+                break
+            indexes = self.literals.get(topic[:length], None)
+            if indexes:
+                for index in indexes:
+                    yield index, {}
+
+    def match_regexes(self, topic):
+        start = 0
+        total = len(self.regexes)
+        while start < total:
+            prefilter, positions = self.get_prefilter(start)
+            prefilter_match = prefilter.match(topic)
+            if prefilter_match is None:
+                break
+
+            position = positions[prefilter_match.lastindex]
+            index, compiled, _, _ = self.regexes[position]
+            yield index, compiled.match(topic).groupdict()
+            start = position + 1
+
+        for index, compiled in self.isolated_regexes:
+            match = compiled.match(topic)
+            if match:
+                yield index, match.groupdict()
+
+    def match_expanded(self, topic):
+        matches = []
+        matches.extend(self.match_literals(topic))
+        matches.extend(self.match_regexes(topic))
+        return matches
+
+    def match_templates(self, topic, payload):
+        if not self.templates:
+            return
+
+        for position, topic_groups in self.get_template_router(payload).match_expanded(topic):
+            yield self.templates[position][0], topic_groups
+
+    def route(self, topic, payload):
+        matches = self.match_expanded(topic)
+        matches.extend(self.match_templates(topic, payload))
+        matches.sort(key=lambda item: item[0])
+
+        return [(self.topic_names[index], topic_groups) for index, topic_groups in matches]
@@ -0,0 +1,98 @@
+from .instrumentation import Stats
+
+
+def get_dependencies(action_data):
+    depends_on = action_data.get('depends_on', None) or ()
+    if isinstance(depends_on, str):
+        depends_on = (depends_on,)
+    return tuple(depends_on)
+
+
+def check_dependencies(compiled_actions):
+    # Unknown names and cycles are configuration errors, better found when
+    # loading the config than when a message happens to trigger them.
+    for action_name, compiled_action in compiled_actions.items():
+        for dependency in compiled_action.depends_on:
+            if dependency not in compiled_actions:
+                raise ValueError('Action "{}" depends on unknown action "{}"'.format(action_name, dependency))
+
+    checked = set()
+
+    def visit(action_name, path):
+        if action_name in path:
+            cycle = path[path.index(action_name):] + (action_name,)
+            raise ValueError('Actions dependency cycle: {}'.format(' -> '.join(cycle)))
+        if action_name in checked:
+            return
+        for dependency in compiled_actions[action_name].depends_on:
+            visit(dependency, path + (action_name,))
+        checked.add(action_name)
+
+    for action_name in compiled_actions:
+        visit(action_name, ())
+
+
+class ActionScheduler:
+    # Hands out the actions matched by one message as soon as all their
+    # dependencies (among the matched actions; the others are ignored)
+    # have succeeded, keeping the matching order otherwise.
+
+    def __init__(self, matched_actions):
+        names = {compiled_action.name for compiled_action, _ in matched_actions}
+        self.pending = [
+            (compiled_action, topic_groups, {name for name in compiled_action.depends_on if name in names})
+            for compiled_action, topic_groups in matched_actions
+        ]
+        self.succeeded = set()
+
+    def ready(self, limit=None):
+        ready = []
+        pending = []
+        for item in self.pending:
+            compiled_action, topic_groups, dependencies = item
+            if (limit is None or len(ready) < limit) and dependencies <= self.succeeded:
+                ready.append((compiled_action, topic_groups))
+            else:
+                pending.append(item)
+        self.pending = pending
+        return ready
+
+    def succeed(self, action_name):
+        self.succeeded.add(action_name)
+
+    def ordered(self):
+        # Serial execution: a stable topological order.
+        while self.pending:
+            ready = self.ready()
+            if not ready:
+                return
+            for compiled_action, topic_groups in ready:
+                yield compiled_action, topic_groups
+                self.succeed(compiled_action.name)
+
+    def __bool__(self):
+        return bool(self.pending)
+
+
+class ExecutionStats(Stats):
+    # `wall_time` is how long messages took to be handled, `actions_time`
+    # the sum of how long each of their actions took: the closer their
+    # ratio is to the number of actions per message, the more they overlap.
+    COUNTERS = ('messages', 'actions', 'failures', 'wall_time', 'actions_time')
+
+    def record_action(self, elapsed, failed=False):
+        with self.lock:
+            self.counters['actions'] += 1
+            self.counters['actions_time'] += elapsed
+            if failed:
+                self.counters['failures'] += 1
+
+    def record_message(self, elapsed):
+        with self.lock:
+            self.counters['messages'] += 1
+            self.counters['wall_time'] += elapsed
+
+    def as_dict(self):
+        stats = super().as_dict()
+        stats['parallelism'] = stats['actions_time'] / stats['wall_time'] if stats['wall_time'] else 0.0
+        return stats
@@ -0,0 +1,96 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+DEFAULT_SERIALIZATION = {
+    'backend': 'auto',  # "auto" (orjson if installed), "orjson", "json" or a registered name.
+    'encode_writes': False,  # Send writes as bytes encoded once, instead of `json=`.
+}
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+class JSONSerializer:
+    name = 'json'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonSerializer:
+    # Anything orjson can't encode or decode (integers beyond 64 bits,
+    # NaN and Infinity, mostly) goes through the standard library instead.
+    name = 'orjson'
+    options = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+    def __init__(self):
+        self.fallback = JSONSerializer()
+
+    def loads(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return self.fallback.loads(data)
+
+    def dumps(self, value):
+        try:
+            return orjson.dumps(value, option=self.options)
+        except orjson.JSONEncodeError:
+            return self.fallback.dumps(value)
+
+
+SERIALIZERS = {'json': JSONSerializer}
+if orjson is not None:
+    SERIALIZERS['orjson'] = OrjsonSerializer
+
+
+def register_serializer(name, serializer_class):
+    # Any class with `loads(str or bytes)` and `dumps(value) -> bytes`.
+    SERIALIZERS[name] = serializer_class
+
+
+def get_serializer(backend='auto'):
+    if backend == 'auto':
+        backend = 'orjson' if 'orjson' in SERIALIZERS else 'json'
+    try:
+        return SERIALIZERS[backend]()
+    except KeyError:
+        raise ValueError('Unknown (or not installed) serialization backend "{}"'.format(backend))
+
+
+def parse_serialization(config):
+    # config['serialization'] = {"backend": "orjson", "encode_writes": true}
+    return {**DEFAULT_SERIALIZATION, **(config or {})}
+
+
+def decode_response(serializer, response):
+    # The body of a `requests.Response` (or an `AsyncResponse`), decoded by
+    # `serializer` when it's UTF-8 (JSON's default, and orjson's only)
+    # and through `response.json()` otherwise.
+    content = getattr(response, 'content', None)
+    if isinstance(content, (bytes, str)):
+        encoding = getattr(response, 'encoding', None)
+        if not encoding or encoding.lower().replace('-', '') == 'utf8':
+            try:
+                return serializer.loads(content)
+            except ValueError:
+                pass
+    return response.json()
+
+
+def project_fields(results, fields):
+    # Keeps only `fields` of each (dict) result, so big API responses don't
+    # stay in memory, through the accumulation entries and caches, for the
+    # few values templates use.
+    if not fields:
+        return results
+    return [
+        {field: result[field] for field in fields if field in result} if isinstance(result, dict) else result
+        for result in results
+    ]
@@ -0,0 +1,71 @@
+from urllib.parse import urlsplit
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool:
+    # One `requests.Session` (and so one urllib3 connection pool) per base
+    # host. Sessions are only configured when created, and never mutated
+    # afterwards, so they can be shared by all the dequeuer threads.
+
+    def __init__(self, headers=None, pool_connections=10, pool_maxsize=10, keep_alive=True, timeout=None,
+                 session_factory=requests.Session):
+        self.headers = headers
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.session_factory = session_factory
+
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_headers(self):
+        headers = self.headers() if callable(self.headers) else self.headers
+        headers = dict(headers or {})
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+        return headers
+
+    def create_session(self):
+        session = self.session_factory()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(self.get_headers())
+        return session
+
+    def get_session(self, url):
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+
+        session = self.sessions.get(host, None)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(host, None)
+                if session is None:
+                    session = self.create_session()
+                    self.sessions[host] = session
+        return session
+
+    def request(self, method_name, url, **kwargs):
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+        return self.get_session(url).request(method_name.upper(), url, **kwargs)
+
+    def update_headers(self, headers):
+        # Sessions in use by other threads are left alone (and to the garbage
+        # collector): new ones are created with the new headers.
+        with self.lock:
+            self.headers = headers
+            self.sessions = {}
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+
+        for session in sessions:
+            session.close()
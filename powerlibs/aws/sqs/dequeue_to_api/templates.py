@@ -0,0 +1,384 @@
+from functools import partial
+import re
+import string
+
+from .expressions import ExpressionError, bind_expression, compile_expression, evaluate_source
+
+
+COERCION_PREFIXES = ('INT:', 'DICT:', 'EVAL:')
+OPTIONAL_PREFIX = 'OPTIONAL:'
+EXPRESSION_PREFIX = 'EXPR:'
+UNKNOWN = object()
+
+
+def coerce_int(value):
+    return int(value.replace('INT:', ''))
+
+
+def coerce_dict(value):
+    return dict(value.replace('DICT:', ''))
+
+
+def coerce_eval(value):
+    return evaluate_source(value.replace('EVAL:', ''))
+
+
+COERCIONS = {
+    'INT:': coerce_int,
+    'DICT:': coerce_dict,
+    'EVAL:': coerce_eval,
+}
+
+
+def coerce_dynamically(value):
+    for prefix in COERCION_PREFIXES:
+        if value.startswith(prefix):
+            return COERCIONS[prefix](value)
+    return value
+
+
+def get_known_coercion(leading_text, has_fields):
+    # The coercion prefix is checked on the *rendered* value, so it's only
+    # known beforehand if the template's leading literal text decides it.
+    for prefix in COERCION_PREFIXES:
+        if leading_text.startswith(prefix):
+            return COERCIONS[prefix]
+
+    if not has_fields:
+        return None
+
+    for prefix in COERCION_PREFIXES:
+        if prefix.startswith(leading_text):
+            return UNKNOWN
+
+    return None
+
+
+SPECIAL_VARIABLES = ('_topic', '_topic_groups', '_action')
+
+
+FIELD_NAME_FIRST = re.compile(r'[^.[]*')
+FIELD_NAME_STEP = re.compile(r'\.([^.[]+)|\[([^\]]+)\]')
+
+
+def split_field_name(field_name):
+    # "payload[items][0].id" -> ("payload", [(False, "items"), (False, 0), (True, "id")]),
+    # as `str.format` reads it; None if it can't.
+    first = FIELD_NAME_FIRST.match(field_name).group()
+    rest = []
+    position = len(first)
+    while position < len(field_name):
+        match = FIELD_NAME_STEP.match(field_name, position)
+        if match is None:
+            return None
+        attribute, key = match.groups()
+        if attribute is not None:
+            rest.append((True, attribute))
+        else:
+            rest.append((False, int(key) if key.isdecimal() else key))
+        position = match.end()
+    return first, rest
+
+
+def compile_field_path(field_name):
+    split = split_field_name(field_name)
+    if split is None or not split[0] or split[0].isdecimal():
+        # Positional (or broken) fields: leave it to `str.format` (and its errors).
+        return None
+    first, rest = split
+    return first, tuple(rest)
+
+
+def compile_field_renderer(path, conversion, format_spec):
+    first, steps = path
+    special = first in SPECIAL_VARIABLES
+    keys = tuple(key for is_attribute, key in steps)
+    only_items = not any(is_attribute for is_attribute, key in steps)
+
+    if only_items and not special and not conversion:
+        # The usual "{payload[id]}" case.
+        def render_entry_field(specials, entry):
+            value = entry[first]
+            for key in keys:
+                value = value[key]
+            return format(value, format_spec)
+
+        return render_entry_field
+
+    def render_field(specials, entry):
+        value = specials[first] if special else entry[first]
+        if only_items:
+            for key in keys:
+                value = value[key]
+        else:
+            for is_attribute, key in steps:
+                if is_attribute:
+                    value = getattr(value, key)
+                else:
+                    value = value[key]
+
+        if conversion == 's':
+            value = str(value)
+        elif conversion == 'r':
+            value = repr(value)
+        elif conversion == 'a':
+            value = ascii(value)
+
+        return format(value, format_spec)
+
+    return render_field
+
+
+def check_eval_source(parts):
+    # An "EVAL:" template evaluated with its fields substituted, as text:
+    # the expression error it would fail with on every message, if any
+    # (with its fields as "1", for the sake of the check).
+    source = ''.join(part if part.__class__ is str else '1' for part in parts)
+    try:
+        compile_expression(source.replace('EVAL:', ''))
+    except ExpressionError as ex:
+        return str(ex)
+    return None
+
+
+class TemplateField:
+    __slots__ = (
+        'key', 'template', 'optional', 'coercion', 'parts', 'single', 'bound', 'is_constant', 'constant', 'error'
+    )
+
+    def __init__(self, key, template):
+        self.key = key
+        self.optional = False
+        self.is_constant = False
+        self.constant = UNKNOWN
+        self.single = None
+        self.bound = None
+        self.error = None
+
+        if template.startswith(OPTIONAL_PREFIX):
+            self.optional = True
+            template = template.replace(OPTIONAL_PREFIX, '')
+        self.template = template
+
+        parts = []
+        leading_text = ''
+        has_fields = False
+        for literal_text, field_name, format_spec, conversion in string.Formatter().parse(template):
+            if not has_fields:
+                leading_text += literal_text
+            if literal_text:
+                parts.append(literal_text)
+
+            if field_name is None:
+                continue
+
+            has_fields = True
+            path = compile_field_path(field_name)
+            if path is None or '{' in format_spec:
+                parts = None
+                break
+            parts.append(compile_field_renderer(path, conversion, format_spec))
+
+        self.coercion = get_known_coercion(leading_text, has_fields)
+        self.parts = parts
+
+        if parts is not None and len(parts) == 1 and has_fields:
+            # The whole value is a single field: no joining needed.
+            self.single = parts[0]
+
+        if parts is not None and self.coercion is coerce_eval:
+            self.bound = bind_expression(parts, 'EVAL:')
+            if self.bound is None:
+                self.error = check_eval_source(parts)
+
+        # Plain text rendering to an immutable value: render (and coerce) it
+        # only once, on first use.
+        self.is_constant = parts is not None and not has_fields and self.coercion in (None, coerce_int)
+
+    def render_text(self, specials, entry):
+        if self.single is not None:
+            return self.single(specials, entry)
+
+        if self.parts is None:
+            return self.template.format(**specials, **entry)
+
+        rendered = []
+        for part in self.parts:
+            if part.__class__ is str:
+                rendered.append(part)
+            else:
+                rendered.append(part(specials, entry))
+        return ''.join(rendered)
+
+    def render(self, specials, entry):
+        if self.is_constant:
+            if self.constant is UNKNOWN:
+                self.constant = self.coerce(self.template.format())
+            return self.constant
+
+        if self.bound is not None:
+            return self.bound.evaluate(specials, entry)
+
+        return self.render_coerced(specials, entry)
+
+    def render_coerced(self, specials, entry):
+        return self.coerce(self.render_text(specials, entry))
+
+    def coerce(self, value):
+        coercion = self.coercion
+        if coercion is None:
+            return value
+        if coercion is UNKNOWN:
+            return coerce_dynamically(value)
+        return coercion(value)
+
+
+class ConstantField:
+    __slots__ = ('key', 'value', 'optional')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.optional = False
+
+    def render(self, specials, entry):
+        return self.value
+
+
+class ExpressionField:
+    # "EXPR:" values: a restricted expression where the entry's steps
+    # (`payload`, accumulators...) and `_topic`, `_topic_groups` and
+    # `_action` are variables, as in `EXPR:int(payload['count']) * 2`.
+    __slots__ = ('key', 'optional', 'expression')
+
+    def __init__(self, key, template):
+        self.key = key
+        self.optional = False
+        if template.startswith(OPTIONAL_PREFIX):
+            self.optional = True
+            template = template[len(OPTIONAL_PREFIX):]
+
+        self.expression = compile_expression(template[len(EXPRESSION_PREFIX):])
+
+    def render(self, specials, entry):
+        try:
+            return self.expression.evaluate({**entry, **specials})
+        except NameError as ex:
+            raise KeyError(str(ex))
+
+
+class PayloadTemplate:
+    def __init__(self, payload_template):
+        self.source = payload_template
+        self.fields = []
+        for key, value in payload_template.items():
+            if not isinstance(value, str):
+                self.fields.append(ConstantField(key, value))
+            elif value.startswith(EXPRESSION_PREFIX) or value.startswith(OPTIONAL_PREFIX + EXPRESSION_PREFIX):
+                self.fields.append(ExpressionField(key, value))
+            else:
+                self.fields.append(TemplateField(key, value))
+
+    @property
+    def errors(self):
+        # Problems found compiling the template that `render` would raise
+        # on every message.
+        return [
+            '"{}": {}'.format(field.key, field.error) for field in self.fields if getattr(field, 'error', None)
+        ]
+
+    def render(self, topic, topic_groups, action, payload):
+        specials = {
+            '_topic': topic,
+            '_topic_groups': topic_groups,
+            '_action': action,
+        }
+
+        hydrated_payload = {}
+        for field in self.fields:
+            try:
+                hydrated_payload[field.key] = field.render(specials, payload)
+            except KeyError as ex:
+                if field.optional:
+                    continue
+                raise ex
+        return hydrated_payload
+
+    def __reduce__(self):
+        # The compiled fields are closures: pickled as their source.
+        return compile_payload_template, (self.source,)
+
+
+def compile_payload_template(payload_template):
+    return PayloadTemplate(payload_template)
+
+
+class UrlTemplate:
+    # A `str.format` template (endpoints, accumulator URLs) compiled once:
+    # `{config[...]}` fields are rendered right away, since the config
+    # doesn't change, and the others work as in payload templates.
+
+    def __init__(self, template, config):
+        self.template = template
+        self.config = config
+        self.constant = None
+
+        parts = []
+        for literal_text, field_name, format_spec, conversion in string.Formatter().parse(template):
+            if literal_text:
+                parts.append(literal_text)
+            if field_name is None:
+                continue
+
+            path = compile_field_path(field_name)
+            if path is None or '{' in format_spec:
+                parts = None
+                break
+
+            renderer = compile_field_renderer(path, conversion, format_spec)
+            if path[0] == 'config':
+                try:
+                    parts.append(renderer({}, {'config': config}))
+                    continue
+                except (KeyError, IndexError, AttributeError, TypeError):
+                    # Left to fail on use, as it always did.
+                    renderer = partial(render_config_field, renderer, config)
+            parts.append(renderer)
+
+        if parts is not None:
+            parts = merge_literals(parts)
+            if all(part.__class__ is str for part in parts):
+                self.constant = ''.join(parts)
+        self.parts = parts
+
+    def render(self, variables):
+        if self.constant is not None:
+            return self.constant
+
+        if self.parts is None:
+            return self.template.format(config=self.config, **variables)
+
+        rendered = []
+        for part in self.parts:
+            if part.__class__ is str:
+                rendered.append(part)
+            else:
+                rendered.append(part({}, variables))
+        return ''.join(rendered)
+
+    def __reduce__(self):
+        return UrlTemplate, (self.template, self.config)
+
+
+def render_config_field(renderer, config, specials, variables):
+    return renderer(specials, {'config': config})
+
+
+def merge_literals(parts):
+    merged = []
+    for part in parts:
+        if part.__class__ is str and merged and merged[-1].__class__ is str:
+            merged[-1] += part
+        else:
+            merged.append(part)
+    return merged
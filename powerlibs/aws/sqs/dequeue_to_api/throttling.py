@@ -0,0 +1,216 @@
+import asyncio
+import threading
+import time
+
+from .instrumentation import Stats
+from .retries import get_host
+
+
+DEFAULT_AIMD = {
+    'min_rate': 1.0,
+    'max_rate': None,  # Defaults to twice the configured rate.
+    'increase': 1.0,  # Requests/s added per second of healthy responses...
+    'decrease': 0.5,  # ...and the factor applied on congestion,
+    'cooldown': 1.0,  # at most once per this many seconds.
+    'statuses': (429, 503),
+    'latency_threshold': None,  # Seconds: slower responses count as congestion.
+}
+
+
+class TokenBucket:
+    # `rate` tokens per second, up to `burst` saved. `reserve` takes a token
+    # right away, possibly going into debt, and tells how long to wait
+    # before using it, so callers can sleep however suits them.
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        with self.lock:
+            self.refill(self.clock())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill(self.clock())
+            self.rate = float(rate)
+
+
+class AIMDController:
+    # Additive increase, multiplicative decrease of a bucket's rate.
+
+    def __init__(self, bucket, min_rate=1.0, max_rate=None, increase=1.0, decrease=0.5, cooldown=1.0,
+                 statuses=(429, 503), latency_threshold=None, clock=time.monotonic):
+        self.bucket = bucket
+        self.min_rate = min_rate
+        self.max_rate = max_rate or bucket.rate * 2
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.statuses = frozenset(statuses)
+        self.latency_threshold = latency_threshold
+        self.clock = clock
+        self.last_decrease = None
+        self.lock = threading.Lock()
+
+    def is_congested(self, status_code, latency):
+        if status_code in self.statuses:
+            return True
+        return self.latency_threshold is not None and latency > self.latency_threshold
+
+    def record(self, status_code, latency):
+        congested = self.is_congested(status_code, latency)
+        with self.lock:
+            rate = self.bucket.rate
+            if congested:
+                now = self.clock()
+                if self.last_decrease is not None and now - self.last_decrease < self.cooldown:
+                    return congested
+                self.last_decrease = now
+                rate = max(self.min_rate, rate * self.decrease)
+            else:
+                rate = min(self.max_rate, rate + self.increase / rate)
+            self.bucket.set_rate(rate)
+        return congested
+
+
+class LimiterStats(Stats):
+    COUNTERS = ('requests', 'delayed', 'delay_time', 'congested')
+
+
+def get_status_code(response=None, ex=None):
+    if ex is not None:
+        response = getattr(ex, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+class HostLimiter:
+    def __init__(self, host, rate=None, burst=None, max_concurrency=None, aimd=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.host = host
+        self.clock = clock
+        self.sleep = sleep
+        self.bucket = TokenBucket(rate, burst, clock) if rate else None
+        self.max_concurrency = max_concurrency
+        self.semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self.async_semaphore = None
+
+        self.aimd = None
+        if aimd and self.bucket is not None:
+            aimd = {**DEFAULT_AIMD, **({} if aimd is True else aimd)}
+            self.aimd = AIMDController(self.bucket, clock=clock, **aimd)
+
+        self.stats = LimiterStats()
+
+    @property
+    def rate(self):
+        return self.bucket.rate if self.bucket is not None else None
+
+    def get_delay(self):
+        self.stats.increment('requests')
+        delay = self.bucket.reserve() if self.bucket is not None else 0.0
+        if delay:
+            self.stats.increment('delayed')
+            self.stats.increment('delay_time', delay)
+        return delay
+
+    def record(self, status_code, latency):
+        if self.aimd is not None and self.aimd.record(status_code, latency):
+            self.stats.increment('congested')
+
+    def call(self, function):
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        try:
+            delay = self.get_delay()
+            if delay:
+                self.sleep(delay)
+
+            started = self.clock()
+            try:
+                response = function()
+            except Exception as ex:
+                self.record(get_status_code(ex=ex), self.clock() - started)
+                raise
+            self.record(get_status_code(response), self.clock() - started)
+            return response
+        finally:
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+    async def async_call(self, coroutine_function):
+        if self.max_concurrency and self.async_semaphore is None:
+            self.async_semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        if self.async_semaphore is not None:
+            await self.async_semaphore.acquire()
+        try:
+            delay = self.get_delay()
+            if delay:
+                await asyncio.sleep(delay)
+
+            started = self.clock()
+            try:
+                response = await coroutine_function()
+            except Exception as ex:
+                self.record(get_status_code(ex=ex), self.clock() - started)
+                raise
+            self.record(get_status_code(response), self.clock() - started)
+            return response
+        finally:
+            if self.async_semaphore is not None:
+                self.async_semaphore.release()
+
+
+class RateLimiters:
+    # config['rate_limit'] = {
+    #     "rate": 50, "burst": 100, "max_concurrency": 20, "aimd": true,
+    #     "hosts": {"https://slow.example.com": {"rate": 5}}
+    # }
+    # Every base host gets its own limiter with these settings (the
+    # top-level ones being the defaults for `hosts`).
+
+    def __init__(self, config=None, clock=time.monotonic, sleep=time.sleep):
+        config = dict(config or {})
+        self.hosts_config = config.pop('hosts', {})
+        self.default_config = config
+        self.clock = clock
+        self.sleep = sleep
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def get_host_config(self, host):
+        return {**self.default_config, **self.hosts_config.get(host, {})}
+
+    def get(self, url):
+        host = get_host(url)
+        limiter = self.limiters.get(host, False)
+        if limiter is False:
+            with self.lock:
+                limiter = self.limiters.get(host, False)
+                if limiter is False:
+                    host_config = self.get_host_config(host)
+                    limiter = None
+                    if host_config.get('rate', None) or host_config.get('max_concurrency', None):
+                        limiter = HostLimiter(host, clock=self.clock, sleep=self.sleep, **host_config)
+                    self.limiters[host] = limiter
+        return limiter
+
+    def get_stats(self):
+        return {
+            host: {**limiter.stats.as_dict(), 'rate': limiter.rate}
+            for host, limiter in self.limiters.items()
+            if limiter is not None
+        }
@@ -1,45 +1,291 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain, islice, repeat
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
 import os
+import time
 
+from .cache import RequestCache
+from .serialization import project_fields
+from .templates import UrlTemplate
 
-def url_get(dequeuer, url):
+
+DEFAULT_PAGINATION = {
+    'style': 'next',  # "next", "link", "cursor" or None
+    'results_field': 'results',
+    'next_field': 'next',
+    'cursor_field': 'next_cursor',
+    'cursor_param': 'cursor',
+    'max_pages': None,
+}
+# Pages a cached step keeps, at most: results longer than that aren't
+# cached, but streamed like those of steps without a cache.
+CACHED_MAX_PAGES = 10
+
+
+def set_query_param(url, name, value):
+    parts = urlsplit(url)
+    query = [(key, val) for key, val in parse_qsl(parts.query, keep_blank_values=True) if key != name]
+    query.append((name, value))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def get_next_page_url(url, response, response_data, pagination):
+    style = pagination['style']
+
+    if style == 'next':
+        next_url = response_data.get(pagination['next_field'], None)
+        return urljoin(url, next_url) if next_url else None
+
+    if style == 'link':
+        return getattr(response, 'links', {}).get('next', {}).get('url', None)
+
+    if style == 'cursor':
+        cursor = response_data.get(pagination['cursor_field'], None)
+        return set_query_param(url, pagination['cursor_param'], cursor) if cursor else None
+
+    return None
+
+
+def get_page(dequeuer, url, pagination, fields=None):
+    # A page's results (only their `fields`, if any) and the next page's
+    # URL (None if it's the last one).
     response = dequeuer.get(url)
-    response_data = response.json()
+    response_data = dequeuer.decode_response(response)
+
+    results_field = pagination['results_field']
+    if not isinstance(response_data, dict) or results_field not in response_data:
+        return project_fields([response_data], fields), None
+    next_url = get_next_page_url(url, response, response_data, pagination)
+    return project_fields(response_data[results_field], fields), next_url
+
+
+def iter_url_pages(dequeuer, url, pagination=None, fields=None, page_getter=get_page):
+    # Each page is only fetched once the previous one was consumed.
+    pagination = {**DEFAULT_PAGINATION, **(pagination or {})}
+    max_pages = pagination['max_pages']
+    pages = 0
+
+    while url:
+        results, url = page_getter(dequeuer, url, pagination, fields)
+        pages += 1
+        yield results
+
+        if max_pages and pages >= max_pages:
+            return
+
+
+def iter_url_results(dequeuer, url, pagination=None):
+    return chain.from_iterable(iter_url_pages(dequeuer, url, pagination))
+
+
+def url_get(dequeuer, url, pagination=None, fields=None):
+    return list(chain.from_iterable(iter_url_pages(dequeuer, url, pagination, fields)))
+
+
+def read_pages(pages, max_pages):
+    # The results of the first `max_pages` pages and the pages left (None
+    # if there are none).
+    results = []
+    for page in islice(pages, max_pages):
+        results.extend(page)
+
+    page = next(pages, None)
+    if page is None:
+        return results, None
+    return results, chain([page], pages)
+
+
+def format_accumulation_url(config, url_template, entry):
+    # "ticket", "v1/tickets/{data[ticket]}"
+    # entry = {"data": {"id": 1, "ticket": "2"}, ...}
+    url = url_template.format(**entry)
+
+    base_url = config['base_url']
+    kwargs = {**entry, 'config': config}
+    return os.path.join(base_url, url).format(**kwargs)
+
+
+def get_accumulation_url(dequeuer, url_template, entry):
+    return format_accumulation_url(dequeuer.config, url_template, entry)
+
+
+class AccumulationUrl:
+    # `format_accumulation_url` for one accumulator, compiled once. The URL
+    # is formatted a single time, so templates with escaped braces (which
+    # relied on the second formatting) keep using the original function.
+
+    def __init__(self, url_template, config):
+        self.url_template = url_template
+        self.config = config
+        self.base_url = config['base_url']
+        self.compiled = None
+        self.joined = False
 
-    if 'results' in response_data:
-        return response_data['results']
-    else:
-        return [response_data]
+        if any('{{' in template or '}}' in template for template in (url_template, self.base_url)):
+            return
+        if url_template[:1] not in ('', '{', '/'):
+            # Surely relative: joined with the base URL right away.
+            self.compiled = UrlTemplate(os.path.join(self.base_url, url_template), config)
+            self.joined = True
+        elif '{' not in self.base_url:
+            self.compiled = UrlTemplate(url_template, config)
 
+    def render(self, entry):
+        if self.compiled is None:
+            return format_accumulation_url(self.config, self.url_template, entry)
 
-def accumulate(dequeuer, payload, accumulators, url_getter=None):
-    last_level = [{'payload': payload}]
-    url_getter = url_getter or url_get
+        url = self.compiled.render(entry)
+        if self.joined or url.startswith('/'):
+            return url
+        return os.path.join(self.base_url, url)
 
-    for step_name, base_url in accumulators:
-        # "ticket", "v1/tickets/{data[ticket]}"
-        new_level = []
-        url = base_url
 
-        for entry in last_level:
-            # last_level = [{"data": {"id": 1, "ticket": "2"}}, ...]
+def parse_accumulator(accumulator):
+    # ("ticket", "v1/tickets/{data[ticket]}") or, with options,
+    # ("ticket", "v1/tickets/{data[ticket]}", {"cache": {"ttl": 60}})
+    step_name, url_template, *rest = accumulator
+    options = rest[0] if rest else {}
+    return step_name, url_template, options
+
+
+def get_cached_url_getter(url_getter, request_cache, step_cache):
+    def fetch(dequeuer, url):
+        if step_cache is not None:
+            results = step_cache.get(url, None)
+            if results is None:
+                results = url_getter(dequeuer, url)
+                step_cache.set(url, results)
+            return results
+        return url_getter(dequeuer, url)
+
+    def cached_url_getter(dequeuer, url):
+        return request_cache.get(url, lambda url: fetch(dequeuer, url))
+
+    return cached_url_getter
+
+
+def get_cached_page_getter(request_cache, step_name=None, on_fetch=None):
+    # `get_page` deduplicated by `request_cache` (which keeps only the most
+    # recent pages) and timed, if `on_fetch`, for each actual request.
+    def fetch_page(dequeuer, url, pagination, fields):
+        started = time.perf_counter()
+        page = get_page(dequeuer, url, pagination, fields)
+        if on_fetch is not None:
+            on_fetch(step_name, time.perf_counter() - started, len(page[0]))
+        return page
+
+    def cached_page_getter(dequeuer, url, pagination, fields):
+        return request_cache.get(url, lambda url: fetch_page(dequeuer, url, pagination, fields))
+
+    return cached_page_getter
+
+
+def get_url_streamer(page_getter, pagination=None, fields=None, step_cache=None, max_cached_pages=CACHED_MAX_PAGES):
+    # A URL getter returning its results as they're needed: the first page
+    # right away (in the `concurrency` threads), the others while the
+    # entries are consumed. With a `step_cache`, results of up to
+    # `max_cached_pages` pages are read at once and cached.
+    def stream(dequeuer, url):
+        if step_cache is not None:
+            results = step_cache.get(url, None)
+            if results is not None:
+                return results
+
+        pages = iter_url_pages(dequeuer, url, pagination, fields, page_getter)
+        if step_cache is None:
+            return chain(next(pages, ()), chain.from_iterable(pages))
+
+        results, pages_left = read_pages(pages, max_cached_pages)
+        if pages_left is None:
+            step_cache.set(url, results)
+            return results
+        return chain(results, chain.from_iterable(pages_left))
+
+    return stream
+
+
+def get_timed_url_getter(url_getter, step_name, on_fetch):
+    # `on_fetch(step_name, seconds, results_count)` after each fetch.
+    def timed_url_getter(dequeuer, url):
+        started = time.perf_counter()
+        results = url_getter(dequeuer, url)
+        on_fetch(step_name, time.perf_counter() - started, len(results))
+        return results
+
+    return timed_url_getter
+
+
+def expand_entry(step_name, entry, results):
+    for result in results:
+        new_entry = {step_name: result}  # "ticket": {...}
+        new_entry.update(entry)  # + "data": {...}
+        yield new_entry  # {"ticket": {"id": 1}, "data": {...}}, {"ticket": {"id": 2}, "data": {...}}
+
+
+def get_url_renderer(dequeuer, url_template, compiled_url=None):
+    if compiled_url is not None:
+        return compiled_url.render
+    return partial(get_accumulation_url, dequeuer, url_template)
+
+
+def iter_level(dequeuer, entries, step_name, url_template, url_getter, concurrency=1, compiled_url=None):
+    # Consumes the previous level as a stream, keeping up to `concurrency`
+    # requests in flight and yielding new entries in the serial order.
+    render_url = get_url_renderer(dequeuer, url_template, compiled_url)
+
+    def fetch(entry):
+        return url_getter(dequeuer, render_url(entry))
+
+    if concurrency <= 1:
+        for entry in entries:
+            yield from expand_entry(step_name, entry, fetch(entry))
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        for entry in entries:
+            in_flight.append((entry, executor.submit(fetch, entry)))
+            if len(in_flight) >= concurrency:
+                entry, future = in_flight.popleft()
+                yield from expand_entry(step_name, entry, future.result())
+
+        while in_flight:
+            entry, future = in_flight.popleft()
+            yield from expand_entry(step_name, entry, future.result())
+
+
+def iter_accumulate(dequeuer, payload, accumulators, url_getter=None, concurrency=1, caches=None, cache_stats=None,
+                    on_fetch=None, compiled_urls=None, action_name=None):
+    # `compiled_urls`: an `AccumulationUrl` per accumulator, if prepared;
+    # `caches` are keyed by `(action_name, step_name, url_template)`.
+    entries = iter([{'payload': payload}])
+    caches = caches or {}
+    request_cache = RequestCache(cache_stats)
+    compiled_urls = compiled_urls or repeat(None)
+
+    for accumulator, compiled_url in zip(accumulators, compiled_urls):
+        step_name, url_template, options = parse_accumulator(accumulator)
+        step_cache = caches.get((action_name, step_name, url_template), None)
+        if url_getter is None:
+            step_url_getter = get_url_streamer(
+                get_cached_page_getter(request_cache, step_name, on_fetch),
+                options.get('pagination', None), options.get('fields', None), step_cache,
+                (options.get('cache', None) or {}).get('max_pages', CACHED_MAX_PAGES)
+            )
+        else:
+            step_url_getter = get_cached_url_getter(url_getter, request_cache, step_cache)
+            if on_fetch is not None:
+                step_url_getter = get_timed_url_getter(step_url_getter, step_name, on_fetch)
 
-            # 1- Find the right URL:
-            for entry_name, entry_values in entry.items():
-                # "data" , {"id": 1, "ticket": "2"}
-                url = url.format(**{entry_name: entry_values})
+        entries = iter_level(dequeuer, entries, step_name, url_template, step_url_getter, concurrency, compiled_url)
 
-            # 2- Save the URL:
-            base_url = dequeuer.config['base_url']
-            kwargs = {**entry, 'config': dequeuer.config}
-            real_url = os.path.join(base_url, url).format(**kwargs)
-            for result in url_getter(dequeuer, real_url):
-                new_entry = {step_name: result}  # "ticket": {...}
-                new_entry.update(entry)  # + "data": {...}
-                new_level.append(new_entry)  # [{"ticket": {"id": 1}, "data": {...}}, {"ticket": {"id": 2}, "data": {...}}]
+    return entries
 
-        last_level = new_level
 
-    return last_level
+def accumulate(dequeuer, payload, accumulators, url_getter=None, concurrency=1, caches=None, cache_stats=None):
+    return list(iter_accumulate(dequeuer, payload, accumulators, url_getter, concurrency, caches, cache_stats))
 
 
 def apply_data_map(data, data_map):
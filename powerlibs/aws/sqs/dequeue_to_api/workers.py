@@ -0,0 +1,208 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+from .compiler import CompiledConfig, compile_config
+from .instrumentation import AggregatedMetrics
+from .plugins import PluginRegistry
+
+
+DEFAULT_WORKERS = {
+    'processes': None,  # Defaults to the number of CPUs.
+    'drain_timeout': 30.0,  # Seconds to finish the messages received before a SIGTERM.
+    'report_interval': 5.0,  # Seconds between each worker's metrics reports.
+    'restart_delay': 1.0,  # Seconds before replacing a worker that died.
+}
+
+
+class Worker:
+    # What runs in each worker process: a dequeuer of its own (threads,
+    # HTTP sessions and all, created after the fork) receiving messages
+    # until SIGTERM, then draining them.
+
+    def __init__(self, slot, generation, make_dequeuer, compiled_config, reports, options):
+        self.slot = slot
+        self.generation = generation
+        self.make_dequeuer = make_dequeuer
+        self.compiled_config = compiled_config
+        self.reports = reports
+        self.options = options
+        self.stopping = threading.Event()
+        self.received = 0
+        self.dequeuer = None
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def report(self):
+        metrics = self.dequeuer.metrics
+        self.reports.put({
+            'slot': self.slot,
+            'generation': self.generation,
+            'received': self.received,
+            'metrics': metrics.snapshot() if metrics.enabled else None,
+        })
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # The supervisor's to handle.
+
+        self.dequeuer = self.make_dequeuer(self.compiled_config)
+        logger = self.dequeuer.logger
+        logger.info(f'Worker {self.slot} started (pid {os.getpid()})')
+
+        reported_at = time.monotonic()
+        while not self.stopping.is_set():
+            self.received += self.dequeuer.process_messages()
+            if time.monotonic() - reported_at >= self.options['report_interval']:
+                self.report()
+                reported_at = time.monotonic()
+
+        if not self.dequeuer.drain(self.options['drain_timeout']):
+            logger.warning(f'Worker {self.slot}: drain timed out, unfinished messages will be received again')
+        self.dequeuer.shutdown()
+        self.report()
+        logger.info(f'Worker {self.slot} stopped')
+
+
+def run_worker(*args):
+    Worker(*args).run()
+
+
+class WorkerSupervisor:
+    # Runs `processes` forked workers, each with a dequeuer built by
+    # `make_dequeuer(compiled_config)` (a `DequeueToAPI` or subclass). The
+    # config is compiled and the plugins imported once, here, before
+    # forking. Workers that die are replaced; SIGTERM and SIGINT make every
+    # worker stop receiving messages and drain the ones it has.
+    #
+    #   supervisor = WorkerSupervisor(
+    #       lambda compiled_config: MyDequeuer(compiled_config, 'queue-name'),
+    #       config_data, {'processes': 4}
+    #   )
+    #   supervisor.run()
+
+    def __init__(self, make_dequeuer, config_data, options=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.make_dequeuer = make_dequeuer
+
+        if isinstance(config_data, CompiledConfig):
+            self.compiled_config = config_data
+        else:
+            self.compiled_config = compile_config(config_data)
+        # Forked workers find the plugins' modules in `sys.modules` already.
+        PluginRegistry.from_config(self.compiled_config.compiled_actions, self.compiled_config.config).preload()
+
+        # `options` override config['workers'], both like DEFAULT_WORKERS.
+        self.options = {
+            **DEFAULT_WORKERS, **self.compiled_config.config.get('workers', {}), **(options or {})
+        }
+        self.processes_count = self.options['processes'] or os.cpu_count() or 1
+
+        self.context = multiprocessing.get_context('fork')
+        self.reports = self.context.Queue()
+        self.processes = {}  # slot: (generation, process)
+        self.generations = {}
+        self.stopping = threading.Event()
+
+        self.metrics = AggregatedMetrics()
+        self.received = {}  # (slot, generation): messages received
+        self.restarts = 0
+
+    def start_worker(self, slot):
+        generation = self.generations.get(slot, -1) + 1
+        self.generations[slot] = generation
+        process = self.context.Process(
+            target=run_worker,
+            args=(slot, generation, self.make_dequeuer, self.compiled_config, self.reports, self.options),
+            name='dequeue_to_api-worker-{}'.format(slot),
+        )
+        process.start()
+        self.processes[slot] = (generation, process)
+        self.logger.info(f'Started worker {slot} (pid {process.pid})')
+
+    def start(self):
+        for slot in range(self.processes_count):
+            self.start_worker(slot)
+
+    def supervise(self):
+        for slot, (generation, process) in list(self.processes.items()):
+            if process.is_alive() or self.stopping.is_set():
+                continue
+
+            self.logger.error(f'Worker {slot} (pid {process.pid}) died with exit code {process.exitcode}')
+            self.restarts += 1
+            time.sleep(self.options['restart_delay'])
+            if not self.stopping.is_set():
+                self.start_worker(slot)
+
+    def collect_reports(self, timeout=0.0):
+        # Whatever the workers reported so far, waiting up to `timeout`
+        # seconds for the first one.
+        block = timeout > 0
+        while True:
+            try:
+                report = self.reports.get(block, timeout) if block else self.reports.get_nowait()
+            except queue.Empty:
+                return
+            block = False
+
+            source = (report['slot'], report['generation'])
+            self.received[source] = report['received']
+            if report['metrics'] is not None:
+                self.metrics.update(source, report['metrics'])
+
+    def get_stats(self):
+        return {
+            'workers': self.processes_count,
+            'alive': sum(1 for _, process in self.processes.values() if process.is_alive()),
+            'restarts': self.restarts,
+            'received': sum(list(self.received.values())),
+        }
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def install_signal_handlers(self):
+        # Returns the previous handlers.
+        return {
+            signal_number: signal.signal(signal_number, self.stop)
+            for signal_number in (signal.SIGTERM, signal.SIGINT)
+        }
+
+    def stop_workers(self):
+        for _, process in self.processes.values():
+            if process.is_alive():
+                process.terminate()  # SIGTERM: drain.
+
+        deadline = time.monotonic() + self.options['drain_timeout'] + 10
+        for slot, (_, process) in self.processes.items():
+            while process.is_alive() and time.monotonic() < deadline:
+                self.collect_reports(timeout=0.1)
+                process.join(timeout=0.1)
+            if process.is_alive():
+                self.logger.error(f'Worker {slot} (pid {process.pid}) didn\'t stop in time: killing it')
+                process.kill()
+                process.join()
+        self.collect_reports()
+
+    def run(self, poll_interval=0.5):
+        # Blocks until SIGTERM/SIGINT (or `stop`), with every worker drained.
+        previous_handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            previous_handlers = self.install_signal_handlers()
+
+        self.start()
+        try:
+            while not self.stopping.is_set():
+                self.collect_reports(timeout=poll_interval)
+                self.supervise()
+        finally:
+            self.stop_workers()
+            for signal_number, handler in previous_handlers.items():
+                signal.signal(signal_number, handler)
+        return self.get_stats()
@@ -46,6 +46,15 @@ setup(
     package_data={'': ['LICENSE', 'README.md']},
     include_package_data=True,
     install_requires=requires,
+    extras_require={
+        'async': ['aiohttp'],
+    },
+    entry_points={
+        'console_scripts': [
+            'dequeue-to-api-compile = powerlibs.aws.sqs.dequeue_to_api.compiler:main',
+            'dequeue-to-api-replay = powerlibs.aws.sqs.dequeue_to_api.replay:main',
+        ],
+    },
     dependency_links=dependency_links,
     zip_safe=False,
     keywords='generic libraries',
@@ -12,9 +12,17 @@ class Message:
         self.body = json.dumps(data)
 
         self.delete = mock.Mock()
+        self.change_visibility = mock.Mock()
         self.message_attributes = attributes
 
 
+def build_message(topic, data, message_id=None):
+    message = Message(data, {'topic': {'StringValue': topic}})
+    if message_id is not None:
+        message.message_id = message_id
+    return message
+
+
 @pytest.fixture
 def simple_message_payload():
     return {
@@ -112,7 +120,31 @@ def config():
 
 
 @pytest.fixture
-def dequeuer(config):
+def dequeuer_factory():
+    # Builds a dequeuer of `actions`, with `options` as its "config" (or of
+    # a whole `config`, compiled or not), whose requests go to the mocked
+    # `methods` ("get", "post"...) of its `mocked_requests_module`.
+    def build(actions=None, methods=None, config=None, dequeuer_class=DequeueToAPI, thread_pool_size=0, **options):
+        if config is None:
+            config = {'config': {'base_url': 'https://example.com/', **options}, 'actions': actions}
+
+        d = dequeuer_class(
+            config, 'TEST QUEUE',
+            process_pool_size=0,  # Do not use multiprocessing.
+            thread_pool_size=thread_pool_size,  # Do not use threads, by default.
+            aws_access_key_id='AWS_ID',
+            aws_secret_access_key='AWS_SECRET',
+            aws_region='AWS_REGION'
+        )
+        d.mocked_requests_module = mock.Mock(**(methods or {}))
+        d.load_request_methods(d.mocked_requests_module)
+        return d
+
+    return build
+
+
+@pytest.fixture
+def dequeuer(config, dequeuer_factory):
     mocked_requests_method = mock.Mock(
         return_value=mock.Mock(
             status_code=200,
@@ -125,24 +157,12 @@ def dequeuer(config):
         def requests_headers(self):
             return {'Authorization': 'token TEST-TOKEN'}
 
-    d = MyDequeuer(
-        config, 'TEST QUEUE',
-        process_pool_size=0,  # Do not use multiprocessing.
-        thread_pool_size=0,  # Do not use threads.
-        aws_access_key_id='AWS_ID',
-        aws_secret_access_key='AWS_SECRET',
-        aws_region='AWS_REGION'
-    )
-
-    mocked_requests_module = mock.Mock(
-        get=mocked_requests_method,
-        post=mocked_requests_method,
-        patch=mocked_requests_method,
-        delete=mocked_requests_method,
+    d = dequeuer_factory(
+        config=config,
+        methods={method_name: mocked_requests_method for method_name in ('get', 'post', 'patch', 'delete')},
+        dequeuer_class=MyDequeuer,
     )
-    d.mocked_requests_module = mocked_requests_module
     d.mocked_requests_method = mocked_requests_method
-    d.load_request_methods(mocked_requests_module)
 
     return d
 
@@ -0,0 +1,18 @@
+class Plugin:
+    def __init__(self, dequeuer):
+        self.dequeuer = dequeuer
+        self.calls = []
+        self.warmed_up = False
+        self.closed = False
+
+    def warm_up(self):
+        self.warmed_up = True
+
+    def close(self):
+        self.closed = True
+
+    def record(self, action, topic, payload):
+        self.calls.append((action['message_topic'], payload))
+
+    def fail(self, action, topic, payload):
+        raise ValueError('Failing on purpose')
@@ -0,0 +1 @@
+raise ImportError('No action uses this plugin: it should never be imported')
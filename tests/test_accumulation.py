@@ -1,4 +1,9 @@
-from powerlibs.aws.sqs.dequeue_to_api.transformations import accumulate
+import time
+import types
+from unittest import mock
+
+from powerlibs.aws.sqs.dequeue_to_api.cache import TTLCache
+from powerlibs.aws.sqs.dequeue_to_api.transformations import accumulate, iter_accumulate
 
 
 def test_accumulator(dequeuer, simple_message_payload, accumulators, accumulators_responses):
@@ -15,3 +20,91 @@ def test_accumulator(dequeuer, simple_message_payload, accumulators, accumulator
     assert 'beta' in first_result
     assert 'gama' in first_result
     assert first_result['gama']['id'] == 'FINAL_01'
+
+
+def test_accumulator_fetches_each_entry_url(dequeuer, simple_message_payload, accumulators, accumulators_responses):
+    requested_urls = []
+
+    def url_get(dequeuer, url):
+        requested_urls.append(url)
+        return accumulators_responses[url]
+
+    results = accumulate(dequeuer, simple_message_payload, accumulators, url_get)
+
+    assert sorted(requested_urls) == sorted(accumulators_responses.keys())
+    assert [result['gama']['id'] for result in results] == [
+        'FINAL_01', 'FINAL_02', 'FINAL_03', 'FINAL_04', 'FINAL_05', 'FINAL_06', 'FINAL_07'
+    ]
+
+
+def test_concurrent_accumulator_keeps_order(dequeuer, simple_message_payload, accumulators, accumulators_responses):
+    def url_get(dequeuer, url):
+        time.sleep(0.01 if url.endswith('01') else 0)
+        return accumulators_responses[url]
+
+    serial_results = accumulate(dequeuer, simple_message_payload, accumulators, url_get)
+    concurrent_results = accumulate(dequeuer, simple_message_payload, accumulators, url_get, concurrency=4)
+
+    assert concurrent_results == serial_results
+
+
+def test_paginated_accumulator(dequeuer, simple_message_payload):
+    pages = {
+        'https://mycompany.example.com/foo/?page=1': {'results': [{'id': 1}, {'id': 2}], 'next': '/foo/?page=2'},
+        'https://mycompany.example.com/foo/?page=2': {'results': [{'id': 3}], 'next': None},
+        'https://mycompany.example.com/bar/?id=1': {'results': [{'id': 'a'}], 'next_cursor': 'X'},
+        'https://mycompany.example.com/bar/?id=1&cursor=X': {'results': [{'id': 'b'}]},
+        'https://mycompany.example.com/bar/?id=2': {'id': 'c'},
+        'https://mycompany.example.com/bar/?id=3': {'results': []},
+    }
+    dequeuer.get = lambda url: mock.Mock(json=mock.Mock(return_value=pages[url]))
+
+    accumulators = (
+        ('alfa', 'foo/?page=1'),
+        ('beta', 'bar/?id={alfa[id]}', {'pagination': {'style': 'cursor'}}),
+    )
+    entries = iter_accumulate(dequeuer, simple_message_payload, accumulators)
+
+    assert isinstance(entries, types.GeneratorType)
+    assert [(entry['alfa']['id'], entry['beta']['id']) for entry in entries] == [(1, 'a'), (1, 'b'), (2, 'c')]
+
+
+def build_pages(count):
+    pages = {}
+    for page in range(1, count + 1):
+        pages['https://mycompany.example.com/foo/?page={}'.format(page)] = {
+            'results': [{'id': page}],
+            'next': '/foo/?page={}'.format(page + 1) if page < count else None,
+        }
+    return pages
+
+
+def test_paginated_accumulator_streams_pages(dequeuer, simple_message_payload):
+    pages = build_pages(3)
+    requested_urls = []
+
+    def get(url):
+        requested_urls.append(url)
+        return mock.Mock(json=mock.Mock(return_value=pages[url]))
+
+    dequeuer.get = get
+    entries = iter_accumulate(dequeuer, simple_message_payload, [('alfa', 'foo/?page=1')])
+
+    assert next(entries)['alfa'] == {'id': 1}
+    assert len(requested_urls) == 1
+    assert [entry['alfa']['id'] for entry in entries] == [2, 3]
+    assert len(requested_urls) == 3
+
+
+def test_cached_steps_keep_a_bounded_number_of_pages(dequeuer, simple_message_payload):
+    pages = build_pages(3)
+    dequeuer.get = lambda url: mock.Mock(json=mock.Mock(return_value=pages[url]))
+
+    for max_pages, cached in ((2, False), (3, True)):
+        accumulators = [('alfa', 'foo/?page=1', {'cache': {'max_pages': max_pages}})]
+        caches = {(None, 'alfa', 'foo/?page=1'): TTLCache()}
+        entries = iter_accumulate(dequeuer, simple_message_payload, accumulators, caches=caches)
+
+        assert [entry['alfa']['id'] for entry in entries] == [1, 2, 3]
+        cached_results = caches[(None, 'alfa', 'foo/?page=1')].get('https://mycompany.example.com/foo/?page=1', None)
+        assert (cached_results is not None) == cached
@@ -0,0 +1,117 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.acknowledgements import AcknowledgementBuffer
+
+from conftest import build_message
+
+
+class FakeQueue:
+    # Answers like boto3's `Queue.delete_messages`.
+    def __init__(self, failing_handles=(), error=None):
+        self.failing_handles = set(failing_handles)
+        self.error = error
+        self.batches = []
+        self.deleted = []
+        self.called = threading.Event()
+
+    def delete_messages(self, Entries):
+        self.batches.append(Entries)
+        self.called.set()
+        if self.error:
+            raise self.error
+
+        response = {'Successful': [], 'Failed': []}
+        for entry in Entries:
+            if entry['ReceiptHandle'] in self.failing_handles:
+                response['Failed'].append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError'})
+            else:
+                self.deleted.append(entry['ReceiptHandle'])
+                response['Successful'].append({'Id': entry['Id']})
+        return response
+
+
+def build_messages(count):
+    messages = []
+    for index in range(count):
+        message = build_message('thing__created', {'id': index})
+        message.receipt_handle = 'HANDLE-{}'.format(index)
+        messages.append(message)
+    return messages
+
+
+def delete_batch(queue):
+    return lambda entries: queue.delete_messages(Entries=entries)
+
+
+def test_flush_on_size():
+    queue = FakeQueue()
+    buffer = AcknowledgementBuffer(delete_batch(queue), max_delay=60)
+
+    for message in build_messages(23):
+        buffer.add(message)
+
+    assert [len(batch) for batch in queue.batches] == [10, 10]
+    buffer.close()
+    assert [len(batch) for batch in queue.batches] == [10, 10, 3]
+    assert len(queue.deleted) == 23
+    assert buffer.stats.as_dict() == {'messages': 23, 'batches': 3, 'retried': 0, 'failed': 0}
+
+
+def test_flush_on_time():
+    queue = FakeQueue()
+    buffer = AcknowledgementBuffer(delete_batch(queue), max_delay=0.01)
+
+    buffer.add(build_messages(1)[0])
+
+    assert queue.called.wait(timeout=5)
+    assert queue.batches[0] == [{'Id': '0', 'ReceiptHandle': 'HANDLE-0'}]
+    buffer.close()
+
+
+def test_failed_entries_are_retried_individually():
+    queue = FakeQueue(failing_handles=['HANDLE-1'])
+    buffer = AcknowledgementBuffer(delete_batch(queue), batch_size=3)
+    messages = build_messages(3)
+
+    for message in messages:
+        buffer.add(message)
+
+    assert [message.delete.call_count for message in messages] == [0, 1, 0]
+    assert buffer.stats.retried == 1
+
+
+def test_failed_batches_are_retried_individually():
+    queue = FakeQueue(error=RuntimeError('Throttled'))
+    on_deleted = mock.Mock()
+    buffer = AcknowledgementBuffer(delete_batch(queue), batch_size=2, on_deleted=on_deleted)
+    messages = build_messages(2)
+    messages[1].delete.side_effect = RuntimeError('Throttled')
+
+    for message in messages:
+        buffer.add(message)
+
+    assert [message.delete.call_count for message in messages] == [1, 1]
+    assert buffer.stats.failed == 1
+    on_deleted.assert_called_once_with(messages[0])
+
+
+def test_batch_size_limit():
+    with pytest.raises(ValueError):
+        AcknowledgementBuffer(delete_batch(FakeQueue()), batch_size=11)
+
+
+def test_dequeuer_acknowledgements(dequeuer_factory, config, update_message):
+    config['config']['acknowledgements'] = {'batch_size': 10, 'max_delay': 60}
+    d = dequeuer_factory(config=config, methods={'patch': mock.Mock(return_value=mock.Mock(status_code=200))})
+    d.queue = FakeQueue()
+    update_message.receipt_handle = 'HANDLE'
+
+    d.handle_message(update_message)
+    assert d.queue.batches == []
+
+    d.shutdown()
+    assert d.queue.deleted == ['HANDLE']
+    assert update_message.delete.call_count == 0
@@ -0,0 +1,181 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api import aio
+from powerlibs.aws.sqs.dequeue_to_api.aio import AsyncDequeueToAPI, accumulate, iter_accumulate
+
+
+@pytest.fixture
+def async_dequeuer(config, dequeuer_factory):
+    config['actions']['run_plugins'] = {
+        'topic': 'plugins__run',
+        'custom_handlers': ['plugin.sync_handler', 'plugin.async_handler'],
+    }
+
+    class Plugin:
+        def __init__(self):
+            self.calls = []
+
+        def sync_handler(self, action, topic, payload):
+            self.calls.append(('sync', topic, action['message_topic']))
+
+        async def async_handler(self, action, topic, payload):
+            await asyncio.sleep(0)
+            self.calls.append(('async', topic, payload['id']))
+
+    response = mock.Mock(status_code=200)
+    d = dequeuer_factory(
+        config=config,
+        methods={'post': mock.Mock(return_value=response), 'patch': mock.Mock(return_value=response)},
+        dequeuer_class=AsyncDequeueToAPI,
+    )
+    d.custom_handlers['plugin'] = Plugin()
+
+    yield d
+    d.shutdown()
+
+
+def test_async_handle_message(async_dequeuer, update_message):
+    assert asyncio.run(async_dequeuer.async_parse_and_handle_message(update_message)) == 1
+
+    method = async_dequeuer.mocked_requests_module.patch
+    assert method.call_count == 1
+    assert update_message.delete.call_count == 1
+
+
+def test_async_handle_message_on_event_loop(async_dequeuer, create_message):
+    future = async_dequeuer.handle_message(create_message)
+
+    assert future.result(timeout=5) == 1
+    assert create_message.delete.call_count == 1
+
+
+def test_async_and_sync_plugins(async_dequeuer, simple_message_payload):
+    message = mock.Mock()
+    result = asyncio.run(async_dequeuer.async_do_handle_message(message, 'plugins__run', simple_message_payload))
+
+    assert result == 1
+    assert message.delete.call_count == 1
+    assert async_dequeuer.custom_handlers['plugin'].calls == [
+        ('sync', 'plugins__run', 'plugins__run'),
+        ('async', 'plugins__run', 'MESSAGE_ID'),
+    ]
+
+
+def test_async_accumulator(dequeuer, simple_message_payload, accumulators, accumulators_responses):
+    async def url_get(dequeuer, url):
+        await asyncio.sleep(0.01 if url.endswith('01') else 0)
+        return accumulators_responses[url]
+
+    results = asyncio.run(accumulate(dequeuer, simple_message_payload, accumulators, url_get, concurrency=4))
+
+    assert [result['gama']['id'] for result in results] == [
+        'FINAL_01', 'FINAL_02', 'FINAL_03', 'FINAL_04', 'FINAL_05', 'FINAL_06', 'FINAL_07'
+    ]
+
+
+def test_async_paginated_accumulator_streams_pages(dequeuer, simple_message_payload):
+    pages = {
+        'https://mycompany.example.com/foo/?page=1': {'results': [{'id': 1}], 'next': '/foo/?page=2'},
+        'https://mycompany.example.com/foo/?page=2': {'results': [{'id': 2}], 'next': None},
+    }
+    requested_urls = []
+
+    async def async_send_request(method_name, url):
+        requested_urls.append(url)
+        return mock.Mock(json=mock.Mock(return_value=pages[url]))
+
+    dequeuer.async_send_request = async_send_request
+    accumulators = [('alfa', 'foo/?page=1')]
+
+    async def consume():
+        entries = iter_accumulate(dequeuer, simple_message_payload, accumulators)
+        first = await entries.__anext__()
+        requested = len(requested_urls)
+        return [first] + [entry async for entry in entries], requested
+
+    entries, requested = asyncio.run(consume())
+    assert [entry['alfa']['id'] for entry in entries] == [1, 2]
+    assert requested == 1
+    assert len(requested_urls) == 2
+
+
+def build_lazy_methods(write_error=None):
+    def get(url, **kwargs):
+        results = [{'id': 1}, {'id': 2}] if 'flights' in url else [{'id': url[-1] + 'a'}, {'id': url[-1] + 'b'}]
+        return mock.Mock(status_code=200, json=mock.Mock(return_value={'results': results}))
+
+    response = mock.Mock(status_code=201)
+    if write_error is not None:
+        response.raise_for_status.side_effect = write_error
+    return {'get': mock.Mock(side_effect=get), 'post': mock.Mock(return_value=response)}
+
+
+def build_lazy_actions(**options):
+    return {
+        'link_tiles': {
+            'topic': 'project__processed',
+            'endpoint': 'links/',
+            'method': 'POST',
+            'accumulators': [
+                ('flight', 'flights/?project={payload[id]}'),
+                ('tile', 'tiles/?flight={flight[id]}'),
+            ],
+            'payload': {'flight': '{flight[id]}', 'tile': '{tile[id]}'},
+            **options,
+        },
+    }
+
+
+@pytest.mark.parametrize('options, bodies', (
+    ({}, [{'flight': '1', 'tile': '1a'}, {'flight': '1', 'tile': '1b'}, {'flight': '2', 'tile': '2a'},
+          {'flight': '2', 'tile': '2b'}]),
+    ({'batch': {'max_size': 3}}, [[{'flight': '1', 'tile': '1a'}, {'flight': '1', 'tile': '1b'},
+                                   {'flight': '2', 'tile': '2a'}], [{'flight': '2', 'tile': '2b'}]]),
+    ({'coalesce': {'window': 60}}, [{'flight': '2', 'tile': '2b'}]),
+))
+def test_async_plans_are_hydrated_as_they_run(dequeuer_factory, options, bodies):
+    d = dequeuer_factory(build_lazy_actions(**options), build_lazy_methods(), dequeuer_class=AsyncDequeueToAPI)
+    message = mock.Mock()
+
+    assert asyncio.run(d.async_do_handle_message(message, 'project__processed', {'id': 10})) == 1
+    if d.coalescer is not None:
+        d.coalescer.close()
+    d.shutdown()
+
+    assert d.mocked_requests_module.get.call_count == 3
+    assert [call[1]['json'] for call in d.mocked_requests_module.post.call_args_list] == bodies
+    assert d.get_hydration_stats()['entries_hydrated'] == 4
+
+
+def test_failed_async_writes_stop_the_hydration(dequeuer_factory):
+    d = dequeuer_factory(
+        build_lazy_actions(), build_lazy_methods(write_error=Exception('Bad Request')), dequeuer_class=AsyncDequeueToAPI
+    )
+    closed = []
+    accumulate_levels = aio.iter_level
+
+    async def iter_level(*args, **kwargs):
+        try:
+            async for entry in accumulate_levels(*args, **kwargs):
+                yield entry
+        finally:
+            closed.append(args[2])
+
+    closed_when_postponed = []
+    d.postpone_message = lambda message, errors: closed_when_postponed.extend(sorted(closed))
+
+    with mock.patch.object(aio, 'iter_level', iter_level):
+        assert asyncio.run(d.async_do_handle_message(mock.Mock(), 'project__processed', {'id': 10})) == 0
+    d.shutdown()
+
+    # Only the first flight's tiles were fetched, and the rest was closed
+    # right away.
+    assert d.mocked_requests_module.get.call_count == 2
+    assert d.mocked_requests_module.post.call_count == 1
+    assert closed_when_postponed == ['flight', 'tile']
+    stats = d.get_hydration_stats()
+    assert stats['entries_hydrated'] == 1
+    assert stats['plans_abandoned'] == 1
@@ -0,0 +1,86 @@
+from unittest import mock
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.batching import get_batch_body, iter_batches, parse_batch
+
+from conftest import build_message
+
+
+def build_actions(batch):
+    return {
+        'bulk_create': {
+            'topic': 'parent__created',
+            'endpoint': 'children/bulk/',
+            'method': 'POST',
+            'accumulators': [('child', 'parents/{payload[id]}/children/')],
+            'payload': {'parent': '{payload[id]}', 'child': '{child[id]}'},
+            'batch': batch,
+        },
+    }
+
+
+def build_methods(post):
+    children = {'results': [{'id': index} for index in range(7)]}
+    get = mock.Mock(return_value=mock.Mock(status_code=200, json=mock.Mock(return_value=children)))
+    return {'get': get, 'post': post}
+
+
+def test_iter_batches():
+    assert list(iter_batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(iter_batches([], 2)) == []
+
+
+def test_get_batch_body():
+    assert get_batch_body([1, 2]) == [1, 2]
+    assert get_batch_body([1, 2], 'items') == {'items': [1, 2]}
+
+
+def test_parse_batch():
+    assert parse_batch('action', None) is None
+    assert parse_batch('action', True)['max_size'] == 100
+
+    with pytest.raises(ValueError):
+        parse_batch('action', {'max_size': 0})
+
+    with pytest.raises(ValueError):
+        parse_batch('action', {'on_failure': 'retry'})
+
+
+def test_entries_go_out_in_chunks(dequeuer_factory):
+    post = mock.Mock(return_value=mock.Mock(status_code=201))
+    d = dequeuer_factory(build_actions({'max_size': 3, 'key': 'items'}), build_methods(post))
+    message = build_message('parent__created', {'id': 1})
+
+    d.parse_and_handle_message(message)
+
+    bodies = [call[1]['json'] for call in post.call_args_list]
+    assert [len(body['items']) for body in bodies] == [3, 3, 1]
+    assert bodies[0]['items'][0] == {'parent': '1', 'child': '0'}
+    assert message.delete.call_count == 1
+
+    stats = d.get_batch_stats()['bulk_create']
+    assert stats['batches'] == 3
+    assert stats['entries'] == 7
+    assert stats['max_entries'] == 3
+    assert stats['failed_batches'] == 0
+
+
+@pytest.mark.parametrize('on_failure, posts_count, deleted', (
+    ('fail', 2, False),
+    ('continue', 3, False),
+    ('ignore', 3, True),
+))
+def test_partial_failure_policies(dequeuer_factory, on_failure, posts_count, deleted):
+    responses = [mock.Mock(status_code=201), RuntimeError('Bad Gateway'), mock.Mock(status_code=201)]
+    post = mock.Mock(side_effect=responses)
+    d = dequeuer_factory(build_actions({'max_size': 3, 'on_failure': on_failure}), build_methods(post))
+    message = build_message('parent__created', {'id': 1})
+
+    d.parse_and_handle_message(message)
+
+    assert post.call_count == posts_count
+    assert message.delete.call_count == int(deleted)
+    stats = d.get_batch_stats()['bulk_create']
+    assert stats['failed_batches'] == 1
+    assert stats['failed_entries'] == 3
@@ -0,0 +1,106 @@
+import json
+import threading
+from unittest import mock
+
+from powerlibs.aws.sqs.dequeue_to_api.cache import RequestCache, TTLCache
+from powerlibs.aws.sqs.dequeue_to_api.transformations import accumulate
+
+from conftest import build_message
+
+
+def test_ttl_cache():
+    now = [0]
+    cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)  # Evicts "b", the least recently used.
+    assert cache.get('b') is None
+
+    now[0] = 11
+    assert cache.get('a') is None
+
+    assert cache.stats.as_dict() == {'hits': 1, 'misses': 2, 'evictions': 1, 'expirations': 1, 'coalesced': 0}
+
+
+def test_request_cache_coalesces_in_flight_requests():
+    cache = RequestCache()
+    release = threading.Event()
+    calls = []
+
+    def fetch(url):
+        calls.append(url)
+        release.wait(1)
+        return [url]
+
+    threads = [threading.Thread(target=cache.get, args=('url', fetch)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ['url']
+    assert cache.get('url', fetch) == ['url']
+    assert cache.stats.misses == 1
+    assert cache.stats.hits + cache.stats.coalesced == 4
+
+
+def test_accumulator_step_cache(dequeuer, simple_message_payload, accumulators, accumulators_responses):
+    requested_urls = []
+
+    def url_get(dequeuer, url):
+        requested_urls.append(url)
+        return accumulators_responses[url]
+
+    gama = ('gama', 'baz/{beta[baz_id]}')
+    caches = {(None,) + gama: TTLCache(ttl=60)}
+    accumulators = accumulators[:2] + (gama + ({'cache': {'ttl': 60}},),)
+
+    first = accumulate(dequeuer, simple_message_payload, accumulators, url_get, caches=caches)
+    second = accumulate(dequeuer, simple_message_payload, accumulators, url_get, caches=caches)
+
+    assert first == second
+    assert len([url for url in requested_urls if '/baz/' in url]) == 4
+    assert caches[(None,) + gama].stats.hits == 4
+
+
+def test_actions_sharing_a_step_have_their_own_caches(dequeuer_factory):
+    accumulator = ('child', 'parents/{payload[id]}/children/')
+    actions = {
+        'link_ids': {
+            'topic': 'parent__updated',
+            'endpoint': 'ids/',
+            'method': 'POST',
+            'accumulators': [accumulator + ({'cache': {'ttl': 60}, 'fields': ['id']},)],
+            'payload': {'child': '{child}'},
+        },
+        'link_names': {
+            'topic': 'parent__updated',
+            'endpoint': 'names/',
+            'method': 'POST',
+            'accumulators': [accumulator + ({'cache': {'ttl': 60}, 'fields': ['name']},)],
+            'payload': {'child': '{child}'},
+        },
+    }
+    children = json.dumps({'results': [{'id': 1, 'name': 'A'}]}).encode('utf-8')
+    d = dequeuer_factory(actions, {
+        'get': mock.Mock(return_value=mock.Mock(status_code=200, content=children, encoding='utf-8')),
+        'post': mock.Mock(return_value=mock.Mock(status_code=201)),
+    })
+
+    for _ in range(2):
+        assert d.parse_and_handle_message(build_message('parent__updated', {'id': 10})) == 1
+
+    bodies = {}
+    for call in d.mocked_requests_module.post.call_args_list:
+        bodies.setdefault(call[0][0], []).append(call[1]['json'])
+    assert bodies == {
+        'https://example.com/ids/': [{'child': "{'id': 1}"}] * 2,
+        'https://example.com/names/': [{'child': "{'name': 'A'}"}] * 2,
+    }
+    assert d.mocked_requests_module.get.call_count == 2
+    stats = d.get_url_cache_stats()
+    assert stats['link_ids child parents/{payload[id]}/children/']['hits'] == 1
+    assert stats['link_names child parents/{payload[id]}/children/']['hits'] == 1
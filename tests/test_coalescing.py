@@ -0,0 +1,181 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+import requests
+
+from powerlibs.aws.sqs.dequeue_to_api.coalescing import WriteCoalescer, parse_coalesce, when_all
+from powerlibs.aws.sqs.dequeue_to_api.instrumentation import Metrics
+
+from conftest import build_message
+
+
+def build_actions(coalesce, retry=None):
+    return {
+        'update_parent': {
+            'topic': 'child__updated',
+            'endpoint': 'parents/{payload[parent_id]}/',
+            'method': 'PATCH',
+            'payload': {'last_child': '{payload[id]}', 'status': '{payload[status]}'},
+            'coalesce': coalesce,
+            'retry': retry,
+        },
+    }
+
+
+def child_message(child_id, parent_id=1, status='ok'):
+    return build_message('child__updated', {'id': child_id, 'parent_id': parent_id, 'status': status})
+
+
+def test_parse_coalesce():
+    assert parse_coalesce('action', None) is None
+    assert parse_coalesce('action', True) == {'window': 1.0, 'strategy': 'last'}
+
+    with pytest.raises(ValueError):
+        parse_coalesce('action', {'strategy': 'first'})
+
+
+@pytest.mark.parametrize('strategy, body', (
+    ('last', {'b': 2}),
+    ('merge', {'a': 1, 'b': 2}),
+))
+def test_writes_are_absorbed(strategy, body):
+    send = mock.Mock(return_value='RESPONSE')
+    coalescer = WriteCoalescer(send)
+
+    futures = [
+        coalescer.submit('patch', 'https://example.com/parents/1/', {'a': 1}, window=60, strategy=strategy),
+        coalescer.submit('patch', 'https://example.com/parents/1/', {'b': 2}, window=60, strategy=strategy),
+    ]
+    other = coalescer.submit('patch', 'https://example.com/parents/2/', {'c': 3}, window=60)
+    assert send.call_count == 0
+
+    coalescer.close()
+
+    assert send.call_count == 2
+    send.assert_any_call('patch', 'https://example.com/parents/1/', body)
+    assert [future.result() for future in futures + [other]] == ['RESPONSE'] * 3
+    assert coalescer.stats.as_dict() == {'writes': 2, 'absorbed': 1, 'sent': 2, 'failed': 0}
+
+
+def test_write_options_are_passed_on():
+    send = mock.Mock()
+    coalescer = WriteCoalescer(send)
+
+    coalescer.submit('patch', 'https://example.com/parents/1/', {'a': 1}, window=60, options={'action_name': 'a'})
+    coalescer.submit('patch', 'https://example.com/parents/1/', {'a': 2}, window=60, options={'action_name': 'b'})
+    coalescer.close()
+
+    send.assert_called_once_with('patch', 'https://example.com/parents/1/', {'a': 2}, action_name='b')
+
+
+def test_window_expiration():
+    send = mock.Mock()
+    coalescer = WriteCoalescer(send)
+
+    future = coalescer.submit('patch', 'https://example.com/parents/1/', {'a': 1}, window=0.01)
+    future.result(timeout=5)
+
+    assert send.call_count == 1
+    coalescer.close()
+
+
+def test_windows_of_a_key_are_sent_one_at_a_time():
+    url = 'https://example.com/parents/1/'
+    first_sent = threading.Event()
+    release = threading.Event()
+    sent = []
+
+    def send(method_name, url, body):
+        if not sent:
+            first_sent.set()
+            release.wait(timeout=5)
+        sent.append(body)
+
+    coalescer = WriteCoalescer(send)
+    first = coalescer.submit('patch', url, {'a': 1}, window=0)
+    assert first_sent.wait(timeout=5)
+
+    second = coalescer.submit('patch', url, {'a': 2}, window=0)
+    third = coalescer.submit('patch', url, {'a': 3}, window=0)
+    time.sleep(0.05)
+    assert sent == []  # The second window waits for the first request.
+
+    release.set()
+    first.result(timeout=5)
+    second.result(timeout=5)
+    assert third.result(timeout=5) is None
+    coalescer.close()
+
+    assert sent == [{'a': 1}, {'a': 3}]
+    assert coalescer.stats.as_dict() == {'writes': 2, 'absorbed': 1, 'sent': 2, 'failed': 0}
+
+
+def test_when_all():
+    callback = mock.Mock()
+    coalescer = WriteCoalescer(mock.Mock(side_effect=RuntimeError('Bad Gateway')))
+
+    when_all([coalescer.submit('patch', 'https://example.com/', {}, window=60)], callback)
+    assert callback.call_count == 0
+    coalescer.close()
+
+    errors = callback.call_args[0][0]
+    assert len(errors) == 1
+    assert isinstance(errors[0], RuntimeError)
+
+
+def test_messages_are_deleted_after_the_absorbing_write(dequeuer_factory):
+    patch = mock.Mock(return_value=mock.Mock(status_code=200))
+    d = dequeuer_factory(build_actions({'window': 60}), {'patch': patch})
+    messages = [child_message(1, status='started'), child_message(2, status='finished'), child_message(3, 2)]
+
+    for message in messages:
+        assert d.parse_and_handle_message(message) == 1
+    assert patch.call_count == 0
+    assert [message.delete.call_count for message in messages] == [0, 0, 0]
+
+    d.coalescer.close()
+
+    assert patch.call_count == 2
+    requests = sorted((call[0][0], call[1]['json']) for call in patch.call_args_list)
+    assert requests[0] == ('https://example.com/parents/1/', {'last_child': '2', 'status': 'finished'})
+    assert [message.delete.call_count for message in messages] == [1, 1, 1]
+
+
+def test_messages_are_kept_when_the_absorbing_write_fails(dequeuer_factory):
+    patch = mock.Mock(side_effect=RuntimeError('Bad Gateway'))
+    d = dequeuer_factory(build_actions({'window': 60}), {'patch': patch})
+    message = child_message(1)
+
+    d.parse_and_handle_message(message)
+    d.coalescer.close()
+
+    assert patch.call_count == 1
+    assert message.delete.call_count == 0
+
+
+def test_coalesced_actions_cannot_be_depended_on(dequeuer_factory):
+    actions = {
+        'first': {'topic': 'a', 'endpoint': 'a/', 'method': 'PATCH', 'coalesce': True},
+        'second': {'topic': 'a', 'endpoint': 'b/', 'method': 'PATCH', 'depends_on': 'first'},
+    }
+    with pytest.raises(ValueError, match='coalesced'):
+        dequeuer_factory(actions)
+
+
+def test_coalesced_writes_honor_the_action_retry_policy(dequeuer_factory):
+    bad_gateway = requests.HTTPError('502 Error', response=mock.Mock(status_code=502, headers={}))
+    patch = mock.Mock(side_effect=[bad_gateway, mock.Mock(status_code=200)])
+    d = dequeuer_factory(build_actions({'window': 60}, {'max_attempts': 2, 'backoff': 0}), {'patch': patch})
+    d.metrics = Metrics()
+    message = child_message(1)
+
+    d.parse_and_handle_message(message)
+    d.coalescer.close()
+
+    assert patch.call_count == 2
+    assert message.delete.call_count == 1
+    for status in ('502', '200'):
+        labels = {'action': 'update_parent', 'method': 'patch', 'status': status}
+        assert d.metrics.get_histogram('http_request_seconds', **labels).count == 1
@@ -0,0 +1,134 @@
+import io
+import json
+import os.path
+import pickle
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.compiler import (
+    CompiledConfig, ConfigError, compile_config, load_compiled_config, main, validate_config
+)
+from powerlibs.aws.sqs.dequeue_to_api.templates import UrlTemplate
+from powerlibs.aws.sqs.dequeue_to_api.transformations import AccumulationUrl, format_accumulation_url
+
+
+PLUGINS_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'plugins')
+
+
+def build_config(**action):
+    return {
+        'config': {'base_url': 'https://example.com/', 'custom_handlers': {'paths': [PLUGINS_PATH]}},
+        'actions': {
+            'update_parent': {
+                'topic': 'parent__updated',
+                'endpoint': 'parents/{payload[id]}/',
+                'method': 'PATCH',
+                'payload': {'status': '{payload[status]}'},
+                **action,
+            },
+        },
+    }
+
+
+def test_valid_config(config):
+    errors, warnings = validate_config(config)
+    assert errors == []
+    assert warnings == []
+
+
+@pytest.mark.parametrize('action, message', [
+    ({'topic': 'step__(?P<name>[a-z+__started'}, 'invalid topic regex'),
+    ({'endpoint': 'parents/{message[id]}/'}, 'unknown variable "message"'),
+    ({'method': 'FETCH'}, 'method must be one of'),
+    ({'payload': {'status': '{payload[status]'}}, 'update_parent" payload'),
+    ({'retry': {'max_attempts': 3, 'backof': 1}}, 'retry: unknown field "backof"'),
+    ({'accumulators': [('child', 'children/?parent={parent[id]}')]}, 'unknown variable "parent"'),
+    ({'accumulators': [('child', 'children/', {'cache': {'tll': 60}})]}, 'cache: unknown field "tll"'),
+    ({'depends_on': 'nothing'}, 'unknown action "nothing"'),
+    ({'batch': True, 'coalesce': True}, 'batch and coalesce'),
+    ({'payload': {'name': "EVAL:'{payload[name]}'.upper()"}}, '"name": Only abs, bool'),
+])
+def test_invalid_configs(action, message):
+    with pytest.raises(ConfigError, match=message):
+        compile_config(build_config(**action))
+
+
+def test_unknown_action_fields_are_warnings():
+    config = build_config(endpiont='parents/')
+
+    assert compile_config(config).warnings == ['Action "update_parent": unknown field "endpiont"']
+    with pytest.raises(ConfigError, match='unknown field "endpiont"'):
+        compile_config(config, strict=True)
+
+
+def test_custom_handlers_are_checked():
+    config = build_config(custom_handlers=['fixture_plugin.record', 'fixture_plugin.nothing', 'nothing.record'])
+
+    errors, _ = validate_config(config, check_handlers=True)
+
+    assert errors == [
+        'Action "update_parent" custom handler "fixture_plugin.nothing": plugin "fixture_plugin" has no "nothing"',
+        'Action "update_parent" custom handler "nothing.record": no plugin "nothing" in {}'.format([PLUGINS_PATH]),
+    ]
+
+
+def test_compiled_config_is_picklable(config):
+    compiled_config = compile_config(config)
+    loaded = load_compiled_config(io.BytesIO(compiled_config.dumps()))
+
+    assert loaded.matches(config)
+    assert loaded.router.route('step__alfa__started', {'company_name': 'mycompany'}) == [
+        ('step__(?P<step_name>[^_]+)__(?P<step_status>[^_]+)', {'step_name': 'alfa', 'step_status': 'started'})
+    ]
+    template = loaded.compiled_actions['create_status'].payload_template
+    assert template.render('topic', {}, {}, {'payload': {'id': 1}}) == {'status': 'created', 'parent': '1'}
+
+
+def test_dequeuer_from_compiled_config(dequeuer_factory, config, update_message):
+    compiled_config = pickle.loads(compile_config(config).dumps())
+
+    d = dequeuer_factory(config=compiled_config)
+
+    assert d.compiled_config is compiled_config
+    (name, plan), = d.get_actions_for_topic('mycompany__child_created', {'company_name': 'mycompany', 'parent_id': 2})
+    assert name == 'update_parent'
+    assert plan.url == 'https://mycompany.example.com/parents/2'
+
+
+def test_url_templates():
+    config = {'base_url': 'https://example.com/', 'version': 'v2'}
+
+    assert UrlTemplate('{config[version]}/items/', config).constant == 'v2/items/'
+    assert UrlTemplate('{config[version]}/items/{payload[id]:>03}', config).render({'payload': {'id': 7}}) == (
+        'v2/items/007'
+    )
+
+
+@pytest.mark.parametrize('base_url, url_template', [
+    ('https://example.com/', 'children/?parent={payload[id]}'),
+    ('https://{payload[host]}/', 'children/{payload[id]}'),
+    ('https://example.com/', '{payload[path]}'),
+    ('https://example.com/', '/absolute/{payload[id]}'),
+    ('https://example.com/', 'escaped/{{payload[id]}}'),
+])
+def test_accumulation_urls(base_url, url_template):
+    config = {'base_url': base_url}
+    for entry in ({'payload': {'id': 1, 'host': 'h.example.com', 'path': 'relative/'}},
+                  {'payload': {'id': 2, 'host': 'h.example.com', 'path': '/absolute/'}}):
+        expected = format_accumulation_url(config, url_template, entry)
+        assert AccumulationUrl(url_template, config).render(entry) == expected
+
+
+def test_cli(tmpdir, config, capsys):
+    config_path = tmpdir.join('config.json')
+    config_path.write(json.dumps(config))
+    output_path = tmpdir.join('config.pickle')
+
+    assert main([str(config_path), '--output', str(output_path)]) == 0
+    with open(str(output_path), 'rb') as compiled_file:
+        assert isinstance(load_compiled_config(compiled_file), CompiledConfig)
+
+    config['actions']['update_parent']['method'] = 'FETCH'
+    config_path.write(json.dumps(config))
+    assert main([str(config_path)]) == 1
+    assert 'error: Action "update_parent": method must be one of' in capsys.readouterr().err
@@ -1,3 +1,9 @@
+from unittest import mock
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.data_maps import DataMapper, parse_data_map_options
+from powerlibs.aws.sqs.dequeue_to_api.templates import compile_payload_template
 from powerlibs.aws.sqs.dequeue_to_api.transformations import apply_data_map
 
 
@@ -18,3 +24,88 @@ def test_data_map(data_map):
 
     assert 'key5' not in result
     assert 'key6' not in result
+
+
+TEMPLATE = {
+    'status': 'done',
+    'id': '{payload[id]}',
+    'kind': 'MAP:{payload[kind]}',
+    'state': 'MAP:alfa',
+    'gone': 'MAP:zeta',
+    'meta': {'kind': 'MAP:alfa', 'tags': ['MAP:beta', 'MAP:zeta', 'x']},
+    'count': 'INT:{payload[count]}',
+}
+
+
+def render(entry_payload, data_map, **options):
+    mapper = DataMapper(data_map, TEMPLATE, options)
+    return mapper, mapper.apply(compile_payload_template(TEMPLATE).render('topic', {}, {}, {'payload': entry_payload}))
+
+
+def test_data_mapper_finds_the_sites_once(data_map):
+    mapper, result = render({'id': 'MAP:beta', 'kind': 'alfa', 'count': '3'}, data_map, nested=True)
+
+    assert mapper.checks == ('id', 'kind')
+    assert mapper.constants == (('state', 'A'), ('meta', {'kind': 'A', 'tags': ['B', 'x']}))
+    assert mapper.drops == ('gone',)
+    assert result == {
+        'status': 'done', 'id': 'B', 'kind': 'A', 'state': 'A', 'meta': {'kind': 'A', 'tags': ['B', 'x']}, 'count': 3
+    }
+
+
+def test_data_mapper_without_a_template_is_apply_data_map(data_map):
+    entry = {'key1': 'value1', 'key2': 'MAP:alfa', 'key4': 'aMAP:alfa', 'key5': 'MAP:', 'key6': 'MAP:zeta'}
+
+    assert DataMapper(data_map, options={'nested': False}).apply(entry) == apply_data_map(entry, data_map)
+    assert DataMapper(data_map).apply({'nested': {'key': ['MAP:alfa']}}) == {'nested': {'key': ['MAP:alfa']}}
+    nested_mapper = DataMapper(data_map, options={'nested': True})
+    assert nested_mapper.apply({'nested': {'key': ['MAP:alfa']}}) == {'nested': {'key': ['A']}}
+
+
+@pytest.mark.parametrize('options, expected', [
+    ({'missing': 'drop'}, {'status': 'done', 'id': '1'}),
+    ({'missing': 'keep'}, {'status': 'done', 'id': '1', 'kind': 'MAP:zeta'}),
+    ({'missing': 'default', 'default': 'OTHER'}, {'status': 'done', 'id': '1', 'kind': 'OTHER'}),
+])
+def test_missing_keys(data_map, options, expected):
+    mapper = DataMapper(data_map, {'status': 'done', 'id': '{payload[id]}', 'kind': 'MAP:{payload[kind]}'}, options)
+
+    assert mapper.apply({'status': 'done', 'id': '1', 'kind': 'MAP:zeta'}) == expected
+
+
+def test_missing_keys_can_fail(data_map):
+    mapper = DataMapper(data_map, {'kind': 'MAP:{payload[kind]}'}, {'missing': 'error'})
+
+    with pytest.raises(KeyError, match='zeta'):
+        mapper.apply({'kind': 'MAP:zeta'})
+
+
+def test_expressions_are_mapped_too(data_map):
+    template = {'kinds': 'EXPR:[payload["kind"], "MAP:beta"]', 'plain': 'text'}
+    mapper = DataMapper(data_map, template, {'nested': True})
+
+    assert mapper.apply(compile_payload_template(template).render('topic', {}, {}, {'payload': {'kind': 'MAP:alfa'}})) == {
+        'kinds': ['A', 'B'], 'plain': 'text'
+    }
+
+
+def test_no_sites(data_map):
+    assert DataMapper(data_map, {'id': 'id-{payload[id]}', 'count': 'INT:{payload[count]}'}).is_noop
+    assert DataMapper({}).is_noop
+    assert not DataMapper(data_map).is_noop
+
+
+def test_payloads_without_template_nor_data_map_are_sent_as_is(dequeuer_factory):
+    actions = {'create_thing': {'topic': 'thing__created', 'endpoint': 'things/', 'method': 'POST'}}
+    post = mock.Mock(return_value=mock.Mock(status_code=201))
+    d = dequeuer_factory(actions, {'post': post})
+    payload = {'id': 1, 'note': 'MAP:foo', 'tags': ['MAP:x', 'y']}
+
+    assert d.compiled_actions['create_thing'].data_mapper.is_noop
+    assert d.do_handle_message(mock.Mock(), 'thing__created', payload) == 1
+    assert post.call_args[1]['json'] == payload
+
+
+def test_invalid_missing_policy():
+    with pytest.raises(ValueError, match='data_map_options missing must be one of'):
+        parse_data_map_options('action', {'missing': 'ignore'})
@@ -0,0 +1,66 @@
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.expressions import ExpressionError, compile_expression
+from powerlibs.aws.sqs.dequeue_to_api.templates import compile_payload_template
+
+
+def test_expression_language():
+    expression = compile_expression("max(data['values']) * 2 + len(data['values']) if data['ok'] else -1")
+
+    assert expression.evaluate({'data': {'values': [1, 5, 3], 'ok': True}}) == 13
+    assert expression.evaluate({'data': {'values': [], 'ok': False}}) == -1
+    assert compile_expression('[1, 2, 3][1:] == [2, 3] and 2 in {"a": 1, 2: 2}').evaluate()
+
+
+@pytest.mark.parametrize('source', (
+    "__import__('os').system('true')",
+    "open('/etc/passwd')",
+    "().__class__.__bases__",
+    "[x for x in (1, 2)]",
+    "(lambda: 1)()",
+    "2 ** 10 ** 10",
+    "[0] * 10 ** 9",
+    "'x' * 10 ** 10",
+    "((10 ** 999) ** 999) ** 999",
+    "(10 ** 999) * (10 ** 999) * (10 ** 999)",
+))
+def test_expression_rejects_unsafe_code(source):
+    with pytest.raises((ExpressionError, NameError)):
+        compile_expression(source).evaluate()
+
+
+def test_eval_templates_compatibility():
+    compiled = compile_payload_template({
+        'bound': 'EVAL:{payload[count]} * 2',
+        'text': 'EVAL:{payload[expression]} * 2',
+        'quoted': 'EVAL:"{payload[count]}" + "!"',
+        'constant': 'EVAL:[1, 2]',
+        'expression': "EXPR:int(payload['count']) + len(_topic)",
+        'optional': "OPTIONAL:EXPR:missing['count']",
+    })
+    entry = {'payload': {'count': '21', 'expression': '1 + 1'}}  # Data, not code: a string.
+
+    rendered = compiled.render('topic', {}, {}, entry)
+
+    assert rendered == {
+        'bound': 42,
+        'text': '1 + 11 + 1',
+        'quoted': '21!',
+        'constant': [1, 2],
+        'expression': 26,
+    }
+    assert compiled.fields[0].bound is not None
+    assert compiled.fields[2].bound is None
+
+
+@pytest.mark.parametrize('value, expected', (
+    ('len([0] * 10 ** 3) + 1', 'len([0] * 10 ** 3) + 1'),
+    ('-3', -3),
+    ('[1, 2]', [1, 2]),
+    ("'quoted'", 'quoted'),
+))
+def test_eval_template_fields_are_never_code(value, expected):
+    compiled = compile_payload_template({'value': 'EVAL:{payload[value]}'})
+
+    assert compiled.fields[0].bound is not None
+    assert compiled.render('topic', {}, {}, {'payload': {'value': value}}) == {'value': expected}
@@ -0,0 +1,113 @@
+from unittest import mock
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.instrumentation import (
+    NULL_METRICS, Metrics, Stats, StatsDExporter, build_metrics, render_prometheus
+)
+
+from conftest import build_message
+
+
+def build_actions():
+    return {
+        'update_children': {
+            'topic': 'parent__updated',
+            'endpoint': 'children/{payload[id]}/',
+            'method': 'PATCH',
+            'accumulators': [('child', 'parents/{payload[id]}/children/')],
+            'payload': {'parent': '{payload[id]}', 'child': '{child[id]}'},
+        },
+    }
+
+
+def build_methods():
+    children = {'results': [{'id': 1}, {'id': 2}]}
+    return {
+        'get': mock.Mock(return_value=mock.Mock(status_code=200, json=mock.Mock(return_value=children))),
+        'patch': mock.Mock(return_value=mock.Mock(status_code=200)),
+    }
+
+
+def test_metrics():
+    exporter = mock.Mock()
+    metrics = Metrics(buckets=(0.1, 1), exporters=[exporter])
+
+    metrics.increment('messages', result='ok')
+    metrics.increment('messages', 2, result='ok')
+    for value in (0.05, 0.5, 5):
+        metrics.observe('message_seconds', value)
+
+    assert metrics.get_counter('messages', result='ok') == 3
+    histogram = metrics.get_histogram('message_seconds')
+    assert list(histogram.get_cumulative_counts()) == [1, 2, 3]
+    assert histogram.sum == 5.55
+    exporter.assert_any_call('counter', 'messages', 2, {'result': 'ok'})
+    exporter.assert_any_call('histogram', 'message_seconds', 5, {})
+
+
+def test_stats():
+    class RequestStats(Stats):
+        COUNTERS = ('requests', 'failures')
+
+    stats = RequestStats()
+    stats.increment('requests', 2)
+    stats.increment('failures')
+
+    assert stats.requests == 2
+    assert stats.as_dict() == {'requests': 2, 'failures': 1}
+    with pytest.raises(AttributeError):
+        stats.other
+
+
+def test_render_prometheus():
+    metrics = Metrics(buckets=(0.1, 1))
+    metrics.increment('messages', result='ok')
+    metrics.observe('http_request_seconds', 0.5, method='post', status='201')
+
+    assert render_prometheus(metrics).splitlines() == [
+        '# TYPE dequeue_to_api_messages_total counter',
+        'dequeue_to_api_messages_total{result="ok"} 1',
+        '# TYPE dequeue_to_api_http_request_seconds histogram',
+        'dequeue_to_api_http_request_seconds_bucket{method="post",status="201",le="0.1"} 0',
+        'dequeue_to_api_http_request_seconds_bucket{method="post",status="201",le="1.0"} 1',
+        'dequeue_to_api_http_request_seconds_bucket{method="post",status="201",le="+Inf"} 1',
+        'dequeue_to_api_http_request_seconds_sum{method="post",status="201"} 0.5',
+        'dequeue_to_api_http_request_seconds_count{method="post",status="201"} 1',
+    ]
+
+
+def test_statsd_exporter():
+    sock = mock.Mock()
+    exporter = StatsDExporter(prefix='app', sock=sock)
+
+    exporter('counter', 'messages', 1, {'result': 'ok'})
+    exporter('histogram', 'http_request_seconds', 0.0125, {'status': '201', 'method': 'post'})
+
+    datagrams = [call[0][0] for call in sock.sendto.call_args_list]
+    assert datagrams == [b'app.messages:1|c|#result:ok', b'app.http_request:12.500|ms|#method:post,status:201']
+
+
+def test_disabled_metrics(dequeuer_factory):
+    assert build_metrics(None) is NULL_METRICS
+
+    d = dequeuer_factory(build_actions(), build_methods(), metrics=None)
+    assert d.parse_and_handle_message(build_message('parent__updated', {'id': 1})) == 1
+    assert d.metrics is NULL_METRICS
+
+
+def test_hot_paths_are_measured(dequeuer_factory):
+    d = dequeuer_factory(build_actions(), build_methods(), metrics=True)
+
+    assert d.parse_and_handle_message(build_message('parent__updated', {'id': 1})) == 1
+
+    metrics = d.metrics
+    assert metrics.get_histogram('routing_seconds').count == 1
+    assert metrics.get_histogram('accumulation_request_seconds', action='update_children', level='child').count == 1
+    assert metrics.get_counter('accumulation_results', action='update_children', level='child') == 2
+    assert metrics.get_histogram('template_render_seconds', action='update_children').count == 2
+    assert metrics.get_histogram('http_request_seconds', action='update_children', method='patch', status='200').count == 2
+    assert metrics.get_histogram('http_request_seconds', action='', method='get', status='200').count == 1
+    assert metrics.get_histogram('action_seconds', action='update_children', result='ok').count == 1
+    assert metrics.get_histogram('message_seconds', result='ok').count == 1
+    assert metrics.get_counter('messages', result='ok') == 1
@@ -0,0 +1,157 @@
+import json
+from unittest import mock
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.compiler import ConfigError, compile_config
+from powerlibs.aws.sqs.dequeue_to_api.journal import MemoryJournal, SQLiteJournal
+
+from conftest import build_message
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def build_actions():
+    return {
+        'link_tiles': {
+            'topic': 'project__processed',
+            'endpoint': 'links/',
+            'method': 'POST',
+            'accumulators': [('tile', 'tiles/?project={payload[id]}')],
+            'payload': {'tile': '{tile[id]}'},
+        },
+        'notify': {
+            'topic': 'project__processed',
+            'endpoint': 'notifications/',
+            'method': 'POST',
+            'depends_on': 'link_tiles',
+        },
+    }
+
+
+def build_methods(failing_urls):
+    def post(url, **kwargs):
+        response = mock.Mock(status_code=201)
+        if (url, json.dumps(kwargs['json'])) in failing_urls:
+            response.raise_for_status.side_effect = Exception('Service Unavailable')
+        return response
+
+    tiles = json.dumps({'results': [{'id': 1}, {'id': 2}, {'id': 3}]}).encode('utf-8')
+    return {
+        'get': mock.Mock(return_value=mock.Mock(status_code=200, content=tiles, encoding=None)),
+        'post': mock.Mock(side_effect=post),
+    }
+
+
+def get_writes(d):
+    return [(call[0][0], call[1]['json']) for call in d.mocked_requests_module.post.call_args_list]
+
+
+@pytest.mark.parametrize('journal_class', [MemoryJournal, SQLiteJournal])
+def test_journal_backends(journal_class):
+    clock = Clock()
+    journal = journal_class(retention=60, clock=clock)
+
+    journal.mark_done('MESSAGE-1', 'link_tiles', 0)
+    assert journal.is_done('MESSAGE-1', 'link_tiles', 0)
+    assert not journal.is_done('MESSAGE-1', 'link_tiles', 1)
+    assert not journal.is_done('MESSAGE-2', 'link_tiles', 0)
+
+    clock.now += 60
+    assert not journal.is_done('MESSAGE-1', 'link_tiles', 0)
+    assert journal.expire() == 1
+    assert len(journal) == 0
+
+    journal.mark_done('MESSAGE-1', 'link_tiles', 0)
+    journal.mark_done('MESSAGE-1', 'notify', -1)
+    journal.mark_done('MESSAGE-2', 'link_tiles', 0)
+    assert journal.forget('MESSAGE-1') == 2
+    assert not journal.is_done('MESSAGE-1', 'link_tiles', 0)
+    assert journal.is_done('MESSAGE-2', 'link_tiles', 0)
+    assert len(journal) == 1
+    journal.close()
+
+
+def test_redelivered_messages_resume_where_they_failed(dequeuer_factory):
+    failing_urls = {('https://example.com/notifications/', json.dumps({'id': 10}))}
+    d = dequeuer_factory(build_actions(), build_methods(failing_urls), journal=True)
+
+    assert d.parse_and_handle_message(build_message('project__processed', {'id': 10}, 'MESSAGE-1')) == 0
+    assert len(get_writes(d)) == 4
+
+    failing_urls.clear()
+    d.mocked_requests_module.post.reset_mock()
+    assert d.parse_and_handle_message(build_message('project__processed', {'id': 10}, 'MESSAGE-1')) == 1
+
+    assert get_writes(d) == [('https://example.com/notifications/', {'id': 10})]
+    assert d.get_journal_stats()['skipped_actions'] == 1
+
+
+def test_redelivered_messages_resume_at_the_failed_entry(dequeuer_factory):
+    failing_urls = {('https://example.com/links/', json.dumps({'tile': '2'}))}
+    d = dequeuer_factory(build_actions(), build_methods(failing_urls), journal=True)
+
+    assert d.parse_and_handle_message(build_message('project__processed', {'id': 10}, 'MESSAGE-1')) == 0
+    failing_urls.clear()
+    d.mocked_requests_module.post.reset_mock()
+    assert d.parse_and_handle_message(build_message('project__processed', {'id': 10}, 'MESSAGE-1')) == 1
+
+    assert get_writes(d) == [
+        ('https://example.com/links/', {'tile': '2'}),
+        ('https://example.com/links/', {'tile': '3'}),
+        ('https://example.com/notifications/', {'id': 10}),
+    ]
+    assert d.get_journal_stats()['skipped_writes'] == 1
+
+
+def test_deleted_messages_are_forgotten(dequeuer_factory):
+    failing_urls = {('https://example.com/notifications/', json.dumps({'id': 10}))}
+    d = dequeuer_factory(build_actions(), build_methods(failing_urls), journal=True)
+
+    assert d.parse_and_handle_message(build_message('project__processed', {'id': 10}, 'MESSAGE-1')) == 0
+    assert len(d.journal) == 4
+
+    failing_urls.clear()
+    assert d.parse_and_handle_message(build_message('project__processed', {'id': 10}, 'MESSAGE-1')) == 1
+    assert len(d.journal) == 0
+    assert d.get_journal_stats()['forgotten'] == 6
+
+
+def test_without_a_journal_everything_runs_again(dequeuer_factory):
+    failing_urls = {('https://example.com/notifications/', json.dumps({'id': 10}))}
+    d = dequeuer_factory(build_actions(), build_methods(failing_urls), journal=None)
+
+    assert d.parse_and_handle_message(build_message('project__processed', {'id': 10}, 'MESSAGE-1')) == 0
+    failing_urls.clear()
+    assert d.parse_and_handle_message(build_message('project__processed', {'id': 10}, 'MESSAGE-1')) == 1
+
+    assert len(get_writes(d)) == 8
+
+
+def test_sqlite_journal_survives_restarts(dequeuer_factory, tmpdir):
+    path = str(tmpdir.join('journal.db'))
+    failing_urls = {('https://example.com/notifications/', json.dumps({'id': 10}))}
+    d = dequeuer_factory(build_actions(), build_methods(failing_urls), journal={'backend': 'sqlite', 'path': path})
+    assert d.parse_and_handle_message(build_message('project__processed', {'id': 10}, 'MESSAGE-1')) == 0
+    d.journal.close()
+
+    d = dequeuer_factory(build_actions(), build_methods(set()), journal={'backend': 'sqlite', 'path': path})
+    assert d.parse_and_handle_message(build_message('project__processed', {'id': 10}, 'MESSAGE-1')) == 1
+    assert get_writes(d) == [('https://example.com/notifications/', {'id': 10})]
+
+
+@pytest.mark.parametrize('journal, message', [
+    ({'backend': 'redis'}, 'Unknown journal backend "redis"'),
+    ({'retention': 0}, 'journal retention must be a positive number'),
+    ({'retension': 60}, 'journal: unknown field "retension"'),
+])
+def test_invalid_journal_configs(journal, message):
+    config = {'config': {'base_url': 'https://example.com/', 'journal': journal}, 'actions': {}}
+    with pytest.raises(ConfigError, match=message):
+        compile_config(config)
@@ -0,0 +1,108 @@
+import json
+from unittest import mock
+
+import pytest
+
+from conftest import build_message
+
+
+def test_plans_are_built_per_message(dequeuer):
+    (name_1, plan_1), = dequeuer.get_actions_for_topic('step__alfa__started', {'company_name': 'test_company'})
+    (name_2, plan_2), = dequeuer.get_actions_for_topic('step__beta__finished', {'company_name': 'test_company'})
+
+    assert name_1 == name_2 == 'test_regexp_matching_with_groups'
+    assert plan_1.entries == ({'status': 'started', 'name': 'alfa'},)
+    assert plan_2.entries == ({'status': 'finished', 'name': 'beta'},)
+    assert plan_1.action['message_topic'] == 'step__alfa__started'
+    assert plan_2.action['message_topic'] == 'step__beta__finished'
+    assert plan_1.url == 'https://test_company.example.com/steps/'
+    assert plan_1.method == 'post'
+
+
+def test_plans_do_not_touch_the_actions_config(dequeuer):
+    action_data = dequeuer.actions['update_parent']
+    original = dict(action_data)
+
+    for _, plan in dequeuer.get_actions_for_topic('mycompany__child_created', {'company_name': 'mycompany', 'parent_id': 2}):
+        plan.run()
+
+    assert action_data == original
+    assert 'run' not in action_data
+    assert 'message_topic' not in action_data
+
+
+def test_plans_are_immutable(dequeuer):
+    (_, plan), = dequeuer.get_actions_for_topic('object__created', {'company_name': 'test_company'})
+
+    with pytest.raises(AttributeError):
+        plan.url = 'https://elsewhere.example.com/'
+
+    with pytest.raises(AttributeError):
+        del plan.entries
+
+
+LAZY_ACTIONS = {
+    'link_tiles': {
+        'topic': 'project__processed',
+        'endpoint': 'links/',
+        'method': 'POST',
+        'accumulators': [
+            ('flight', 'flights/?project={payload[id]}'),
+            ('tile', 'tiles/?flight={flight[id]}'),
+        ],
+        'payload': {'flight': '{flight[id]}', 'tile': '{tile[id]}'},
+    },
+    'notify': {
+        'topic': 'project__processed',
+        'endpoint': 'notifications/',
+        'method': 'POST',
+        'depends_on': 'link_tiles',
+    },
+}
+
+
+def build_lazy_methods(write_error=None):
+    def get(url, **kwargs):
+        results = [{'id': 1}, {'id': 2}] if 'flights' in url else [{'id': url[-1] + 'a'}, {'id': url[-1] + 'b'}]
+        return mock.Mock(status_code=200, content=json.dumps({'results': results}).encode('utf-8'), encoding=None)
+
+    response = mock.Mock(status_code=201)
+    if write_error is not None:
+        response.raise_for_status.side_effect = write_error
+    return {'get': mock.Mock(side_effect=get), 'post': mock.Mock(return_value=response)}
+
+
+def test_plans_are_hydrated_as_they_run(dequeuer_factory):
+    d = dequeuer_factory(LAZY_ACTIONS, build_lazy_methods())
+    (_, plan), _ = d.get_actions_for_topic('project__processed', {'id': 10})
+
+    assert d.mocked_requests_module.get.call_count == 0
+    assert repr(plan) == '<ActionPlan link_tiles post https://example.com/links/ (0+ entries, 0 handlers)>'
+
+    plan.run()
+
+    assert d.mocked_requests_module.get.call_count == 3
+    assert [call[1]['json'] for call in d.mocked_requests_module.post.call_args_list] == [
+        {'flight': '1', 'tile': '1a'}, {'flight': '1', 'tile': '1b'},
+        {'flight': '2', 'tile': '2a'}, {'flight': '2', 'tile': '2b'},
+    ]
+    assert len(plan.entries) == 4
+    assert d.mocked_requests_module.get.call_count == 3
+
+
+def test_failed_writes_stop_the_hydration(dequeuer_factory):
+    d = dequeuer_factory(LAZY_ACTIONS, build_lazy_methods(write_error=Exception('Bad Request')))
+    message = build_message('project__processed', {'id': 10})
+
+    assert d.parse_and_handle_message(message) == 0
+
+    # Only the first flight's tiles were fetched, and "notify" was never built.
+    assert d.mocked_requests_module.get.call_count == 2
+    assert d.mocked_requests_module.post.call_count == 1
+    assert d.get_hydration_stats() == {
+        'actions_matched': 2,
+        'actions_built': 1,
+        'actions_skipped': 1,
+        'entries_hydrated': 1,
+        'plans_abandoned': 1,
+    }
@@ -0,0 +1,104 @@
+import os.path
+import sys
+from unittest import mock
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.compiler import ConfigError, compile_config
+from powerlibs.aws.sqs.dequeue_to_api.plugins import PluginRegistry
+
+
+PLUGINS_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'plugins')
+
+
+def build_config(handlers, loading='lazy'):
+    return {
+        'config': {
+            'base_url': 'https://example.com/',
+            'custom_handlers': {'paths': [PLUGINS_PATH], 'loading': loading},
+        },
+        'actions': {
+            'run_plugins': {'topic': 'plugins__run', 'custom_handlers': handlers},
+        },
+    }
+
+
+def test_plugins_are_loaded_lazily(dequeuer_factory):
+    d = dequeuer_factory(config=build_config(['fixture_plugin.record']))
+
+    assert d.custom_handlers == {}
+    assert d.plugins.plugin_names == ('fixture_plugin',)
+
+    assert d.do_handle_message(mock.Mock(), 'plugins__run', {'id': 1}) == 1
+
+    plugin = d.custom_handlers['fixture_plugin']
+    assert plugin.warmed_up
+    assert plugin.calls == [('plugins__run', {'id': 1})]
+    assert 'unused_plugin.plugin' not in sys.modules
+
+
+def test_plugins_are_loaded_eagerly(dequeuer_factory):
+    d = dequeuer_factory(config=build_config(['fixture_plugin.record'], loading='eager'))
+
+    plugin = d.custom_handlers['fixture_plugin']
+    assert plugin.warmed_up
+    d.shutdown()
+    assert plugin.closed
+
+
+def test_plugins_are_closed_once(dequeuer_factory):
+    d = dequeuer_factory(config=build_config(['fixture_plugin.record'], loading='eager'))
+    plugin = d.custom_handlers['fixture_plugin']
+    plugin.close = mock.Mock()
+
+    d.shutdown()
+    d.shutdown()
+
+    assert plugin.close.call_count == 1
+    assert d.custom_handlers == {}
+
+
+def test_handler_stats(dequeuer_factory):
+    d = dequeuer_factory(config=build_config(['fixture_plugin.record', 'fixture_plugin.fail']))
+
+    d.do_handle_message(mock.Mock(), 'plugins__run', {'id': 1})
+    d.do_handle_message(mock.Mock(), 'plugins__run', {'id': 2})
+
+    stats = d.get_handler_stats()
+    assert stats['fixture_plugin.record']['calls'] == 2
+    assert stats['fixture_plugin.record']['failures'] == 0
+    assert stats['fixture_plugin.fail']['calls'] == 2
+    assert stats['fixture_plugin.fail']['failures'] == 2
+    assert stats['fixture_plugin.fail']['mean_time'] > 0
+
+
+def test_preload_only_imports():
+    sys.modules.pop('fixture_plugin.plugin', None)
+    registry = PluginRegistry([PLUGINS_PATH], ['fixture_plugin.record'])
+
+    registry.preload()
+
+    assert 'fixture_plugin.plugin' in sys.modules
+    assert len(registry) == 0
+
+
+def test_missing_plugins():
+    registry = PluginRegistry([PLUGINS_PATH], ['nothing.record'])
+
+    with pytest.raises(ImportError, match='No plugin "nothing"'):
+        registry.get_handler('nothing.record')
+
+
+def test_invalid_loading():
+    with pytest.raises(ConfigError, match='loading must be one of lazy, eager'):
+        compile_config(build_config(['fixture_plugin.record'], loading='sometimes'))
+
+
+def test_deprecated_plugin_loading(dequeuer_factory):
+    d = dequeuer_factory(config=build_config([]))
+
+    with pytest.warns(DeprecationWarning):
+        d.load_custom_handler(os.path.join(PLUGINS_PATH, 'fixture_plugin', 'plugin.py'))
+
+    assert d.custom_handlers['fixture_plugin'].warmed_up
+    assert d.get_custom_handler('fixture_plugin.record') is not None
@@ -0,0 +1,113 @@
+import copy
+import json
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.replay import ReplayMessage, diff_writes, main, read_messages, replay
+
+
+CONFIG = {
+    'config': {'base_url': 'https://example.com/'},
+    'actions': {
+        'create_tiles': {
+            'topic': 'project__processed',
+            'endpoint': 'tiles/',
+            'method': 'POST',
+            'accumulators': [('flight', 'flights/?project={payload[id]}')],
+            'payload': {'project': '{payload[id]}', 'flight': '{flight[id]}', 'kind': 'MAP:{payload[kind]}'},
+            'data_map': {'rgb': 'RGB'},
+        },
+        'notify': {
+            'topic': 'project__processed',
+            'custom_handlers': ['notifier.notify'],
+        },
+    },
+}
+RESPONSES = {
+    'https://example.com/flights/?project=1': {'results': [{'id': 10}, {'id': 11}]},
+}
+
+
+@pytest.fixture
+def messages():
+    return [
+        ReplayMessage('project__processed', {'id': 1, 'kind': 'rgb'}, 'M1'),
+        ReplayMessage('project__processed', {'id': 2, 'kind': 'rgb'}, 'M2'),
+        ReplayMessage('unknown__topic', {'id': 3}, 'M3'),
+    ]
+
+
+def test_replay(messages):
+    writes, report = replay(CONFIG, messages, RESPONSES)
+
+    assert writes == [
+        {'message': 'M1', 'topic': 'project__processed', 'method': 'POST', 'url': 'https://example.com/tiles/',
+         'body': {'project': '1', 'flight': '10', 'kind': 'RGB'}},
+        {'message': 'M1', 'topic': 'project__processed', 'method': 'POST', 'url': 'https://example.com/tiles/',
+         'body': {'project': '1', 'flight': '11', 'kind': 'RGB'}},
+        {'message': 'M1', 'topic': 'project__processed', 'handler': 'notifier.notify',
+         'payload': {'id': 1, 'kind': 'rgb'}},
+        {'message': 'M2', 'topic': 'project__processed', 'handler': 'notifier.notify',
+         'payload': {'id': 2, 'kind': 'rgb'}},
+    ]
+    assert report['handled'] == 3
+    assert report['gets'] == 2
+    assert report['unrecorded_gets'] == 1
+    assert report['actions'] == {
+        'create_tiles': {'runs': 2, 'failed': 0, 'gets': 2, 'entries': 2, 'writes': 2},
+        'notify': {'runs': 2, 'failed': 0, 'gets': 0, 'entries': 0, 'writes': 2},
+    }
+    assert all(message.deleted for message in messages)
+
+
+def test_replay_unrecorded_gets_can_fail(messages):
+    _, report = replay(CONFIG, messages, RESPONSES, missing='error')
+
+    assert report['failed'] == 1
+    assert report['actions']['create_tiles']['failed'] == 1
+
+
+def test_diff_writes(messages):
+    other_config = copy.deepcopy(CONFIG)
+    other_config['actions']['create_tiles']['data_map'] = {'rgb': 'VISIBLE'}
+
+    writes, _ = replay(CONFIG, messages, RESPONSES)
+    other_writes, _ = replay(other_config, messages, RESPONSES)
+
+    diff = diff_writes(writes, other_writes)
+    assert [message_diff['message'] for message_diff in diff] == ['M1']
+    assert [write['body']['kind'] for write in diff[0]['removed']] == ['RGB', 'RGB']
+    assert [write['body']['kind'] for write in diff[0]['added']] == ['VISIBLE', 'VISIBLE']
+    assert diff_writes(writes, writes) == []
+
+
+def test_cli(tmpdir, capsys):
+    config_path = tmpdir.join('config.json')
+    config_path.write(json.dumps(CONFIG))
+    other_config = copy.deepcopy(CONFIG)
+    del other_config['actions']['notify']
+    other_config_path = tmpdir.join('other.json')
+    other_config_path.write(json.dumps(other_config))
+    responses_path = tmpdir.join('responses.json')
+    responses_path.write(json.dumps(RESPONSES))
+    messages_path = tmpdir.join('messages.jsonl')
+    messages_path.write('{"topic": "project__processed", "body": {"id": 1, "kind": "rgb"}, "id": "M1"}\n\n')
+    output_path = tmpdir.join('writes.jsonl')
+
+    assert len(read_messages(str(messages_path))) == 1
+    assert main([str(config_path), str(messages_path), '--responses', str(responses_path),
+                 '--output', str(output_path)]) == 0
+    assert len(output_path.readlines()) == 3
+    assert 'create_tiles' in capsys.readouterr().out
+
+    assert main([str(config_path), str(messages_path), '--responses', str(responses_path),
+                 '--compare', str(other_config_path), '--json']) == 1
+    output = json.loads(capsys.readouterr().out)
+    assert output['diff'] == [{
+        'message': 'M1',
+        'removed': [{'handler': 'notifier.notify', 'payload': {'id': 1, 'kind': 'rgb'}, 'topic': 'project__processed'}],
+        'added': [],
+    }]
+
+    messages_path.write('{"body": {}}\n')
+    assert main([str(config_path), str(messages_path)]) == 2
@@ -0,0 +1,141 @@
+from unittest import mock
+
+import pytest
+import requests
+
+from powerlibs.aws.sqs.dequeue_to_api.retries import (
+    CircuitBreaker, CircuitOpenError, call_with_retry, get_delay, get_retry_after, parse_retry
+)
+
+from conftest import build_message
+
+
+def http_error(status_code, headers=None):
+    response = mock.Mock(status_code=status_code, headers=headers or {})
+    return requests.HTTPError('{} Error'.format(status_code), response=response)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def build_actions(retry=None):
+    return {
+        'update_parent': {
+            'topic': 'child__updated',
+            'endpoint': 'parents/{payload[parent_id]}/',
+            'method': 'PATCH',
+            'retry': retry,
+        },
+    }
+
+
+def test_get_retry_after():
+    assert get_retry_after(mock.Mock(headers={'Retry-After': '3'})) == 3.0
+    assert get_retry_after(mock.Mock(headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0.0
+    assert get_retry_after(mock.Mock(headers={})) is None
+    assert get_retry_after(None) is None
+
+
+def test_get_delay():
+    retry = parse_retry('action', {'backoff': 1, 'max_backoff': 5, 'jitter': False})
+    error = http_error(503)
+
+    assert [get_delay(attempt, error, retry) for attempt in (1, 2, 3, 4)] == [1, 2, 4, 5]
+    assert get_delay(3, http_error(429, {'Retry-After': '2'}), retry) == 2
+
+    jittered = parse_retry('action', {'backoff': 1})
+    assert get_delay(2, error, jittered, lambda: 0.5) == 1
+
+
+def test_call_with_retry():
+    retry = parse_retry('action', {'max_attempts': 3})
+    sleep = mock.Mock()
+    function = mock.Mock(side_effect=[http_error(503), requests.ConnectionError(), 'RESPONSE'])
+
+    assert call_with_retry(function, retry, sleep=sleep) == 'RESPONSE'
+    assert function.call_count == 3
+    assert sleep.call_count == 2
+
+
+@pytest.mark.parametrize('error, calls', (
+    (http_error(400), 1),
+    (http_error(503), 3),
+))
+def test_call_with_retry_gives_up(error, calls):
+    retry = parse_retry('action', {'max_attempts': 3})
+    function = mock.Mock(side_effect=error)
+
+    with pytest.raises(requests.HTTPError):
+        call_with_retry(function, retry, sleep=mock.Mock())
+    assert function.call_count == calls
+
+
+def test_circuit_breaker():
+    clock = Clock()
+    breaker = CircuitBreaker('https://example.com', failure_threshold=2, reset_timeout=10, clock=clock)
+
+    breaker.before_request()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    clock.now = 4
+    with pytest.raises(CircuitOpenError) as info:
+        breaker.before_request()
+    assert info.value.retry_in == 6
+
+    clock.now = 10
+    breaker.before_request()  # The trial request.
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    clock.now = 20
+    breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def test_failed_writes_are_retried_by_themselves(dequeuer_factory):
+    patch = mock.Mock(side_effect=[http_error(503), mock.Mock(status_code=200)])
+    d = dequeuer_factory(build_actions({'max_attempts': 2, 'backoff': 0}), {'patch': patch})
+    message = build_message('child__updated', {'parent_id': 1})
+
+    assert d.parse_and_handle_message(message) == 1
+    assert patch.call_count == 2
+    assert message.delete.call_count == 1
+
+
+def test_open_circuits_postpone_messages(dequeuer_factory):
+    patch = mock.Mock(side_effect=http_error(503))
+    d = dequeuer_factory(
+        build_actions(), {'patch': patch}, circuit_breaker={'failure_threshold': 1, 'reset_timeout': 30}
+    )
+
+    first, second = (build_message('child__updated', {'parent_id': 1}) for _ in range(2))
+    assert d.parse_and_handle_message(first) == 0
+    assert first.change_visibility.call_count == 0
+
+    assert d.parse_and_handle_message(second) == 0
+    assert patch.call_count == 1
+    second.change_visibility.assert_called_once_with(VisibilityTimeout=30)
+    assert second.delete.call_count == 0
+
+
+def test_circuit_breakers_are_off_unless_configured(dequeuer_factory):
+    patch = mock.Mock(side_effect=http_error(503))
+    d = dequeuer_factory(build_actions(), {'patch': patch})
+
+    messages = [build_message('child__updated', {'parent_id': 1}) for _ in range(10)]
+    for message in messages:
+        assert d.parse_and_handle_message(message) == 0
+
+    assert patch.call_count == 10
+    assert all(message.change_visibility.call_count == 0 for message in messages)
+    assert len(d.circuit_breakers.breakers) == 0
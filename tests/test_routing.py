@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+import re
+
+from powerlibs.aws.sqs.dequeue_to_api.routing import TopicRouter
+
+
+TOPICS = (
+    '{payload[company_name]}__child_created',
+    'object__\\w+',
+    'step__(?P<step_name>[^_]+)__(?P<step_status>[^_]+)',
+    'object__created',
+    '(a)(?P<x>b)?c__(?P<y>\\w+)',
+    '{config[prefix]}__started',
+    '(?P<word>\\w+)__(?P=word)',
+    '(?i)CASE__\\w+',
+)
+
+
+def linear_scan(topics, config, topic, payload):
+    for topic_name in topics:
+        match = re.match(topic_name.format(config=config, payload=payload), topic)
+        if match:
+            yield topic_name, match.groupdict()
+
+
+def test_router_classification():
+    router = TopicRouter(TOPICS, {'prefix': 'job'})
+
+    assert router.kinds['{payload[company_name]}__child_created'] == TopicRouter.TEMPLATE
+    assert router.kinds['object__created'] == TopicRouter.LITERAL
+    assert router.kinds['{config[prefix]}__started'] == TopicRouter.LITERAL
+    assert router.kinds['object__\\w+'] == TopicRouter.REGEX
+
+
+def test_router_matches_linear_scan():
+    config = {'prefix': 'job'}
+    payload = {'company_name': 'mycompany'}
+    router = TopicRouter(TOPICS, config)
+
+    for topic in (
+        'mycompany__child_created',
+        'othercompany__child_created',
+        'object__created',
+        'object__created_again',
+        'object__deleted',
+        'step__alfa__started',
+        'ac__zeta',
+        'abc__zeta',
+        'job__started',
+        'same__same',
+        'same__other',
+        'case__lower',
+        'nothing',
+    ):
+        expected = list(linear_scan(TOPICS, config, topic, payload))
+        assert router.route(topic, payload) == expected, topic
+
+
+def test_router_templates_per_payload():
+    router = TopicRouter(TOPICS, {'prefix': 'job'})
+
+    routed = router.route('mycompany__child_created', {'company_name': 'mycompany'})
+    assert [topic_name for topic_name, _ in routed] == ['{payload[company_name]}__child_created']
+
+    assert router.route('mycompany__child_created', {'company_name': 'other'}) == []
+    assert len(router.template_routers) == 2
+
+
+def test_router_template_cache_is_thread_safe():
+    router = TopicRouter(TOPICS, {'prefix': 'job'}, cache_size=4)
+
+    def route(index):
+        company_name = 'company{}'.format(index % 16)
+        return router.route('{}__child_created'.format(company_name), {'company_name': company_name})
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(route, range(2000)))
+
+    assert all(len(routed) == 1 for routed in results)
+    assert len(router.template_routers) <= 4
@@ -0,0 +1,109 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from conftest import build_message
+
+
+def build_actions():
+    return {
+        'notify': {
+            'topic': 'thing__created',
+            'endpoint': 'notifications/',
+            'method': 'POST',
+            'depends_on': ['create', 'update'],
+        },
+        'create': {
+            'topic': 'thing__created',
+            'endpoint': 'things/',
+            'method': 'POST',
+        },
+        'update': {
+            'topic': 'thing__created',
+            'endpoint': 'parents/',
+            'method': 'PATCH',
+        },
+    }
+
+
+class RecordingRequests:
+    def __init__(self, delay=0, failing_url=None):
+        self.delay = delay
+        self.failing_url = failing_url
+        self.lock = threading.Lock()
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    @property
+    def methods(self):
+        return {'post': self, 'patch': self}
+
+    def __call__(self, url, **kwargs):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.calls.append(url.rsplit('/', 2)[-2])
+
+        if url == self.failing_url:
+            raise RuntimeError('Failed: {}'.format(url))
+        return mock.Mock(status_code=200)
+
+
+@pytest.mark.parametrize('actions_concurrency', (1, 4))
+def test_dependencies_run_first(dequeuer_factory, actions_concurrency):
+    requests = RecordingRequests(delay=0.01)
+    d = dequeuer_factory(build_actions(), requests.methods, actions_concurrency=actions_concurrency)
+    message = build_message('thing__created', {'id': 1})
+
+    assert d.parse_and_handle_message(message) == 1
+    assert sorted(requests.calls[:2]) == ['parents', 'things']
+    assert requests.calls[2] == 'notifications'
+    assert message.delete.call_count == 1
+
+
+def test_independent_actions_run_concurrently(dequeuer_factory):
+    requests = RecordingRequests(delay=0.05)
+    d = dequeuer_factory(build_actions(), requests.methods, actions_concurrency=4)
+
+    d.parse_and_handle_message(build_message('thing__created', {'id': 1}))
+
+    assert requests.max_running == 2
+    stats = d.execution_stats.as_dict()
+    assert stats['messages'] == 1
+    assert stats['actions'] == 3
+    assert stats['actions_time'] > stats['wall_time']
+    assert stats['parallelism'] > 1
+
+
+@pytest.mark.parametrize('actions_concurrency', (1, 4))
+def test_failures_stop_dependents_and_keep_the_message(dequeuer_factory, actions_concurrency):
+    requests = RecordingRequests(failing_url='https://example.com/parents/')
+    d = dequeuer_factory(build_actions(), requests.methods, actions_concurrency=actions_concurrency)
+    message = build_message('thing__created', {'id': 1})
+
+    assert d.parse_and_handle_message(message) == 0
+    assert 'notifications' not in requests.calls
+    assert message.delete.call_count == 0
+    assert d.execution_stats.failures == 1
+
+
+def test_unknown_dependency(dequeuer_factory):
+    actions = build_actions()
+    actions['notify']['depends_on'] = 'nothing'
+
+    with pytest.raises(ValueError, match='unknown action "nothing"'):
+        dequeuer_factory(actions)
+
+
+def test_dependency_cycle(dequeuer_factory):
+    actions = build_actions()
+    actions['create']['depends_on'] = 'notify'
+
+    with pytest.raises(ValueError, match='cycle'):
+        dequeuer_factory(actions)
@@ -0,0 +1,105 @@
+import json
+from unittest import mock
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.serialization import (
+    JSONSerializer, OrjsonSerializer, decode_response, get_serializer, orjson, project_fields
+)
+from powerlibs.aws.sqs.dequeue_to_api.transformations import accumulate
+
+from conftest import build_message
+
+
+def build_actions():
+    return {
+        'link_children': {
+            'topic': 'parent__updated',
+            'endpoint': 'parents/{payload[id]}/links/',
+            'method': 'POST',
+            'accumulators': [('child', 'parents/{payload[id]}/children/', {'fields': ['id']})],
+            'payload': {'parent': '{payload[id]}', 'child': '{child[id]}'},
+        },
+    }
+
+
+def build_methods():
+    children = json.dumps({'results': [{'id': 1, 'name': 'A'}, {'id': 2, 'name': 'B'}]}).encode('utf-8')
+    return {
+        'get': mock.Mock(return_value=mock.Mock(status_code=200, content=children, encoding='utf-8')),
+        'post': mock.Mock(return_value=mock.Mock(status_code=201)),
+    }
+
+
+def test_get_serializer():
+    assert get_serializer('json').name == 'json'
+    assert get_serializer().name == ('orjson' if orjson is not None else 'json')
+    with pytest.raises(ValueError, match='nothing'):
+        get_serializer('nothing')
+
+
+@pytest.mark.skipif(orjson is None, reason='orjson is not installed')
+def test_orjson_serializer():
+    serializer = OrjsonSerializer()
+
+    assert serializer.loads('{"a": [1, 2]}') == {'a': [1, 2]}
+    assert serializer.dumps({'a': 1, 2: 'b'}) == b'{"a":1,"2":"b"}'
+    assert serializer.dumps({'big': 2 ** 70}) == JSONSerializer().dumps({'big': 2 ** 70})
+    assert serializer.loads(b'{"big": 1180591620717411303424}') == {'big': 2 ** 70}
+
+
+@pytest.mark.skipif(orjson is None, reason='orjson is not installed')
+def test_orjson_parses_what_json_does(dequeuer_factory):
+    d = dequeuer_factory(build_actions(), build_methods(), serialization={'backend': 'orjson'})
+    message = build_message('parent__updated', {})
+    message.body = '{"id": 1, "ratio": NaN, "limit": Infinity, "big": 1180591620717411303424}'
+
+    topic, payload = d.parse_message(message)
+    assert topic == 'parent__updated'
+    assert payload['id'] == 1
+    assert payload['ratio'] != payload['ratio']
+    assert payload['limit'] == float('inf')
+    assert payload['big'] == 2 ** 70
+
+
+def test_decode_response():
+    serializer = get_serializer()
+    response = mock.Mock(content=b'{"id": 1}', encoding=None, json=mock.Mock(return_value='json()'))
+    assert decode_response(serializer, response) == {'id': 1}
+
+    response.encoding = 'iso-8859-1'
+    assert decode_response(serializer, response) == 'json()'
+
+
+def test_project_fields():
+    assert project_fields([{'id': 1, 'name': 'A'}, 'other'], ['id', 'missing']) == [{'id': 1}, 'other']
+    assert project_fields([{'id': 1, 'name': 'A'}], None) == [{'id': 1, 'name': 'A'}]
+
+
+def test_accumulator_fields(dequeuer_factory):
+    d = dequeuer_factory(build_actions(), build_methods())
+
+    entries = accumulate(d, {'id': 10}, d.compiled_actions['link_children'].accumulators)
+
+    assert [entry['child'] for entry in entries] == [{'id': 1}, {'id': 2}]
+
+
+def test_writes_as_json_by_default(dequeuer_factory):
+    d = dequeuer_factory(build_actions(), build_methods())
+
+    assert d.parse_and_handle_message(build_message('parent__updated', {'id': 10})) == 1
+    post = d.mocked_requests_module.post
+    assert [call[1]['json'] for call in post.call_args_list] == [
+        {'parent': '10', 'child': '1'}, {'parent': '10', 'child': '2'}
+    ]
+
+
+def test_encoded_writes(dequeuer_factory):
+    d = dequeuer_factory(build_actions(), build_methods(), serialization={'backend': 'json', 'encode_writes': True})
+
+    assert d.parse_and_handle_message(build_message('parent__updated', {'id': 10})) == 1
+    post = d.mocked_requests_module.post
+    assert [call[1]['data'] for call in post.call_args_list] == [
+        b'{"parent":"10","child":"1"}', b'{"parent":"10","child":"2"}'
+    ]
+    assert post.call_args[1]['headers']['Content-Type'] == 'application/json'
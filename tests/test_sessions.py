@@ -0,0 +1,39 @@
+from unittest import mock
+
+from powerlibs.aws.sqs.dequeue_to_api.sessions import SessionPool
+
+
+def test_one_session_per_host():
+    sessions = []
+
+    def session_factory():
+        session = mock.Mock(headers={})
+        sessions.append(session)
+        return session
+
+    pool = SessionPool(lambda: {'Authorization': 'token TEST-TOKEN'}, keep_alive=False, session_factory=session_factory)
+    pool.request('get', 'https://a.example.com/foo/')
+    pool.request('post', 'https://a.example.com/bar/', json={})
+    pool.request('get', 'https://b.example.com/foo/')
+
+    assert len(sessions) == 2
+    assert sessions[0].headers == {'Authorization': 'token TEST-TOKEN', 'Connection': 'close'}
+    assert sessions[0].request.call_args_list == [
+        mock.call('GET', 'https://a.example.com/foo/'),
+        mock.call('POST', 'https://a.example.com/bar/', json={}),
+    ]
+
+    pool.close()
+    assert sessions[1].close.call_count == 1
+
+
+def test_dequeuer_uses_session_pool(dequeuer):
+    session = mock.Mock(headers={})
+    session.request.return_value = mock.Mock(status_code=200)
+
+    dequeuer.load_request_methods()
+    dequeuer.sessions.session_factory = mock.Mock(return_value=session)
+    dequeuer.request_methods['patch']('https://example.com/', json={})
+
+    session.request.assert_called_once_with('PATCH', 'https://example.com/', json={})
+    assert session.headers == {'Authorization': 'token TEST-TOKEN'}
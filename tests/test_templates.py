@@ -0,0 +1,96 @@
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.templates import compile_payload_template, split_field_name
+
+
+def legacy_apply_payload_template(payload_template, topic, topic_groups, action, payload):
+    hydrated_payload = {}
+    for key, value in payload_template.items():
+
+        optional = False
+        if value.startswith('OPTIONAL:'):
+            optional = True
+            value = value.replace('OPTIONAL:', '')
+
+        try:
+            hydrated_payload[key] = value.format(
+                _topic=topic,
+                _topic_groups=topic_groups,
+                _action=action,
+                **payload
+            )
+        except KeyError as ex:
+            if optional:
+                continue
+            raise ex
+
+        if hydrated_payload[key].startswith('INT:'):
+            hydrated_payload[key] = int(hydrated_payload[key].replace('INT:', ''))
+        elif hydrated_payload[key].startswith('DICT:'):
+            hydrated_payload[key] = dict(hydrated_payload[key].replace('DICT:', ''))
+        elif hydrated_payload[key].startswith('EVAL:'):
+            hydrated_payload[key] = eval(hydrated_payload[key].replace('EVAL:', ''))
+
+    return hydrated_payload
+
+
+TEMPLATE = {
+    'status': 'new status',
+    'escaped': '{{not a field}}',
+    'parent': '{payload[id]}',
+    'nested': '{alfa[data][0]}-{beta[name]!r:>10}',
+    'count': 'INT:{payload[count]}',
+    'constant_count': 'INT:42',
+    'dynamic_coercion': '{payload[coerced]}',
+    'expression': 'EVAL:{payload[count]} * 2',
+    'topic': '{_topic}/{_topic_groups[step]}/{_action[method]}',
+    'optional': 'OPTIONAL:{payload[missing]}',
+}
+
+
+def test_compiled_template_renders_like_legacy():
+    entry = {
+        'payload': {'id': 1, 'count': '21', 'coerced': 'INT:7'},
+        'alfa': {'data': ['first']},
+        'beta': {'name': 'beta'},
+    }
+    args = ('step__alfa', {'step': 'alfa'}, {'method': 'POST'}, entry)
+
+    compiled = compile_payload_template(TEMPLATE)
+    expected = legacy_apply_payload_template(TEMPLATE, *args)
+
+    assert compiled.render(*args) == expected
+    assert compiled.render(*args) == expected
+    assert expected['dynamic_coercion'] == 7
+    assert 'optional' not in expected
+
+
+def test_compiled_template_missing_key():
+    compiled = compile_payload_template({'status': '{payload[missing]}'})
+
+    with pytest.raises(KeyError):
+        compiled.render('topic', {}, {}, {'payload': {}})
+
+
+@pytest.mark.parametrize('field_name, expected', (
+    ('payload[items][0].id', ('payload', [(False, 'items'), (False, 0), (True, 'id')])),
+    ('payload[a.b[c]', ('payload', [(False, 'a.b[c')])),
+    ('0', ('0', [])),
+    ('payload.', None),
+    ('payload[]', None),
+    ('payload[id]x', None),
+))
+def test_split_field_name(field_name, expected):
+    assert split_field_name(field_name) == expected
+
+
+def test_payload_templates_cache(dequeuer):
+    compiled_action = next(
+        compiled_action for compiled_action in dequeuer.compiled_actions.values() if compiled_action.payload_template
+    )
+    assert dequeuer.get_payload_template(compiled_action.data['payload']) is compiled_action.payload_template
+
+    template = {'id': '{payload[id]}'}
+    compiled = dequeuer.get_payload_template(template)
+    assert dequeuer.get_payload_template(template) is compiled
+    assert dequeuer.get_payload_template({'id': '{payload[id]}'}) is not compiled
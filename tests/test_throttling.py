@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from unittest import mock
+
+import requests
+
+from powerlibs.aws.sqs.dequeue_to_api.throttling import AIMDController, HostLimiter, RateLimiters, TokenBucket
+
+from conftest import build_message
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = TokenBucket(rate=10, burst=2, clock=clock)
+
+    assert [bucket.reserve() for _ in range(4)] == [0, 0, 0.1, 0.2]
+
+    clock.now = 1
+    assert bucket.reserve() == 0
+
+
+def test_aimd():
+    clock = Clock()
+    bucket = TokenBucket(rate=10, clock=clock)
+    aimd = AIMDController(bucket, min_rate=2, max_rate=11, cooldown=1, latency_threshold=2, clock=clock)
+
+    assert aimd.record(503, 0.1)
+    assert bucket.rate == 5
+    assert aimd.record(429, 0.1)  # Within the cooldown.
+    assert bucket.rate == 5
+
+    clock.now = 2
+    assert aimd.record(200, 3)  # Too slow.
+    assert bucket.rate == 2.5
+
+    for _ in range(100):
+        assert not aimd.record(200, 0.1)
+    assert bucket.rate == 11
+
+
+def test_host_limiter_rate():
+    clock = Clock()
+    limiter = HostLimiter('https://example.com', rate=2, burst=1, clock=clock, sleep=clock.sleep)
+    function = mock.Mock(return_value=mock.Mock(status_code=200))
+
+    for _ in range(5):
+        limiter.call(function)
+
+    assert function.call_count == 5
+    assert clock.now == 2
+    assert limiter.stats.delayed == 4
+
+
+def test_host_limiter_concurrency():
+    limiter = HostLimiter('https://example.com', max_concurrency=2)
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def function():
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: limiter.call(function), range(16)))
+
+    assert running[1] == 2
+
+
+def test_host_limiter_aimd_on_errors():
+    limiter = HostLimiter('https://example.com', rate=10, aimd={'cooldown': 0})
+    error = requests.HTTPError(response=mock.Mock(status_code=429))
+
+    try:
+        limiter.call(mock.Mock(side_effect=error))
+    except requests.HTTPError:
+        pass
+
+    assert limiter.rate == 5
+    assert limiter.stats.congested == 1
+
+
+def test_rate_limiters_per_host():
+    limiters = RateLimiters({'rate': 10, 'hosts': {'https://slow.example.com': {'rate': 1}}})
+
+    assert limiters.get('https://example.com/a/').rate == 10
+    assert limiters.get('https://example.com/b/') is limiters.get('https://example.com/a/')
+    assert limiters.get('https://slow.example.com/a/').rate == 1
+    assert RateLimiters().get('https://example.com/') is None
+
+
+def test_dequeuer_rate_limits(dequeuer_factory):
+    d = dequeuer_factory(
+        {'create': {'topic': 'thing__created', 'endpoint': 'things/', 'method': 'POST'}},
+        {'post': mock.Mock(return_value=mock.Mock(status_code=201))},
+        rate_limit={'rate': 1000, 'max_concurrency': 4},
+    )
+
+    d.parse_and_handle_message(build_message('thing__created', {'id': 1}))
+
+    assert d.get_rate_limit_stats()['https://example.com']['requests'] == 1
@@ -1,8 +1,8 @@
 def test_topic_regexp_matching(dequeuer):
     msg = {'company_name': 'test_company'}
-    actions_1 = tuple(dequeuer.get_actions_for_topic('object__created', msg))
-    actions_2 = tuple(dequeuer.get_actions_for_topic('object__deleted', msg))
-    actions_3 = tuple(dequeuer.get_actions_for_topic('otherthing__created', msg))
+    actions_1 = tuple(name for name, plan in dequeuer.get_actions_for_topic('object__created', msg))
+    actions_2 = tuple(name for name, plan in dequeuer.get_actions_for_topic('object__deleted', msg))
+    actions_3 = tuple(name for name, plan in dequeuer.get_actions_for_topic('otherthing__created', msg))
 
     assert actions_1 == actions_2
     assert actions_1 != actions_3
@@ -12,7 +12,7 @@ def test_topic_regexp_matching_with_groups(dequeuer):
     msg = {'company_name': 'test_company'}
     actions_1 = tuple(dequeuer.get_actions_for_topic('step__alfa__started', msg))
 
-    payload = actions_1[0][1]['run'].args[2][0]
+    payload = actions_1[0][1].entries[0]
     assert 'name' in payload
     assert payload['name'] == 'alfa'
     assert 'status' in payload
@@ -21,5 +21,5 @@ def test_topic_regexp_matching_with_groups(dequeuer):
     actions_2 = tuple(dequeuer.get_actions_for_topic('step__beta__finished', msg))
     actions_3 = tuple(dequeuer.get_actions_for_topic('otherthing__created', msg))
 
-    assert actions_1 == actions_2
-    assert actions_1 != actions_3
+    assert [name for name, plan in actions_1] == [name for name, plan in actions_2]
+    assert [name for name, plan in actions_1] != [name for name, plan in actions_3]
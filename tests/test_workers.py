@@ -0,0 +1,94 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from powerlibs.aws.sqs.dequeue_to_api.compiler import compile_config
+from powerlibs.aws.sqs.dequeue_to_api.instrumentation import AggregatedMetrics, Metrics
+from powerlibs.aws.sqs.dequeue_to_api.workers import WorkerSupervisor
+
+from conftest import build_message
+
+
+CONFIG = {
+    'config': {'base_url': 'https://example.com/', 'metrics': True},
+    'actions': {
+        'update_parent': {
+            'topic': 'parent__updated',
+            'endpoint': 'parents/{payload[id]}/',
+            'method': 'PATCH',
+            'payload': {'status': '{payload[status]}'},
+        },
+    },
+}
+
+
+class FakeQueue:
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    def receive_messages(self, MaxNumberOfMessages=1, **kwargs):
+        if not self.messages:
+            time.sleep(0.01)
+            return []
+        received, self.messages = self.messages[:MaxNumberOfMessages], self.messages[MaxNumberOfMessages:]
+        return received
+
+
+@pytest.fixture
+def make_dequeuer(dequeuer_factory):
+    # What the supervisor builds each worker's dequeuer with.
+    def make(compiled_config):
+        d = dequeuer_factory(
+            config=compiled_config,
+            methods={'patch': mock.Mock(return_value=mock.Mock(status_code=200))},
+            thread_pool_size=2,
+        )
+        d.queue = FakeQueue(build_message('parent__updated', {'id': index, 'status': 'done'}) for index in range(3))
+        return d
+
+    return make
+
+
+def test_aggregated_metrics():
+    first, second = Metrics(buckets=(0.1, 1)), Metrics(buckets=(0.1, 1))
+    first.increment('messages', result='ok')
+    second.increment('messages', 2, result='ok')
+    first.observe('message_seconds', 0.05)
+    second.observe('message_seconds', 0.5)
+
+    metrics = AggregatedMetrics()
+    metrics.update('first', first.snapshot())
+    metrics.update('second', second.snapshot())
+    metrics.update('second', second.snapshot())  # Replaces, doesn't add.
+
+    counters, histograms = metrics.snapshot()
+    assert metrics.get_counter('messages', result='ok') == 3
+    assert histograms[('message_seconds', ())] == ((0.1, 1.0), [1, 2, 2], 0.55, 2)
+
+
+def test_drain(make_dequeuer):
+    d = make_dequeuer(compile_config(CONFIG))
+    d.execute_new_thread(time.sleep, [0.2])
+
+    assert not d.drain(timeout=0.01)
+    assert d.drain(timeout=5)
+    d.shutdown()
+
+
+def test_worker_supervisor(make_dequeuer):
+    supervisor = WorkerSupervisor(make_dequeuer, CONFIG, {'processes': 2, 'report_interval': 0.05})
+
+    def stop_when_done():
+        deadline = time.monotonic() + 20
+        while supervisor.get_stats()['received'] < 6 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        supervisor.stop()
+
+    threading.Thread(target=stop_when_done, daemon=True).start()
+    stats = supervisor.run(poll_interval=0.05)
+
+    assert stats == {'workers': 2, 'alive': 0, 'restarts': 0, 'received': 6}
+    assert supervisor.metrics.get_counter('messages', result='ok') == 6
+    assert len(supervisor.metrics.snapshots) == 2